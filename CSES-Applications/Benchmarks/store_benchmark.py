@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Read/write throughput of the local HDF5 data store
+# Compares per-site DataFrame.to_hdf calls (fixed format, file reopened per site)
+# with one open, compressed table-format store.HDF_Writer for the whole batch.
+# Run from the CSES-Applications directory: python Benchmarks/store_benchmark.py
+
+import os
+import sys
+import time
+import tempfile
+import argparse
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Community_Eval_Methods import store
+
+
+def synthetic_sites(n_sites, n_years, seed = 0):
+    #daily mean flows with the same columns NWIS_retrieve writes
+    rng = np.random.default_rng(seed)
+    index = pd.date_range('1980-01-01', periods = int(365.25*n_years), freq = 'D', name = 'Datetime')
+    sites = {}
+    for i in np.arange(0, n_sites, 1):
+        site = str(10000000 + i)
+        df = pd.DataFrame(index = index)
+        df['USGS_flow'] = rng.lognormal(3, 1, len(index)).astype('float32')
+        df['USGS_ID'] = site
+        df['variable'] = 'Streamflow, ft&#179;/s'
+        sites[site] = df
+    return sites
+
+
+def timed(func):
+    t0 = time.perf_counter()
+    func()
+    return time.perf_counter() - t0
+
+
+def main(n_sites, n_years):
+    sites = synthetic_sites(n_sites, n_years)
+    n_rows = sum(len(df) for df in sites.values())
+    mb = sum(df.memory_usage(deep = True).sum() for df in sites.values())/1e6
+    with tempfile.TemporaryDirectory() as tmp:
+        fixed_path = os.path.join(tmp, 'fixed.h5')
+        table_path = os.path.join(tmp, 'table.h5')
+
+        def write_fixed():
+            for site, df in sites.items():
+                df.to_hdf(fixed_path, key = site)
+
+        def write_table():
+            with store.HDF_Writer(table_path) as writer:
+                for site, df in sites.items():
+                    writer.put(site, df)
+
+        def append_table():
+            #nightly refresh, the last 30 days of every site
+            with store.HDF_Writer(table_path) as writer:
+                for site, df in sites.items():
+                    writer.append(site, df.iloc[-30:])
+
+        def read_fixed():
+            for site in sites:
+                pd.read_hdf(fixed_path, key = site)
+
+        def read_table():
+            with store.HDF_Writer(table_path) as writer:
+                for site in sites:
+                    writer.select(site)
+
+        def read_table_window():
+            with store.HDF_Writer(table_path) as writer:
+                for site in sites:
+                    writer.select(site, '2000-01-01', '2000-12-31')
+
+        results = [
+            ('write, to_hdf per site (fixed)', timed(write_fixed), mb),
+            ('write, HDF_Writer (table, blosc:zstd)', timed(write_table), mb),
+            ('append 30 days, HDF_Writer', timed(append_table), mb*30/(365.25*n_years)),
+            ('read, read_hdf per site (fixed)', timed(read_fixed), mb),
+            ('read, HDF_Writer.select', timed(read_table), mb),
+            ('read 1 year window, HDF_Writer.select', timed(read_table_window), mb/n_years),
+        ]
+
+        print('Sites: ', n_sites, ' years: ', n_years, ' rows: ', n_rows, ' in-memory size: ', round(mb, 1), ' MB')
+        for name, seconds, size in results:
+            print(f"{name:40s} {seconds:8.3f} s {size/seconds:10.1f} MB/s")
+        print('File size, fixed: ', round(os.path.getsize(fixed_path)/1e6, 1), ' MB')
+        print('File size, table: ', round(os.path.getsize(table_path)/1e6, 1), ' MB')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'HDF5 data store throughput benchmark')
+    parser.add_argument('--sites', type = int, default = 200)
+    parser.add_argument('--years', type = int, default = 40)
+    args = parser.parse_args()
+    main(args.sites, args.years)
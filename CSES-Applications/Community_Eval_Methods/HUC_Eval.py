@@ -4,71 +4,51 @@
 #Date: 5-9-2024
 
 #local packages
-from Community_Eval_Methods import data
-
+from Community_Eval_Methods import store
+from Community_Eval_Methods import metrics
+from Community_Eval_Methods import skill_kernels
+from Community_Eval_Methods import memo
+from Community_Eval_Methods import aggregation
+from Community_Eval_Methods import alignment
+from Community_Eval_Methods import downsample
+from Community_Eval_Methods import lazy
 #Data Processing Modules
 import pandas as pd
 import numpy as np
-import geopandas as gpd
 from datetime import timedelta
 import time
-import jenkspy
 import json
-from geopy.geocoders import Nominatim
+#heavy dependencies used by single methods are imported on first use
+data = lazy.Lazy_Module('Community_Eval_Methods.data')
+gpd = lazy.Lazy_Module('geopandas')
+geocoders = lazy.Lazy_Module('geopy.geocoders')
 
 # Hydrological modeling utils
 #from hydrotools.nwis_client.iv import IVDataService
-from hydrotools.nwm_client import utils
-import streamstats
-
-#Plotting modules
-import folium
-import matplotlib
-import matplotlib.pyplot as plt
-import mpl_toolkits
-from mpl_toolkits.mplot3d import Axes3D
-import hvplot.pandas
-import holoviews as hv
-from holoviews import dim, opts, streams
-from bokeh.models import HoverTool
-import branca.colormap as cm
-import vincent
-from vincent import AxisProperties, PropertySet, ValueRef, Axis
-import matplotlib.cm
-from folium import features
-import proplot as pplt
-from folium.plugins import StripePattern
-
-#Evaluation modules
-from sklearn.metrics import r2_score
-from sklearn.metrics import mean_squared_error
-from sklearn.metrics import max_error
-from sklearn.metrics import mean_absolute_percentage_error
-import hydroeval as he
+utils = lazy.Lazy_Module('hydrotools.nwm_client.utils')
+streamstats = lazy.Lazy_Module('streamstats')
+
+#Plotting modules, imported on first use
+from Community_Eval_Methods.viz import plt, hv, folium, features, cm, vincent, site_map, report, display
 
 #AWS Data Access Modules
-import boto3
-from botocore import UNSIGNED
-from botocore.client import Config
+boto3 = lazy.Lazy_Module('boto3')
+botocore = lazy.Lazy_Module('botocore')
+botocore_client = lazy.Lazy_Module('botocore.client')
 
 #General Environment modules
-from IPython.display import display
 import warnings
 from progressbar import ProgressBar
 import io
 import os
 
 #Environment settings/configs
-pplt.rc["figure.facecolor"] = "w"
 os.environ['AWS_NO_SIGN_REQUEST'] = 'YES'
-geolocator = Nominatim(user_agent="geoapiExercises")
-pd.options.plotting.backend = 'holoviews'
-warnings.filterwarnings("ignore")
 
 
 
 class HUC_Eval():
-    def __init__(self, model , HUCid, startDT, endDT, cwd):
+    def __init__(self, model , HUCid, startDT, endDT, cwd, cache_dir = None):
         self = self
         #self.df =df
         self.startDT = startDT
@@ -84,20 +64,22 @@ class HUC_Eval():
                         'Q': 'Quarterly',
                         'A': 'Annual'
                         }
+        #metrics scored by Interactive_Model_Eval, any of metrics.METRICS
+        self.metric_set = ['RMSE', 'MaxError', 'MAPE', 'KGE']
+        #memoized evaluation results, also persisted to cache_dir if given
+        self.eval_cache = memo.Result_Cache(path = cache_dir)
+        #daily to annual aggregates, built on first use after the data is loaded
+        self.NWIS_pyramid = None
+        self.Mod_pyramid = None
          #AWS bucket information
         bucket_name = 'streamflow-app-data'
-        s3 = boto3.resource('s3', config=Config(signature_version=UNSIGNED))
+        s3 = boto3.resource('s3', config=botocore_client.Config(signature_version=botocore.UNSIGNED))
         self.bucket = s3.Bucket(bucket_name)
 
 
     def date_range_list(self):
-        # Return list of datetime.date objects between start_date and end_date (inclusive).
-        date_list = []
-        curr_date = pd.to_datetime(self.startDT)
-        while curr_date <= pd.to_datetime(self.endDT):
-            date_list.append(curr_date)
-            curr_date += timedelta(days=1)
-        self.dates = date_list
+        # Shared daily DatetimeIndex between startDT and endDT (inclusive)
+        self.dates = alignment.shared_index(self.startDT, self.endDT)
 
     '''
      Function for getting state id from lat long, needed to get NWIS and NHD streamflow information
@@ -105,7 +87,7 @@ class HUC_Eval():
 
     def Lat_Long_to_state(self, row):
         coord = f"{row['dec_lat_va']}, {row['dec_long_va']}"
-        location = geolocator.reverse(coord, exactly_one=True)
+        location = geocoders.Nominatim(user_agent="geoapiExercises").reverse(coord, exactly_one=True)
         address = location.raw['address']
         state = address.get('state', '')
         row['state'] = state
@@ -208,7 +190,35 @@ class HUC_Eval():
 
 
 
-    def prepare_comparison(self):
+    def read_Mod_csv(self, site, state):
+        #Get the model predictions for one reach from the AWS bucket
+        format = '%Y-%m-%d %H:%M:%S'
+        csv_key = f"{self.model}/NHD_segments_{state}.h5/{self.model[:3]}_{site}.csv"
+        obj = self.bucket.Object(csv_key)
+        body = obj.get()['Body']
+        Mod_flow = pd.read_csv(body)
+        Mod_flow.pop('Unnamed: 0')
+        Mod_flow['time'] ='12:00:00' 
+        Mod_flow['Datetime'] = pd.to_datetime(Mod_flow['Datetime']+ ' ' + Mod_flow['time'], format = format)
+        Mod_flow.set_index('Datetime', inplace = True)
+        return Mod_flow
+
+
+    def read_NWIS_csv(self, site, state):
+        #Get the NWIS observations for one site from the AWS bucket
+        csv_key = f"NWIS/NWIS_sites_{state}.h5/NWIS_{site}.csv"
+        obj = self.bucket.Object(csv_key)
+        body = obj.get()['Body']
+        NWIS_meanflow = pd.read_csv(body)
+        format = '%Y-%m-%d %H:%M:%S'
+        NWIS_meanflow.drop_duplicates(subset = 'Datetime', inplace = True)                
+        NWIS_meanflow['time'] ='12:00:00' 
+        NWIS_meanflow['Datetime'] = pd.to_datetime(NWIS_meanflow['Datetime']+ ' ' + NWIS_meanflow['time'], format = format)
+        NWIS_meanflow.set_index('Datetime', inplace = True)
+        return NWIS_meanflow
+
+
+    def prepare_comparison(self, cache = False):
 
         #prepare the daterange
         self.date_range_list()
@@ -217,8 +227,9 @@ class HUC_Eval():
         self.NWIS_sites = list(self.HUC_NWIS.NWIS_site_id)
 
 
-        self.NWIS_data = pd.DataFrame(columns = self.NWIS_sites)
-        self.Mod_data = pd.DataFrame(columns = self.comparison_reaches)
+        #series are collected per site and joined on the shared index by date
+        NWIS_series = {}
+        Mod_series = {}
 
         self.HUC_NWIS.state_id = self.HUC_NWIS.state_id.str.lower()
         #create a key/dict of site/state id
@@ -235,18 +246,14 @@ class HUC_Eval():
             state = Mod_state_key[site].lower()
             try:
 
-                format = '%Y-%m-%d %H:%M:%S'
-                csv_key = f"{self.model}/NHD_segments_{state}.h5/{self.model[:3]}_{site}.csv"
-                obj = self.bucket.Object(csv_key)
-                body = obj.get()['Body']
-                Mod_flow = pd.read_csv(body)
-                Mod_flow.pop('Unnamed: 0')
-                Mod_flow['time'] ='12:00:00' 
-                Mod_flow['Datetime'] = pd.to_datetime(Mod_flow['Datetime']+ ' ' + Mod_flow['time'], format = format)
-                Mod_flow.set_index('Datetime', inplace = True)
+                if cache == True:
+                    Mod_flow = store.cached_series(self.cwd+'/Data/cache/'+self.model+'.h5', site, self.startDT, self.endDT,
+                                                   lambda: self.read_Mod_csv(site, state))
+                else:
+                    Mod_flow = self.read_Mod_csv(site, state)
                 Mod_flow = Mod_flow.loc[self.startDT:self.endDT]
                 cols = Mod_flow.columns
-                self.Mod_data[site] = Mod_flow[cols[0]]
+                Mod_series[site] = Mod_flow[cols[0]]
 
             except:
                 print('Site: ', site, ' not in database, skipping')
@@ -260,20 +267,13 @@ class HUC_Eval():
         for site in pbar(self.NWIS_sites):
             state = NWIS_state_key[site]
             try:
-                csv_key = f"NWIS/NWIS_sites_{state}.h5/NWIS_{site}.csv"
-                obj = self.bucket.Object(csv_key)
-                body = obj.get()['Body']
-                NWIS_meanflow = pd.read_csv(body)
-                format = '%Y-%m-%d %H:%M:%S'
-                NWIS_meanflow.drop_duplicates(subset = 'Datetime', inplace = True)                
-                NWIS_meanflow['time'] ='12:00:00' 
-                NWIS_meanflow['Datetime'] = pd.to_datetime(NWIS_meanflow['Datetime']+ ' ' + NWIS_meanflow['time'], format = format)
-                NWIS_meanflow.set_index('Datetime', inplace = True)
+                if cache == True:
+                    NWIS_meanflow = store.cached_series(self.cwd+'/Data/cache/NWIS.h5', site, self.startDT, self.endDT,
+                                                        lambda: self.read_NWIS_csv(site, state))
+                else:
+                    NWIS_meanflow = self.read_NWIS_csv(site, state)
                 NWIS_meanflow = NWIS_meanflow.loc[self.startDT:self.endDT]
-                #change np.nan to -100, can separate values out later
-                #NWIS_meanflow.fillna(-100, inplace = True)
-                self.NWIS_data[site] = -100
-                self.NWIS_data[site] = NWIS_meanflow['USGS_flow']
+                NWIS_series[site] = NWIS_meanflow['USGS_flow']
                
 
             except:
@@ -282,145 +282,117 @@ class HUC_Eval():
                     self.NWIS_sites.remove(site)
   
         #reset NWIS sites  
-        self.NWIS_data.fillna(-100, inplace = True)
+        #join every series onto the shared index, days without data stay NaN
+        self.NWIS_data, self.NWIS_data_coverage = alignment.align(NWIS_series, self.dates)
+        self.Mod_data, self.Mod_data_coverage = alignment.align(Mod_series, self.dates)
+        #flows are stored as float32
+        self.NWIS_data = self.NWIS_data.astype('float32')
+        self.Mod_data = self.Mod_data.astype('float32')
         self.HUC_NWIS.reset_index(drop = True, inplace = True)
         self.NWIS_sites = self.HUC_NWIS['NWIS_site_id']
 
-        #need to get the date range of NWIS and adjust modeled flow
-        NWIS_dates = self.NWIS_data.index
-        self.Mod_data = self.Mod_data.loc[NWIS_dates[0]:NWIS_dates[-1]]
 
-        self.NWIS_column = self.NWIS_data.copy()
-        self.NWIS_column = pd.DataFrame(self.NWIS_column.stack(), columns = ['NWIS_flow_cfs'])
-        self.NWIS_column = self.NWIS_column.reset_index().drop('level_1',1)
 
-        self.Mod_column = self.Mod_data.copy()
-        col = self.model+'_flow_cfs'
-        self.Mod_column = pd.DataFrame(self.Mod_column.stack(), columns = [col])
-        self.Mod_column = self.Mod_column.reset_index().drop('level_1',1)
+        #one typed (site, reach, Datetime, obs, model) row per time step of every site pair
+        self.Evaluation = metrics.long_table(self.NWIS_data, self.Mod_data, self.HUC_NWIS['NWIS_site_id'], self.HUC_NWIS['NHD_reachid'],
+                                             self.model+'_flow_cfs')
+
+    def resample_pairs(self, freq, supply, NWIS_sites, reaches, water_year = False):
+        #Resampled (and supply accumulated) NWIS and model series for each site pair
+        #Pairs are memoized on (site, reach, startDT, endDT, freq, supply, data version)
+        #water_year accumulates supply from October and bins annual volumes by water year
+        NWIS_series, Mod_series = {}, {}
+        missing = []
+        for site, reach in zip(NWIS_sites, reaches):
+            version = [memo.data_version(data[col]) if col in data.columns else None
+                       for data, col in [(self.NWIS_data, site), (self.Mod_data, reach)]]
+            key = memo.make_key(site, reach, self.startDT, self.endDT, freq, supply, water_year, version)
+            pair = self.eval_cache.get(key)
+            if pair is None:
+                missing.append((site, reach, key))
+            else:
+                NWIS_series[site], Mod_series[reach] = pair
+
+        if len(missing) > 0:
+            NWIS_columns = list(dict.fromkeys([p[0] for p in missing]))
+            Mod_columns = list(dict.fromkeys([p[1] for p in missing]))
+
+            #Daily
+            if freq == 'D':
+                NWIS_data_resampled = self.NWIS_data.reindex(columns = NWIS_columns)
+                Mod_data_resampled = self.Mod_data.reindex(columns = Mod_columns)
 
-    def Interactive_Model_Eval(self, freq, supply):
+            #Monthly, Quarterly, Annual volumes are looked up in the aggregation pyramids
+            else:
+                if self.NWIS_pyramid is None or not self.NWIS_pyramid.matches(self.NWIS_data):
+                    self.NWIS_pyramid = aggregation.Aggregation_Pyramid(self.NWIS_data, self.cfsday_AFday)
+                if self.Mod_pyramid is None or not self.Mod_pyramid.matches(self.Mod_data):
+                    self.Mod_pyramid = aggregation.Aggregation_Pyramid(self.Mod_data, self.cfsday_AFday)
+                rule = 'A-SEP' if (water_year == True and freq == 'A') else freq
+                #only complete periods are compared, a gap in either series drops the period
+                NWIS_data_resampled = self.NWIS_pyramid.level(rule, 'sum', NWIS_columns, complete = True)
+                Mod_data_resampled = self.Mod_pyramid.level(rule, 'sum', Mod_columns, complete = True)
+
+            #one column per pair, a site or reach may be in several pairs
+            NWIS_pairs = NWIS_data_resampled[[p[0] for p in missing]]
+            Mod_pairs = Mod_data_resampled[[p[1] for p in missing]]
+            if supply == True:
+                #year-to-date volumes for all pairs in one grouped cumulative sum, only over the
+                #periods both series of a pair hold so a gap in one does not leak into the other
+                Mod_pairs = Mod_pairs.reindex(NWIS_pairs.index)
+                both = NWIS_pairs.notna().values & Mod_pairs.notna().values
+                NWIS_pairs = aggregation.supply_cumsum(NWIS_pairs.where(both), water_year)
+                Mod_pairs = aggregation.supply_cumsum(Mod_pairs.where(both), water_year)
+
+            for j, (site, reach, key) in enumerate(missing):
+                pair = (NWIS_pairs.iloc[:, j], Mod_pairs.iloc[:, j])
+                self.eval_cache.put(key, pair)
+                NWIS_series[site], Mod_series[reach] = pair
+
+        self.NWIS_data_resampled = pd.DataFrame(NWIS_series)
+        self.Mod_data_resampled = pd.DataFrame(Mod_series)
+
+
+    def Score_Sites(self, freq, supply, metric_set = None, n_boot = 0, water_year = False):
+        #score every site at one frequency into self.Eval, sorted by KGE, without displaying or plotting
+        #used by Interactive_Model_Eval and by batch runs
         self.freq = freq
+        #metrics to score, defaults to the class metric set
+        if metric_set is not None:
+            self.metric_set = list(metric_set)
+        #sites are ranked by KGE so it is always scored
+        if 'KGE' not in self.metric_set:
+            self.metric_set = self.metric_set + ['KGE']
 
         if self.freq == 'D':
             self.units = 'cfs'
         else:
             self.units = 'Acre-Feet'
 
-        #Adjust for different time intervals here
-        #Daily
-        if self.freq == 'D':
-            self.NWIS_data_resampled = self.NWIS_data.copy()
-            self.Mod_data_resampled = self.Mod_data.copy()
-
-        #Monthly, Quarterly, Annual
-        if self.freq !='D':
-            #NWIS
-            self.NWIS_data_resampled = self.NWIS_data.copy()*self.cfsday_AFday
-            self.NWIS_data_resampled = self.NWIS_data_resampled.resample(self.freq).sum()
-            #Modeled
-            self.Mod_data_resampled = self.Mod_data.copy()*self.cfsday_AFday
-            self.Mod_data_resampled = self.Mod_data_resampled.resample(self.freq).sum()
-            
-        if supply == True:
-            #NWIS
-            #Get Columns names
-            columns = self.NWIS_data_resampled.columns
-
-            #set up cumulative monthly values
-            self.NWIS_data_resampled['Year'] = self.NWIS_data_resampled.index.year
-
-            self.NWIS_CumSum = pd.DataFrame(columns=columns)
-
-            for site in columns:
-                self.NWIS_CumSum[site] = self.NWIS_data_resampled.groupby(['Year'])[site].cumsum()
-
-            #Model
-            #Get Columns names
-            columns = self.Mod_data_resampled.columns
-
-            #set up cumulative monthly values
-            self.Mod_data_resampled['Year'] = self.Mod_data_resampled.index.year
-
-            self.Mod_CumSum = pd.DataFrame(columns=columns)
-
-            for site in columns:
-                self.Mod_CumSum[site] = self.Mod_data_resampled.groupby(['Year'])[site].cumsum()
-                
-            #set the Mod and NWIS resampled data == to the CumSum Df's
-            self.NWIS_data_resampled = self.NWIS_CumSum
-            self.Mod_data_resampled =self.Mod_CumSum
-            
-            
-            
-        RMSE = []
-        MAXERROR = []
-        MAPE = []
-        KGE = []
-
-        for row in np.arange(0,len(self.HUC_NWIS),1):
-            #Get NWIS id
-            NWISid = self.HUC_NWIS['NWIS_site_id'][row]
-            #Get Model reach id
-            reachid = 'NHD_reachid'
-            modid = self.HUC_NWIS[reachid][row]
-   
-            #get observed and prediction data
-            obs = self.NWIS_data_resampled[NWISid]
-            mod = self.Mod_data_resampled[modid]
-            
-            
-            
-            #remove na values or 0
-            df = pd.DataFrame()
-            df['obs'] = obs
-            df['mod'] = mod.astype('float64')
-            df = df[df > 0]            
-            df.dropna(axis=0, inplace =True)
-
-            if len(df)>=1:
-                df[df<0.01] = 0.01
-                df['error'] = df['obs'] - df['mod']
-                df['P_error'] = abs(df['error']/df['obs'])*100
-                #drop inf values
-                df.replace([np.inf, -np.inf], np.nan, inplace = True)
-                df.dropna(inplace = True)
+        #resample the site pairs, reusing memoized results from earlier calls
+        self.resample_pairs(self.freq, supply, self.HUC_NWIS['NWIS_site_id'], self.HUC_NWIS['NHD_reachid'], water_year)
 
-                obs = df['obs']
-                mod = df['mod']
 
-                #calculate scoring
-                rmse = round(mean_squared_error(obs, mod, squared=False))
-                maxerror = round(max_error(obs, mod))
-                mape = df.P_error.mean()
-                kge, r, alpha, beta = he.evaluator(he.kge, mod.astype('float32'), obs.astype('float32'))
 
-                RMSE.append(rmse)
-                MAXERROR.append(maxerror)
-                MAPE.append(mape)
-                KGE.append(kge[0])
-                
-            else:
-                #calculate scoring
-                rmse = 0
-                maxerror = 0
-                mape = 0
-                kge = -10000
-                
-                RMSE.append(rmse)
-                MAXERROR.append(maxerror)
-                MAPE.append(mape)
-                KGE.append(kge)
+        #score all sites at once on the aligned obs and model matrices
+        reachid = 'NHD_reachid'
+        obs, mod = metrics.site_matrices(self.NWIS_data_resampled, self.Mod_data_resampled,
+                                         self.HUC_NWIS['NWIS_site_id'], self.HUC_NWIS[reachid])
+        mask = metrics.validity_mask(obs, mod, strict = True)
+        scores = metrics.evaluate(obs, mod, mask, metric_set = self.metric_set)
 
         #Connect model evaluation to a DF, add in relevant information concerning LULC
         Eval = pd.DataFrame()
         Eval['NWIS_site_id'] = self.HUC_NWIS['NWIS_site_id']
         Eval[reachid] = self.HUC_NWIS[reachid]
         Eval['Location'] = self.HUC_NWIS['NWIS_sitename']
-        Eval['RMSE'] = RMSE
-        Eval['MaxError'] = MAXERROR
-        Eval['MAPE'] = MAPE
-        Eval['KGE'] = KGE
+        for metric in self.metric_set:
+            Eval[metric] = scores[metric].values
+        #block-bootstrap interval of the KGE used to rank the sites
+        if n_boot > 0:
+            KGE_ci = metrics.kge_bootstrap(obs, mod, mask, n_boot = n_boot)
+            Eval['KGE_lower'] = KGE_ci['KGE_lower'].values
+            Eval['KGE_upper'] = KGE_ci['KGE_upper'].values
         Eval['Drainage_area_mi2'] = self.HUC_NWIS['Drainage_area_mi2']
         Eval['Mean_Basin_Elev_ft'] = self.HUC_NWIS['Mean_Basin_Elev_ft']
         Eval['Perc_Forest'] = self.HUC_NWIS['Perc_Forest']
@@ -435,7 +407,12 @@ class HUC_Eval():
         Eval = Eval[Eval['KGE']> -1000]
 
         #sort dataframe and reindex
-        self.Eval = Eval.sort_values('KGE', ascending = False).reset_index(drop = True)    
+        self.Eval = Eval.sort_values('KGE', ascending = False).reset_index(drop = True)
+        return self.Eval
+
+
+    def Interactive_Model_Eval(self, freq, supply, metric_set = None, n_boot = 0, water_year = False, max_points = downsample.MAX_POINTS, browse = False):
+        self.Score_Sites(freq, supply, metric_set, n_boot, water_year)
         #display evaluation DF
         display(self.Eval)
         
@@ -517,112 +494,161 @@ class HUC_Eval():
         
         num_figs = len(self.Eval)
         self.HUC_NWIS.reset_index(inplace = True, drop = True)
+        if browse:
+            #plots are only built for the selected site
+            return self.Site_Browser(max_points)
         for i in np.arange(0,num_figs,1):
+            plot = self.Site_Plot(i, max_points)
+            if plot is not None:
+                display(plot[0] + plot[1])
 
-            reach = self.Eval[reachid][i]
-            site = self.Eval['NWIS_site_id'][i]
-            #print(site, reach)
-            sitename = self.Eval.Location[i]
-            #sitestat = str(df[self.category][i])
-
-            plot_title = self.Eval['name'][i] +' Basin: HUC' + self.Eval[self.HUC_length][i] + ' ' + self.freqkeys[self.freq]+ ' (' + self.units +') \n Performance of ' + self.model +' predictions, reach: ' + str(reach) + '\n USGS:' + str(site) +' ' + str(sitename)
 
-            NWIS_site_lab = 'USGS: ' + str(site)
-            Mod_reach_lab = self.model + ': NHD ' + str(reach)
-
-            Eval_cols = [NWIS_site_lab, Mod_reach_lab]
-
-            #Adjust for different time intervals here
-            #Daily
+    def Site_Plot(self, i, max_points = downsample.MAX_POINTS):
+        #hydrograph and obs vs model scatter of the i-th site of self.Eval, None without data
+        reachid = 'NHD_reachid'
+        reach = self.Eval[reachid][i]
+        site = self.Eval['NWIS_site_id'][i]
+        #print(site, reach)
+        sitename = self.Eval.Location[i]
+        #sitestat = str(df[self.category][i])
 
-            Eval_df = pd.DataFrame(index = self.NWIS_data_resampled.index, columns = Eval_cols)
-            Eval_df[Mod_reach_lab] = self.Mod_data_resampled[reach]
-            Eval_df[NWIS_site_lab] = self.NWIS_data_resampled[site]
+        plot_title = self.Eval['name'][i] +' Basin: HUC' + self.Eval[self.HUC_length][i] + ' ' + self.freqkeys[self.freq]+ ' (' + self.units +') \n Performance of ' + self.model +' predictions, reach: ' + str(reach) + '\n USGS:' + str(site) +' ' + str(sitename)
 
-            Eval_df = Eval_df.dropna()
+        NWIS_site_lab = 'USGS: ' + str(site)
+        Mod_reach_lab = self.model + ': NHD ' + str(reach)
 
-            if Eval_df.shape[0] > 0:
+        Eval_cols = [NWIS_site_lab, Mod_reach_lab]
 
-                #need to have datetime fixed
-                Eval_df = Eval_df.reset_index()
-                Eval_df['Datetime'] = pd.to_datetime(Eval_df['Datetime'])
-                Eval_df.set_index('Datetime', inplace = True, drop = True)
-                
-                #get observed and prediction data
-                obs = Eval_df[NWIS_site_lab]
-                mod = Eval_df[Mod_reach_lab]
-
-                #remove na values or 0
-                df = pd.DataFrame()
-                df['obs'] = obs
-                df['mod'] = mod.astype('float64')
-                df = df[df>0]
-                df.dropna(axis = 0, inplace =True)
-                
-                if len(df)>= 1:
-                    df['error'] = df['obs'] - df['mod']
-                    df['P_error'] = abs(df['error']/df['obs'])*100
-                    #drop inf values
-                    df.replace([np.inf, -np.inf], np.nan, inplace = True)
-                    df.dropna(inplace = True)
+        #Adjust for different time intervals here
+        #Daily
 
-                    obs = df['obs']
-                    mod = df['mod']
+        Eval_df = pd.DataFrame(index = self.NWIS_data_resampled.index, columns = Eval_cols)
+        Eval_df[Mod_reach_lab] = self.Mod_data_resampled[reach]
+        Eval_df[NWIS_site_lab] = self.NWIS_data_resampled[site]
 
-                    #calculate scoring
-                    rmse = round(mean_squared_error(obs, mod, squared=False))
-                    maxerror = round(max_error(obs, mod))
-                    MAPE = round(mean_absolute_percentage_error(obs, mod)*100)
-                    kge, r, alpha, beta = he.evaluator(he.kge, mod.astype('float32'), obs.astype('float32'))
+        Eval_df = Eval_df.dropna()
 
-                    #set limit to MAPE error
-                    if MAPE > 1000:
-                        MAPE ='> 1000'
+        if Eval_df.shape[0] > 0:
 
-                    rmse_phrase = 'RMSE: ' + str(rmse) + ' ' +  self.units
-                    error_phrase = 'Max Error: ' + str(maxerror) + ' ' + self.units
-                    mape_phrase = 'MAPE: ' + str(MAPE) + '%'
-                    kge_phrase = 'kge: ' + str(round(kge[0],2))
+            #need to have datetime fixed
+            Eval_df = Eval_df.reset_index()
+            Eval_df['Datetime'] = pd.to_datetime(Eval_df['Datetime'])
+            Eval_df.set_index('Datetime', inplace = True, drop = True)
+            
+            #get observed and prediction data
+            obs = Eval_df[NWIS_site_lab]
+            mod = Eval_df[Mod_reach_lab]
 
+            #remove na values or 0
+            df = pd.DataFrame()
+            df['obs'] = obs
+            df['mod'] = mod.astype('float64')
+            df = df[df>0]
+            df.dropna(axis = 0, inplace =True)
+            
+            if len(df)>= 1:
+                df['error'] = df['obs'] - df['mod']
+                df['P_error'] = abs(df['error']/df['obs'])*100
+                #drop inf values
+                df.replace([np.inf, -np.inf], np.nan, inplace = True)
+                df.dropna(inplace = True)
 
-                    max_flow = max(max(Eval_df[NWIS_site_lab]), max(Eval_df[Mod_reach_lab]))
-                    min_flow = min(min(Eval_df[NWIS_site_lab]), min(Eval_df[Mod_reach_lab]))
+                obs = df['obs']
+                mod = df['mod']
 
-                    flow_range = np.arange(min_flow, max_flow, (max_flow-min_flow)/100)
+                #scores come from the vectorized evaluation in Score_Sites, not recomputed per site
+                #RMSE, MaxError and MAPE show as nan when not in the scored metric set
+                scores = self.Eval.loc[i]
+                rmse = scores.get('RMSE', np.nan)
+                maxerror = scores.get('MaxError', np.nan)
+                MAPE = np.round(scores.get('MAPE', np.nan))
+                kge = scores['KGE']
 
-                    if self.freq == 'A':
-                        bbox_L = -int(round((len(Eval_df)*.32),0))
-                        text_bbox_L = -int(round((len(Eval_df)*.18),0))
+                #set limit to MAPE error
+                if MAPE > 1000:
+                    MAPE ='> 1000'
 
-                    else:
-                        bbox_L = -int(round((len(Eval_df)*.32),0))
-                        text_bbox_L = -int(round((len(Eval_df)*.16),0))
+                rmse_phrase = 'RMSE: ' + str(rmse) + ' ' +  self.units
+                error_phrase = 'Max Error: ' + str(maxerror) + ' ' + self.units
+                mape_phrase = 'MAPE: ' + str(MAPE) + '%'
+                #Interactive_Model_Eval caps very negative KGE at -1
+                kge_phrase = 'kge: ' + (str(round(kge,2)) if kge > -1 else '<= -1')
 
-                    Discharge_lab = 'Discharge (' +self.units +')'
-                    Obs_Discharge_lab = ' Observed Discharge (' +self.units +')'
-                    Mod_Discharge_lab = self.model +' Discharge (' +self.units +')'
 
+                max_flow = np.nanmax([Eval_df[NWIS_site_lab].max(), Eval_df[Mod_reach_lab].max()])
+                min_flow = np.nanmin([Eval_df[NWIS_site_lab].min(), Eval_df[Mod_reach_lab].min()])
 
-                    NWIS_hydrograph = hv.Curve((Eval_df.index, Eval_df[NWIS_site_lab]), 'DateTime', Discharge_lab, label = NWIS_site_lab).opts(title = plot_title, tools = ['hover'], color = 'orange')
-                    Mod_hydrograph = hv.Curve((Eval_df.index, Eval_df[Mod_reach_lab]), 'DateTime', Discharge_lab, label = Mod_reach_lab).opts(tools = ['hover'], color = 'blue')
-                    RMSE_hv = hv.Text(Eval_df.index[text_bbox_L],max_flow*.93, rmse_phrase, fontsize = 8)
-                    Error_hv = hv.Text(Eval_df.index[text_bbox_L],max_flow*.83, error_phrase, fontsize = 8)
-                    MAPE_hv = hv.Text(Eval_df.index[text_bbox_L],max_flow*.73, mape_phrase, fontsize = 8)
-                    KGE_hv = hv.Text(Eval_df.index[text_bbox_L],max_flow*.63, kge_phrase, fontsize = 8)
-                    textbox_hv = hv.Rectangles([(Eval_df.index[bbox_L], max_flow*.56, Eval_df.index[-1], max_flow*.99)]).opts(color = 'white')
+                flow_range = np.arange(min_flow, max_flow, (max_flow-min_flow)/100)
 
-                    Mod_NWIS_Scatter = hv.Scatter((Eval_df[NWIS_site_lab], Eval_df[Mod_reach_lab]), Obs_Discharge_lab, Mod_Discharge_lab).opts(tools = ['hover'], color = 'blue', xrotation=45)
-                    Mod_NWIS_one2one = hv.Curve((flow_range, flow_range)).opts(color = 'red', line_dash='dashed')
-                    
-                    display((NWIS_hydrograph * Mod_hydrograph*textbox_hv*RMSE_hv*Error_hv*MAPE_hv*KGE_hv).opts(width=600, legend_position='top_left', tools=['hover']) + (Mod_NWIS_Scatter*Mod_NWIS_one2one).opts(shared_axes = False))
+                if self.freq == 'A':
+                    bbox_L = -int(round((len(Eval_df)*.32),0))
+                    text_bbox_L = -int(round((len(Eval_df)*.18),0))
 
                 else:
-                    print('No data for NWIS site: ', str(NWIS_site_lab), ' skipping.')
-
-
-
+                    bbox_L = -int(round((len(Eval_df)*.32),0))
+                    text_bbox_L = -int(round((len(Eval_df)*.16),0))
+
+                Discharge_lab = 'Discharge (' +self.units +')'
+                Obs_Discharge_lab = ' Observed Discharge (' +self.units +')'
+                Mod_Discharge_lab = self.model +' Discharge (' +self.units +')'
+
+
+                #plot a shape-preserving subset of long records, the scores above use every point
+                plot_df = downsample.downsample_frame(Eval_df[[NWIS_site_lab, Mod_reach_lab]], max_points)
+                NWIS_hydrograph = hv.Curve((plot_df.index, plot_df[NWIS_site_lab]), 'DateTime', Discharge_lab, label = NWIS_site_lab).opts(title = plot_title, tools = ['hover'], color = 'orange')
+                Mod_hydrograph = hv.Curve((plot_df.index, plot_df[Mod_reach_lab]), 'DateTime', Discharge_lab, label = Mod_reach_lab).opts(tools = ['hover'], color = 'blue')
+                RMSE_hv = hv.Text(Eval_df.index[text_bbox_L],max_flow*.93, rmse_phrase, fontsize = 8)
+                Error_hv = hv.Text(Eval_df.index[text_bbox_L],max_flow*.83, error_phrase, fontsize = 8)
+                MAPE_hv = hv.Text(Eval_df.index[text_bbox_L],max_flow*.73, mape_phrase, fontsize = 8)
+                KGE_hv = hv.Text(Eval_df.index[text_bbox_L],max_flow*.63, kge_phrase, fontsize = 8)
+                textbox_hv = hv.Rectangles([(Eval_df.index[bbox_L], max_flow*.56, Eval_df.index[-1], max_flow*.99)]).opts(color = 'white')
+
+                Mod_NWIS_Scatter = hv.Scatter((Eval_df[NWIS_site_lab], Eval_df[Mod_reach_lab]), Obs_Discharge_lab, Mod_Discharge_lab).opts(tools = ['hover'], color = 'blue', xrotation=45)
+                Mod_NWIS_one2one = hv.Curve((flow_range, flow_range)).opts(color = 'red', line_dash='dashed')
+                
+                return (NWIS_hydrograph * Mod_hydrograph*textbox_hv*RMSE_hv*Error_hv*MAPE_hv*KGE_hv).opts(width=600, legend_position='top_left', tools=['hover']), (Mod_NWIS_Scatter*Mod_NWIS_one2one).opts(shared_axes = False)
 
-    def Map_Plot_Eval(self, freq, supply):
+            else:
+                print('No data for NWIS site: ', str(NWIS_site_lab), ' skipping.')
+
+
+    def Site_Browser(self, max_points = downsample.MAX_POINTS, cache_size = 32):
+        #site selector showing one site at a time, a site's plot is built when it is first
+        #selected and the most recently viewed plots are kept
+        plots = memo.Result_Cache(maxsize = cache_size)
+
+        def site_plot(NWIS_site_id):
+            plot = plots.get(NWIS_site_id)
+            if plot is None:
+                i = int(np.flatnonzero(self.Eval['NWIS_site_id'] == NWIS_site_id)[0])
+                plot = self.Site_Plot(i, max_points)
+                if plot is None:
+                    empty = hv.Curve([]) * hv.Text(0, 0, 'No data for NWIS site: ' + str(NWIS_site_id))
+                    plot = (empty, empty)
+                plots.put(NWIS_site_id, plot)
+            return plot
+
+        #one DynamicMap per panel, holoviews shares the site selector between them
+        sites = list(self.Eval['NWIS_site_id'])
+        hydrographs = hv.DynamicMap(lambda NWIS_site_id: site_plot(NWIS_site_id)[0], kdims = ['NWIS_site_id'])
+        scatters = hv.DynamicMap(lambda NWIS_site_id: site_plot(NWIS_site_id)[1], kdims = ['NWIS_site_id'])
+        self.Browser = (hydrographs + scatters).redim.values(NWIS_site_id = sites)
+        display(self.Browser)
+        return self.Browser
+
+
+    def Report(self, out_dir = None, max_workers = None, max_points = downsample.MAX_POINTS, dpi = 100):
+        #render the figures of every site in self.Eval to disk with an index page, nothing is displayed
+        #run Interactive_Model_Eval or Score_Sites first so the evaluation and resampled pairs exist
+        if out_dir is None:
+            out_dir = os.path.join(self.cwd, 'Reports', self.model + '_' + self.freq)
+        title = self.model + ' ' + self.freqkeys[self.freq] + ' (' + self.units + ') evaluation'
+        return report.render_report(out_dir, self.Eval, self.NWIS_data_resampled, self.Mod_data_resampled,
+                                    self.model, self.units, title = title, max_workers = max_workers,
+                                    max_points = max_points, dpi = dpi)
+
+
+    def Map_Plot_Eval(self, freq, supply, n_boot = 0, water_year = False, lazy = False, map_dir = None, fast = False, max_points = downsample.MAX_POINTS):
         self.freq = freq
 
         if self.freq == 'D':
@@ -631,51 +657,11 @@ class HUC_Eval():
             self.units = 'Acre-Feet'
 
         yaxis = 'Streamflow (' + self.units +')'
+        if lazy and map_dir is None:
+            map_dir = os.path.join(self.cwd, 'Maps', self.model + '_' + self.freq)
 
-        #Adjust for different time intervals here
-        #Daily
-        if self.freq == 'D':
-            self.NWIS_data_resampled = self.NWIS_data.copy()
-            self.Mod_data_resampled = self.Mod_data.copy()
-
-
-        #Monthly, Quarterly, Annual
-        if self.freq !='D':
-            #NWIS
-            self.NWIS_data_resampled = self.NWIS_data.copy()*self.cfsday_AFday
-            self.NWIS_data_resampled = self.NWIS_data_resampled.resample(self.freq).sum()
-            #Modeled
-            self.Mod_data_resampled = self.Mod_data.copy()*self.cfsday_AFday
-            self.Mod_data_resampled = self.Mod_data_resampled.resample(self.freq).sum()
-            
-        if supply == True:
-            #NWIS
-            #Get Columns names
-            columns = self.NWIS_data_resampled.columns
-
-            #set up cumulative monthly values
-            self.NWIS_data_resampled['Year'] = self.NWIS_data_resampled.index.year
-
-            self.NWIS_CumSum = pd.DataFrame(columns=columns)
-
-            for site in columns:
-                self.NWIS_CumSum[site] = self.NWIS_data_resampled.groupby(['Year'])[site].cumsum()
-
-            #Model
-            #Get Columns names
-            columns = self.Mod_data_resampled.columns
-
-            #set up cumulative monthly values
-            self.Mod_data_resampled['Year'] = self.Mod_data_resampled.index.year
-
-            self.Mod_CumSum = pd.DataFrame(columns=columns)
-
-            for site in columns:
-                self.Mod_CumSum[site] = self.Mod_data_resampled.groupby(['Year'])[site].cumsum()
-                
-            #set the Mod and NWIS resampled data == to the CumSum Df's
-            self.NWIS_data_resampled = self.NWIS_CumSum
-            self.Mod_data_resampled =self.Mod_CumSum
+        #resample the site pairs, reusing memoized results from earlier calls
+        self.resample_pairs(self.freq, supply, self.HUC_NWIS['NWIS_site_id'], self.HUC_NWIS['NHD_reachid'], water_year)
 
         print('Plotting monitoring station locations')
         cols =  ['NWIS_site_id', 'NWIS_sitename', 'NHD_reachid', 'dec_lat_va', 'dec_long_va', 'geometry']
@@ -698,13 +684,31 @@ class HUC_Eval():
         colormap.caption = 'Model Performance (KGE)'
         m.add_child(colormap)
 
-        ax = AxisProperties(
-        labels=PropertySet(
-            angle=ValueRef(value=300),
-            align=ValueRef(value='right')
+        ax = vincent.AxisProperties(
+        labels=vincent.PropertySet(
+            angle=vincent.ValueRef(value=300),
+            align=vincent.ValueRef(value='right')
                 )
             )
 
+        #score every mapped site in one NaN-skipping kernel pass
+        obs, mod = metrics.site_matrices(self.NWIS_data_resampled, self.Mod_data_resampled,
+                                         self.df_map['NWIS_site_id'], self.df_map['NHD_reachid'])
+        mask = metrics.validity_mask(obs, mod, strict = True)
+        #floored as in Score_Sites, so the map and the metrics table show the same KGE
+        self.Map_scores = skill_kernels.skill_scores(obs, mod, mask, floor = 0.01)
+        if n_boot > 0:
+            self.Map_scores = self.Map_scores.join(metrics.kge_bootstrap(obs, mod, mask, n_boot = n_boot))
+
+        if fast:
+            #every scored site goes in one clustered layer, colored by KGE class without a per-site loop
+            if lazy:
+                site_map.write_series(os.path.join(map_dir, 'series'), self.df_map, self.NWIS_data_resampled,
+                                      self.Mod_data_resampled, self.model, self.units, self.Map_scores,
+                                      max_points = max_points)
+            m.add_child(site_map.score_layer(self.df_map, self.Map_scores, colormap, lazy = lazy))
+            return site_map.show_map(m, lazy, map_dir)
+
         for i in np.arange(0, len(self.df_map),1):
             #get site information
             site = self.df_map['NWIS_site_id'][i]
@@ -720,47 +724,44 @@ class HUC_Eval():
             df = df.rename(columns = {site: USGSsite})
             df[Modreach] = pd.DataFrame(self.Mod_data_resampled[reach])
             
-            #remove na values or 0
-            df_narem = pd.DataFrame()
-            df_narem['obs'] = self.NWIS_data_resampled[site].astype('float64')
-            df_narem['mod'] = self.Mod_data_resampled[reach].astype('float64')
-            df_narem = df_narem[df_narem > 0]
-            df_narem.dropna(inplace = True)
-            
-            if len(df_narem) >=1:
-            
-                #df_narem['error'] = df_narem['obs'] - df_narem['mod']
-                #df_narem['P_error'] = abs(df_narem['error']/df_narem['obs'])*100
-                #drop inf values
-                df_narem.replace([np.inf, -np.inf], np.nan, inplace = True)
-                df_narem.dropna(inplace = True)
-
-                obs = df_narem['obs']
-                mod = df_narem['mod']
+            if self.Map_scores['n'][i] >= 1:
 
-                #calculate scoring
-                kge, r, alpha, beta = he.evaluator(he.kge, mod.astype('float32'), obs.astype('float32'))
+                kge = self.Map_scores['KGE'][i]
+                tooltip = None
+                if n_boot > 0:
+                    tooltip = 'KGE: ' + str(round(kge, 2)) + ' (' + str(round(self.Map_scores['KGE_lower'][i], 2)) + ' to ' + str(round(self.Map_scores['KGE_upper'][i], 2)) + ')'
 
                  #set the color of marker by model performance
                 #Marker color options ['red', 'blue', 'green', 'purple', 'orange', 'darkred', 'lightred', 'beige', 'darkblue', 'darkgreen', 'cadetblue', 'darkpurple', 'white', 'pink', 'lightblue', 'lightgreen', 'gray', 'black', 'lightgray']
 
-                if kge[0] > 0.30:
+                if kge > 0.30:
                     color = 'green'
 
-                elif kge[0] > 0.0:
+                elif kge > 0.0:
                     color = 'lightgreen'
 
-                elif kge[0] > -0.40:
+                elif kge > -0.40:
                     color = 'orange'
 
                 else:
                     color = 'red'
 
 
+                if lazy:
+                    #only the site id and KGE go in the page, the series is loaded when the popup opens
+                    site_map.write_site_series(os.path.join(map_dir, 'series'), site,
+                                               site_map.series_payload(downsample.downsample_frame(df, max_points), site_name, self.units))
+                    tooltip = USGSsite + ', ' + (tooltip if tooltip is not None else 'KGE: ' + str(round(kge, 2)))
+                    mk = features.Marker([self.df_map['dec_lat_va'][i], self.df_map['dec_long_va'][i]],
+                                         icon=folium.Icon(color=color, icon = 'fa-navicon', prefix = 'fa'), tooltip = tooltip)
+                    mk.add_child(site_map.lazy_popup(site))
+                    m.add_child(mk)
+                    continue
+
                 title_size = 14
 
                 #create graph and convert to json
-                graph = vincent.Line(df, height=300, width=500)
+                graph = vincent.Line(downsample.downsample_frame(df, max_points), height=300, width=500)
                 graph.axis_titles(x='Datetime', y=yaxis)
                 graph.legend(title= site_name)
                 graph.colors(brew='Set1')
@@ -775,7 +776,7 @@ class HUC_Eval():
                 #Add marker with point to map, https://fontawesome.com/v4/cheatsheet/
                 lat = self.df_map['dec_lat_va'][i]
                 long = self.df_map['dec_long_va'][i]
-                mk = features.Marker([lat, long], icon=folium.Icon(color=color, icon = 'fa-navicon', prefix = 'fa'))
+                mk = features.Marker([lat, long], icon=folium.Icon(color=color, icon = 'fa-navicon', prefix = 'fa'), tooltip = tooltip)
                 p = folium.Popup("Hello")
                 v = features.Vega(data, width="100%", height="100%")
 
@@ -784,5 +785,5 @@ class HUC_Eval():
                 m.add_child(mk)
 
 
-        display(m)
+        return site_map.show_map(m, lazy, map_dir)
           
@@ -4,65 +4,47 @@
 #Date: 5-9-2024
 
 #local packages
-from Community_Eval_Methods import data
+from Community_Eval_Methods import store
+from Community_Eval_Methods import metrics
+from Community_Eval_Methods import skill_kernels
+from Community_Eval_Methods import memo
+from Community_Eval_Methods import aggregation
+from Community_Eval_Methods import alignment
+from Community_Eval_Methods import classify
+from Community_Eval_Methods import downsample
+from Community_Eval_Methods import nwis_iv
+from Community_Eval_Methods import lazy
 #Data Processing Modules
 import pandas as pd
 import numpy as np
-import geopandas as gpd
 from datetime import timedelta
 import time
-import jenkspy
 import json
-from geopy.geocoders import Nominatim
+#heavy dependencies used by single methods are imported on first use
+data = lazy.Lazy_Module('Community_Eval_Methods.data')
+gpd = lazy.Lazy_Module('geopandas')
 
 # Hydrological modeling utils
 #from hydrotools.nwis_client.iv import IVDataService
-from hydrotools.nwm_client import utils
-import streamstats
-
-#Plotting modules
-import folium
-import matplotlib
-import matplotlib.pyplot as plt
-import mpl_toolkits
-from mpl_toolkits.mplot3d import Axes3D
-import hvplot.pandas
-import holoviews as hv
-from holoviews import dim, opts, streams
-from bokeh.models import HoverTool
-import branca.colormap as cm
-import vincent
-from vincent import AxisProperties, PropertySet, ValueRef, Axis
-import matplotlib.cm
-from folium import features
-import proplot as pplt
-from folium.plugins import StripePattern
-
-#Evaluation modules
-from sklearn.metrics import r2_score
-from sklearn.metrics import mean_squared_error
-from sklearn.metrics import max_error
-from sklearn.metrics import mean_absolute_percentage_error
-import hydroeval as he
+utils = lazy.Lazy_Module('hydrotools.nwm_client.utils')
+streamstats = lazy.Lazy_Module('streamstats')
+
+#Plotting modules, imported on first use
+from Community_Eval_Methods.viz import plt, hv, folium, features, cm, vincent, site_map, report, display
 
 #AWS Data Access Modules
-import boto3
-from botocore import UNSIGNED
-from botocore.client import Config
+boto3 = lazy.Lazy_Module('boto3')
+botocore = lazy.Lazy_Module('botocore')
+botocore_client = lazy.Lazy_Module('botocore.client')
 
 #General Environment modules
-from IPython.display import display
 import warnings
 from progressbar import ProgressBar
 import io
 import os
 
 #Environment settings/configs
-pplt.rc["figure.facecolor"] = "w"
 os.environ['AWS_NO_SIGN_REQUEST'] = 'YES'
-geolocator = Nominatim(user_agent="geoapiExercises")
-pd.options.plotting.backend = 'holoviews'
-warnings.filterwarnings("ignore")
 
 
 
@@ -70,7 +52,7 @@ warnings.filterwarnings("ignore")
 
 class LULC_Eval():
     
-    def __init__(self, model ,state,  startDT, endDT, cwd):
+    def __init__(self, model ,state,  startDT, endDT, cwd, cache_dir = None):
         self = self
         #self.df =df
         self.startDT = startDT
@@ -86,13 +68,21 @@ class LULC_Eval():
                         'Q': 'Quarterly',
                         'A': 'Annual'
                         }
+        #metrics scored by Interactive_Model_Eval, any of metrics.METRICS
+        self.metric_set = ['RMSE', 'MaxError', 'MAPE', 'KGE']
+        #memoized evaluation results, also persisted to cache_dir if given
+        self.eval_cache = memo.Result_Cache(path = cache_dir)
+        #daily to annual aggregates, built on first use after the data is loaded
+        self.NWIS_pyramid = None
+        self.Mod_pyramid = None
+        self.prepared_key = None
         
     def get_NWIS(self):
         print('Getting NWIS Streamstats')
         
         #AWS bucket information
         bucket_name = 'streamflow-app-data'
-        s3 = boto3.resource('s3', config=Config(signature_version=UNSIGNED))
+        s3 = boto3.resource('s3', config=botocore_client.Config(signature_version=botocore.UNSIGNED))
         self.bucket = s3.Bucket(bucket_name)
 
        #Load streamstats wiht lat long to get geolocational information
@@ -329,12 +319,9 @@ class LULC_Eval():
             
 
         try: 
-            breaks = jenkspy.jenks_breaks(self.df[self.category], n_classes=5)
+            breaks = classify.cached_breaks((self.state, self.category), self.df[self.category], n_classes=5)
             print('Categorical breaks for ', self.category, ': ',  breaks)
-            self.df[self.cat_breaks] = pd.cut(self.df[self.category],
-                                    bins=breaks,
-                                    labels=['vsmall', 'small', 'medium', 'large', 'vlarge'],
-                                                include_lowest=True)
+            self.df[self.cat_breaks] = classify.size_classes(self.df[self.category], breaks)
             self.Catchment_Category()
 
         except ValueError:
@@ -347,75 +334,201 @@ class LULC_Eval():
 
 
     def Catchment_Category(self):
-        #create df for each jenks category
-        self.df_vsmall = self.df[self.df[self.cat_breaks]=='vsmall'].reset_index(drop = True)
-        self.df_small = self.df[self.df[self.cat_breaks]=='small'].reset_index(drop = True)
-        self.df_medium = self.df[self.df[self.cat_breaks]=='medium'].reset_index(drop = True)
-        self.df_large= self.df[self.df[self.cat_breaks]=='large'].reset_index(drop = True)
-        self.df_vlarge = self.df[self.df[self.cat_breaks]=='vlarge'].reset_index(drop = True)
-
-    def NWIS_retrieve(self, df):
+        #group sites by jenks category, the per-category dataframes are only built when accessed
+        self.size_groups = self.df.groupby(self.cat_breaks, observed = True)
+
+    def size_class(self, size):
+        #sites of one jenks category ('vsmall', 'small', 'medium', 'large', 'vlarge')
+        if size not in self.size_groups.groups:
+            return self.size_groups.obj.iloc[0:0].reset_index(drop = True)
+        return self.size_groups.get_group(size).reset_index(drop = True)
+
+    @property
+    def df_vsmall(self):
+        return self.size_class('vsmall')
+
+    @property
+    def df_small(self):
+        return self.size_class('small')
+
+    @property
+    def df_medium(self):
+        return self.size_class('medium')
+
+    @property
+    def df_large(self):
+        return self.size_class('large')
+
+    @property
+    def df_vlarge(self):
+        return self.size_class('vlarge')
+
+    def Category_Sweep(self, categories, freq = 'D', supply = False, metric_set = None, df = None, water_year = False):
+        #Evaluate the jenks classes of several catchment categories from one data load
+        #Sites are loaded and scored once, each category only relabels them
+        #Returns one tidy metrics table indexed by (category, class, NWIS_site_id)
+        df = self.df if df is None else df
+        df = df.reset_index(drop = True)
+        metric_set = self.metric_set if metric_set is None else list(metric_set)
+
+        self.prepare_comparison(df)
+        self.resample_pairs(freq, supply, df['NWIS_site_id'], df['NHD_reachid'], water_year)
+        obs, mod = metrics.site_matrices(self.NWIS_data_resampled, self.Mod_data_resampled,
+                                         df['NWIS_site_id'], df['NHD_reachid'])
+        scores = metrics.evaluate(obs, mod, metrics.validity_mask(obs, mod), metric_set = metric_set)
+        scores.insert(0, 'NWIS_site_id', df['NWIS_site_id'].values)
+        scores.insert(1, 'NHD_reachid', df['NHD_reachid'].values)
+        #remove locations with no USGS obs
+        has_obs = (scores['n'] > 0).values
+
+        tables = []
+        for category in categories:
+            #sites without a value for the category are not classified, as in class_eval_state
+            #breaks are set by every site with a value, so classes match class_eval_state
+            #and the df_vsmall..df_vlarge groups, sites without obs are dropped afterwards
+            classified = ~(df[category] < 0.00001).values
+            values = df[category][classified]
+            try:
+                breaks = classify.cached_breaks((self.state, category), values, n_classes=5)
+                classes = classify.size_classes(values, breaks)
+            except ValueError:
+                print('Not enough locations to categorize ', category)
+                continue
+            print('Categorical breaks for ', category, ': ',  breaks)
+
+            keep = has_obs[classified]
+            table = scores[classified][keep].copy()
+            table['category'] = category
+            table['class'] = classes.values[keep]
+            table['value'] = values.values[keep]
+            tables.append(table)
+
+        if len(tables) == 0:
+            #no category could be classified, an empty table keeps the sweep columns
+            table = scores.iloc[:0].copy()
+            table['category'] = pd.Series(dtype = object)
+            table['class'] = pd.Series(dtype = object)
+            table['value'] = pd.Series(dtype = 'float64')
+            tables.append(table)
+        self.Sweep_Eval = pd.concat(tables).set_index(['category', 'class', 'NWIS_site_id']).sort_index()
+        return self.Sweep_Eval
+
+    def NWIS_retrieve(self, df, batch = False, batch_size = 50, chunk_days = 365, max_workers = 8, min_coverage = 0.9, incremental = False):
         # Retrieve data from a number of sites
         print('Retrieving USGS sites ', list(df.NWIS_site_id), ' data')
         self.NWIS_sites = list(df.NWIS_site_id)
         
+        #batched mode, multi-site IV requests with parallel time chunks over one session
+        if batch == True:
+            self.NWIS_retrieve_batch(batch_size, chunk_days, max_workers, min_coverage, incremental)
+            return
+        
         #self.NWIS_data = pd.DataFrame(columns = self.NWIS_sites)
-        pbar = ProgressBar()
-        for site in pbar(self.NWIS_sites):
-            #print('Getting data for: ', site)
+        #keep one compressed store open for all sites
+        with store.HDF_Writer(self.cwd+'/Data/NWIS/NWIS_sites_'+self.state+'.h5') as writer:
+            pbar = ProgressBar()
+            for site in pbar(self.NWIS_sites):
+                #print('Getting data for: ', site)
             
-            try:
-                service = IVDataService()
-                usgs_data = service.get(
-                    sites=str(site),
-                    startDT= self.startDT,
-                    endDT=self.endDT
-                    )
-
-                #Get Daily mean for Model comparision
-                usgs_meanflow = pd.DataFrame(usgs_data.reset_index().groupby(pd.Grouper(key = 'value_time', freq = self.freq))['value'].mean())
-                usgs_meanflow = usgs_meanflow.reset_index()
-
-                #add key site information
-                #make obs data the same as temporal means
-                usgs_data = usgs_data.head(len(usgs_meanflow))
-
-                #remove obs streamflow
-                del usgs_data['value']
-                del usgs_data['value_time']
-
-                #connect mean temporal with other key info
-                usgs_meanflow = pd.concat([usgs_meanflow, usgs_data], axis=1)
-                usgs_meanflow = usgs_meanflow.rename(columns={'value_time':'Datetime', 'value':'USGS_flow','usgs_site_code':'USGS_ID', 'variable_name':'variable'})
-                usgs_meanflow = usgs_meanflow.set_index('Datetime')
-                usgs_meanflow.to_hdf(self.cwd+'/Data/NWIS/NWIS_sites_'+state+'.h5', key = site)
+                try:
+                    service = IVDataService()
+                    usgs_data = service.get(
+                        sites=str(site),
+                        startDT= self.startDT,
+                        endDT=self.endDT
+                        )
+
+                    #Get Daily mean for Model comparision
+                    usgs_meanflow = pd.DataFrame(usgs_data.reset_index().groupby(pd.Grouper(key = 'value_time', freq = self.freq))['value'].mean())
+                    usgs_meanflow = usgs_meanflow.reset_index()
+
+                    #add key site information
+                    #make obs data the same as temporal means
+                    usgs_data = usgs_data.head(len(usgs_meanflow))
+
+                    #remove obs streamflow
+                    del usgs_data['value']
+                    del usgs_data['value_time']
+
+                    #connect mean temporal with other key info
+                    usgs_meanflow = pd.concat([usgs_meanflow, usgs_data], axis=1)
+                    usgs_meanflow = usgs_meanflow.rename(columns={'value_time':'Datetime', 'value':'USGS_flow','usgs_site_code':'USGS_ID', 'variable_name':'variable'})
+                    usgs_meanflow = usgs_meanflow.set_index('Datetime')
+                    writer.put(site, store.nwis_frame(usgs_meanflow))
                 
-            except:
-                siteA = '0'+str(site)
-                service = IVDataService()
-                usgs_data = service.get(
-                    sites=siteA,
-                    startDT= self.startDT,
-                    endDT=self.endDT
-                    )
-
-                #Get Daily mean for Model comparision
-                usgs_meanflow = pd.DataFrame(usgs_data.reset_index().groupby(pd.Grouper(key = 'value_time', freq = self.freq))['value'].mean())
-                usgs_meanflow = usgs_meanflow.reset_index()
-
-                #add key site information
-                #make obs data the same as temporal means
-                usgs_data = usgs_data.head(len(usgs_meanflow))
-
-                #remove obs streamflow
-                del usgs_data['value']
-                del usgs_data['value_time']
-
-                #connect mean temporal with other key info
-                usgs_meanflow = pd.concat([usgs_meanflow, usgs_data], axis=1)
-                usgs_meanflow = usgs_meanflow.rename(columns={'value_time':'Datetime', 'value':'USGS_flow','usgs_site_code':'USGS_ID', 'variable_name':'variable'})
-                usgs_meanflow = usgs_meanflow.set_index('Datetime')
-                usgs_meanflow.to_hdf(self.cwd+'/Data/NWIS/NWIS_sites_'+state+'.h5', key = site)
+                except:
+                    siteA = '0'+str(site)
+                    service = IVDataService()
+                    usgs_data = service.get(
+                        sites=siteA,
+                        startDT= self.startDT,
+                        endDT=self.endDT
+                        )
+
+                    #Get Daily mean for Model comparision
+                    usgs_meanflow = pd.DataFrame(usgs_data.reset_index().groupby(pd.Grouper(key = 'value_time', freq = self.freq))['value'].mean())
+                    usgs_meanflow = usgs_meanflow.reset_index()
+
+                    #add key site information
+                    #make obs data the same as temporal means
+                    usgs_data = usgs_data.head(len(usgs_meanflow))
+
+                    #remove obs streamflow
+                    del usgs_data['value']
+                    del usgs_data['value_time']
+
+                    #connect mean temporal with other key info
+                    usgs_meanflow = pd.concat([usgs_meanflow, usgs_data], axis=1)
+                    usgs_meanflow = usgs_meanflow.rename(columns={'value_time':'Datetime', 'value':'USGS_flow','usgs_site_code':'USGS_ID', 'variable_name':'variable'})
+                    usgs_meanflow = usgs_meanflow.set_index('Datetime')
+                    writer.put(site, store.nwis_frame(usgs_meanflow))
+                
+                
+                
+                
+    def NWIS_retrieve_batch(self, batch_size = 50, chunk_days = 365, max_workers = 8, min_coverage = 0.9, incremental = False):
+        #the csv loses the 0 in front of USGS ids, make all NWIS sites correct 8 digit code
+        sites = ['0'+str(site) if len(str(site)) < 8 else str(site) for site in self.NWIS_sites]
+        filepath = self.cwd+'/Data/NWIS/NWIS_sites_'+self.state+'.h5'
+
+        #only request the date windows past each site's high-water mark, sites missing the same window share requests
+        if incremental == True:
+            windows = {}
+            watermarks = store.read_watermarks(filepath)
+            for site in sites:
+                for window in store.missing_ranges(filepath, site, self.startDT, self.endDT, self.freq, watermarks):
+                    windows.setdefault(window, []).append(site)
+        else:
+            windows = {(self.startDT, self.endDT): sites}
+
+        #fraction of the expected IV samples received per site, over every window
+        self.NWIS_coverage = {}
+        samples = {}
+        for (startDT, endDT), window_sites in windows.items():
+            print('Retrieving ', len(window_sites), ' USGS sites from ', startDT, ' to ', endDT)
+
+            #stream the IV records chunk by chunk into running sums and counts per period
+            reducer = nwis_iv.IV_Reducer(freq = self.freq)
+            for usgs_data in nwis_iv.iter_iv_batch(window_sites, startDT, endDT,
+                                                   batch_size = batch_size,
+                                                   chunk_days = chunk_days,
+                                                   max_workers = max_workers):
+                reducer.update(usgs_data)
+
+            #temporal means with per-period sample counts, partial periods are flagged
+            with store.HDF_Writer(filepath) as writer:
+                for site, usgs_meanflow in reducer.result(startDT, endDT, min_coverage).items():
+                    n_obs, expected = samples.get(site, (0, 0))
+                    samples[site] = (n_obs + usgs_meanflow['n_obs'].sum(), expected + usgs_meanflow['expected'].sum())
+                    self.NWIS_coverage[site] = samples[site][0] / samples[site][1]
+                    if incremental == True:
+                        writer.append(site, store.nwis_frame(usgs_meanflow))
+                    else:
+                        writer.put(site, store.nwis_frame(usgs_meanflow))
+                    #trailing partial periods are requested again on the next refresh
+                    held_end = store.received_end(usgs_meanflow, endDT, ~usgs_meanflow['partial'])
+                    if held_end is not None:
+                        writer.write_watermark(site, startDT, held_end)
                 
                 
                 
@@ -448,7 +561,8 @@ class LULC_Eval():
             usgs_meanflow = pd.concat([usgs_meanflow, usgs_data], axis=1)
             usgs_meanflow = usgs_meanflow.rename(columns={'value_time':'Datetime', 'value':'USGS_flow','usgs_site_code':'USGS_ID', 'variable_name':'variable'})
             usgs_meanflow = usgs_meanflow.set_index('Datetime')
-            usgs_meanflow.to_hdf(self.cwd+'/Data/NWIS/NWIS_sites_'+self.state+'.h5', key = site)
+            with store.HDF_Writer(self.cwd+'/Data/NWIS/NWIS_sites_'+self.state+'.h5') as writer:
+                writer.put(site, store.nwis_frame(usgs_meanflow))
 
         except:
             siteA = '0'+str(site)
@@ -475,28 +589,46 @@ class LULC_Eval():
             usgs_meanflow = pd.concat([usgs_meanflow, usgs_data], axis=1)
             usgs_meanflow = usgs_meanflow.rename(columns={'value_time':'Datetime', 'value':'USGS_flow','usgs_site_code':'USGS_ID', 'variable_name':'variable'})
             usgs_meanflow = usgs_meanflow.set_index('Datetime')
-            usgs_meanflow.to_hdf(self.cwd+'/Data/NWIS/NWIS_sites_'+self.state+'.h5', key = site)
+            with store.HDF_Writer(self.cwd+'/Data/NWIS/NWIS_sites_'+self.state+'.h5') as writer:
+                writer.put(site, store.nwis_frame(usgs_meanflow))
 
             
             
-    def Model_retrieve(self, df):
+    def Model_retrieve(self, df, incremental = False):
         
         # Retrieve data from a number of sites
         print('Retrieving model NHD reaches ', list(df.NHD_reachid), ' data')
         self.comparison_reaches = list(df.NHD_reachid)
+        filepath = self.cwd+'/Data/'+self.model+'/NHD_segments_'+self.state+'.h5'
         
-        pbar = ProgressBar()
-        for site in pbar(self.comparison_reaches):
-            print('Getting data for: ', site)
-            nwm_predictions = data.get_nwm_data(site,  self.startDT,  self.endDT)
-            #I think NWM outputs are in cms...
-            NHD_meanflow = nwm_predictions.resample(self.freq).mean()*self.cms_to_cfs
-            NHD_meanflow = NHD_meanflow.reset_index()
-            NHD_meanflow = NHD_meanflow.rename(columns={'time':'Datetime', 'value':'Obs_flow','feature_id':'NHD_segment', 'streamflow':'NHD_flow', 'velocity':'NHD_velocity'})
-            NHD_meanflow = NHD_meanflow.set_index('Datetime')
-            filepath = self.cwd+'/Data/'+self.model+'/NHD_segments_'+self.state+'.h5',
-            NHD_meanflow.to_hdf(filepath, key = site)
-           
+        #only request the date windows past each reach's high-water mark
+        if incremental == True:
+            watermarks = store.read_watermarks(filepath)
+            windows = [store.missing_ranges(filepath, site, self.startDT, self.endDT, self.freq, watermarks) for site in self.comparison_reaches]
+        else:
+            windows = [[(self.startDT, self.endDT)] for site in self.comparison_reaches]
+
+        #keep one compressed store open for all reaches
+        with store.HDF_Writer(filepath) as writer:
+            pbar = ProgressBar()
+            for site, site_windows in pbar(list(zip(self.comparison_reaches, windows))):
+                print('Getting data for: ', site)
+                for startDT, endDT in site_windows:
+                    nwm_predictions = data.get_nwm_data(site,  startDT,  endDT)
+                    #I think NWM outputs are in cms...
+                    NHD_meanflow = nwm_predictions.resample(self.freq).mean()*self.cms_to_cfs
+                    NHD_meanflow = NHD_meanflow.reset_index()
+                    NHD_meanflow = NHD_meanflow.rename(columns={'time':'Datetime', 'value':'Obs_flow','feature_id':'NHD_segment', 'streamflow':'NHD_flow', 'velocity':'NHD_velocity'})
+                    NHD_meanflow = NHD_meanflow.set_index('Datetime')
+                    if incremental == True:
+                        writer.append(site, NHD_meanflow)
+                    else:
+                        writer.put(site, NHD_meanflow)
+                    #period labels of the resampled series run to the period end, use the raw record
+                    held_end = store.received_end(nwm_predictions, endDT)
+                    if held_end is not None:
+                        writer.write_watermark(site, startDT, held_end)
+            
             
             
             
@@ -510,29 +642,65 @@ class LULC_Eval():
         NHD_meanflow = NHD_meanflow.reset_index()
         NHD_meanflow = NHD_meanflow.rename(columns={'time':'Datetime', 'value':'Obs_flow','feature_id':'NHD_segment', 'streamflow':'NHD_flow', 'velocity':'NHD_velocity'})
         NHD_meanflow = NHD_meanflow.set_index('Datetime')       
-        filepath = self.cwd+'/Data/'+self.model+'/NHD_segments_'+self.state+'.h5',
-        NHD_meanflow.to_hdf(filepath, key = site)
+        filepath = self.cwd+'/Data/'+self.model+'/NHD_segments_'+self.state+'.h5'
+        with store.HDF_Writer(filepath) as writer:
+            writer.put(site, NHD_meanflow)
+            #period labels of the resampled series run to the period end, use the raw record
+            held_end = store.received_end(nwm_predictions, self.endDT)
+            if held_end is not None:
+                writer.write_watermark(site, self.startDT, held_end)
             
             
             
             
     def date_range_list(self, start_date, end_date):
-        # Return list of datetime.date objects between start_date and end_date (inclusive).
-        date_list = []
-        curr_date = start_date
-        while curr_date <= end_date:
-            date_list.append(curr_date)
-            curr_date += timedelta(days=1)
-        return date_list      
-
-    def prepare_comparison(self, df):
+        # Return the shared daily DatetimeIndex between start_date and end_date (inclusive)
+        return alignment.shared_index(start_date, end_date)
+
+    def read_Mod_csv(self, site, state):
+        #Get the model predictions for one reach from the AWS bucket
+        format = '%Y-%m-%d %H:%M:%S'
+        csv_key = f"{self.model}/NHD_segments_{state}.h5/{self.model[:3]}_{site}.csv"
+        obj = self.bucket.Object(csv_key)
+        body = obj.get()['Body']
+        Mod_flow = pd.read_csv(body)
+        Mod_flow.pop('Unnamed: 0')
+        Mod_flow['time'] ='12:00:00' 
+        Mod_flow['Datetime'] = pd.to_datetime(Mod_flow['Datetime']+ ' ' + Mod_flow['time'], format = format)
+        Mod_flow.set_index('Datetime', inplace = True)
+        return Mod_flow
+
+
+    def read_NWIS_csv(self, site, state):
+        #Get the NWIS observations for one site from the AWS bucket
+        csv_key = f"NWIS/NWIS_sites_{state}.h5/NWIS_{site}.csv"
+        obj = self.bucket.Object(csv_key)
+        body = obj.get()['Body']
+        NWIS_meanflow = pd.read_csv(body)
+        format = '%Y-%m-%d %H:%M:%S'
+        NWIS_meanflow.drop_duplicates(subset = 'Datetime', inplace = True)                
+        NWIS_meanflow['time'] ='12:00:00' 
+        NWIS_meanflow['Datetime'] = pd.to_datetime(NWIS_meanflow['Datetime']+ ' ' + NWIS_meanflow['time'], format = format)
+        NWIS_meanflow.set_index('Datetime', inplace = True)
+        return NWIS_meanflow
+
+
+    def prepare_comparison(self, df, cache = False):
+
+        #the same site pairs and window are already loaded, e.g. by an earlier Map_Plot_Eval call
+        #cache changes where the series are read from, so it is part of the key
+        prepared_key = memo.make_key(list(df.NWIS_site_id), list(df.NHD_reachid), self.startDT, self.endDT,
+                                     cache, self.eval_cache.path)
+        if prepared_key == self.prepared_key:
+            return
         
         self.comparison_reaches = list(df.NHD_reachid)
         self.NWIS_sites = list(df.NWIS_site_id)
         self.dates = self.date_range_list(pd.to_datetime(self.startDT), pd.to_datetime(self.endDT))
         
-        self.NWIS_data = pd.DataFrame(columns = self.NWIS_sites)
-        self.Mod_data = pd.DataFrame(columns = self.comparison_reaches)
+        #series are collected per site and joined on the shared index by date
+        NWIS_series = {}
+        Mod_series = {}
 
         Mod_state_key =  dict(zip(df.NHD_reachid, 
                               df.state_id))
@@ -544,19 +712,14 @@ class LULC_Eval():
             try:
                 #print(f"Getting data for {self.model[:3]}: ", site)
                 state = Mod_state_key[site].lower()
-                format = '%Y-%m-%d %H:%M:%S'
-                csv_key = f"{self.model}/NHD_segments_{state}.h5/{self.model[:3]}_{site}.csv"
-                #print(csv_key)
-                obj = self.bucket.Object(csv_key)
-                body = obj.get()['Body']
-                Mod_flow = pd.read_csv(body)
-                Mod_flow.pop('Unnamed: 0')
-                Mod_flow['time'] ='12:00:00' 
-                Mod_flow['Datetime'] = pd.to_datetime(Mod_flow['Datetime']+ ' ' + Mod_flow['time'], format = format)
-                Mod_flow.set_index('Datetime', inplace = True)
+                if cache == True:
+                    Mod_flow = store.cached_series(self.cwd+'/Data/cache/'+self.model+'.h5', site, self.startDT, self.endDT,
+                                                   lambda: self.read_Mod_csv(site, state))
+                else:
+                    Mod_flow = self.read_Mod_csv(site, state)
                 Mod_flow = Mod_flow.loc[self.startDT:self.endDT]
                 cols = Mod_flow.columns
-                self.Mod_data[site] = Mod_flow[cols[0]]
+                Mod_series[site] = Mod_flow[cols[0]]
 
             except:
                 print('Site: ', site, ' not in database, skipping')
@@ -573,67 +736,93 @@ class LULC_Eval():
             try:
                 
                 #NWIS_meanflow =  pd.read_hdf(self.cwd+'/Data/NWIS/NWIS_sites_'+self.state+'.h5', key = str(site))
-                csv_key = f"NWIS/NWIS_sites_{self.state}.h5/NWIS_{site}.csv"
-                obj = self.bucket.Object(csv_key)
-                body = obj.get()['Body']
-                NWIS_meanflow = pd.read_csv(body)
-                format = '%Y-%m-%d %H:%M:%S'
-                NWIS_meanflow.drop_duplicates(subset = 'Datetime', inplace = True)                
-                NWIS_meanflow['time'] ='12:00:00' 
-                NWIS_meanflow['Datetime'] = pd.to_datetime(NWIS_meanflow['Datetime']+ ' ' + NWIS_meanflow['time'], format = format)
-                NWIS_meanflow.set_index('Datetime', inplace = True)
+                if cache == True:
+                    NWIS_meanflow = store.cached_series(self.cwd+'/Data/cache/NWIS.h5', site, self.startDT, self.endDT,
+                                                        lambda: self.read_NWIS_csv(site, self.state))
+                else:
+                    NWIS_meanflow = self.read_NWIS_csv(site, self.state)
                 NWIS_meanflow = NWIS_meanflow.loc[self.startDT:self.endDT]
                 
-                #change np.nan to -100, can separate values out later
-                self.NWIS_data[site] = -100
 
 
                 #Adjust for different time intervals here
                 #Daily
                 #if self.freq =='D':
-                self.NWIS_data[site] = NWIS_meanflow['USGS_flow']
+                NWIS_series[site] = NWIS_meanflow['USGS_flow']
 
             except:
                     print('USGS site ', site, ' not in database, skipping')
                     #remove item from list
                     self.NWIS_sites.remove(site)
-        #change np.nan to -100, can separate values out later
-        self.NWIS_data.fillna(-100, inplace = True)
-        self.NWIS_column = self.NWIS_data.copy()
-        self.NWIS_column = pd.DataFrame(self.NWIS_column.stack(), columns = ['NWIS_flow_cfs'])
-        self.NWIS_column = self.NWIS_column.reset_index().drop('level_1', axis = 1)
-
-        self.Mod_column = self.Mod_data.copy()
-        col = self.model+'_flow_cfs'
-        self.Mod_column = pd.DataFrame(self.Mod_column.stack(), columns = [col])
-        self.Mod_column = self.Mod_column.reset_index().drop('level_1', axis =  1)
+        #join every series onto the shared index, days without data stay NaN
+        self.NWIS_data, self.NWIS_data_coverage = alignment.align(NWIS_series, self.dates)
+        self.Mod_data, self.Mod_data_coverage = alignment.align(Mod_series, self.dates)
+        #flows are stored as float32
+        self.NWIS_data = self.NWIS_data.astype('float32')
+        self.Mod_data = self.Mod_data.astype('float32')
+
+        #one typed (site, reach, Datetime, obs, model) row per time step of every site pair
+        self.Evaluation = metrics.long_table(self.NWIS_data, self.Mod_data, df['NWIS_site_id'], df['NHD_reachid'],
+                                             self.model+'_flow_cfs')
+        self.prepared_key = prepared_key
 
         
             
             
-    def Model_Eval(self, df, size):
+    def Stream_Model_Eval(self, df, chunk_days = 1826, metric_set = None):
+        #Daily evaluation of every site pair without building the NWIS_data/Mod_data frames
+        #Site records are cached locally one at a time, then scored window by window
+        metric_set = self.metric_set if metric_set is None else list(metric_set)
+        NWIS_path = self.cwd+'/Data/cache/NWIS.h5'
+        Mod_path = self.cwd+'/Data/cache/'+self.model+'.h5'
+        Mod_state_key = dict(zip(df.NHD_reachid, df.state_id))
+
+        print('Caching ', self.model, ' and NWIS data')
+        pbar = ProgressBar()
+        for site, reach in pbar(list(zip(df.NWIS_site_id, df.NHD_reachid))):
+            try:
+                state = Mod_state_key[reach].lower()
+                store.cached_series(Mod_path, reach, self.startDT, self.endDT, lambda: self.read_Mod_csv(reach, state))
+                store.cached_series(NWIS_path, site, self.startDT, self.endDT, lambda: self.read_NWIS_csv(site, self.state))
+            except:
+                print('Site: ', site, ' not in database, skipping')
+
+        print('Scoring sites')
+        accumulator = metrics.Metric_Accumulator(len(df))
+        NWIS_windows = store.iter_site_windows(NWIS_path, df.NWIS_site_id, self.startDT, self.endDT, 'USGS_flow', chunk_days)
+        Mod_windows = store.iter_site_windows(Mod_path, df.NHD_reachid, self.startDT, self.endDT, None, chunk_days)
+        for (index, obs), (_, mod) in zip(NWIS_windows, Mod_windows):
+            accumulator.update(obs, mod)
+
+        scores = accumulator.result([m for m in metric_set if m not in ['FHV', 'FLV']])
+        scores.insert(0, 'NWIS_site_id', list(df.NWIS_site_id))
+        scores.insert(1, 'NHD_reachid', list(df.NHD_reachid))
+        self.Stream_Eval = scores
+        return self.Stream_Eval
+
+
+    def Model_Eval(self, df, size, panels = True, density = True):
+        #panels draws every point of each site, set it False for large sets and keep the pooled density view
 
         #Creates a total categorical evaluation comparing model performacne
         print('Creating dataframe of all flow predictions to evaluate')
-        self.Evaluation = pd.concat([self.Mod_column,self.NWIS_column], axis = 1)
-        self.Evaluation = self.Evaluation.T.drop_duplicates().T     
-        self.Evaluation = self.Evaluation.dropna()
+        model_cfs = self.model+'_flow_cfs'
+        self.Evaluation = self.Evaluation.dropna(subset = ['NWIS_flow_cfs', model_cfs])
         
-        num_figs = len(self.comparison_reaches)
-
-
-        fig, ax = plt.subplots(num_figs ,2, figsize = (10,4*num_figs))
+        num_figs = len(self.comparison_reaches) if panels else 0
 
         plot_title = 'Evaluation of ' + self.model + ' predictions related to watershed: ' + self.category + '-'+ size
 
-        fig.suptitle(plot_title, y = 0.89)    
-        
-        self.Mod_data['datetime'] = self.dates
-        self.Mod_data.set_index('datetime', inplace = True)
-        
-        self.NWIS_data['datetime'] = self.dates
-        self.NWIS_data.set_index('datetime', inplace = True)
+        if density:
+            #all pooled pairs as one log-scaled 2-D histogram, drawn in constant time
+            fig, ax = plt.subplots(figsize = (7,5.5))
+            report.draw_density(fig, ax, self.Evaluation['NWIS_flow_cfs'].values, self.Evaluation[model_cfs].values, self.model, 'cfs')
+            ax.set_title(plot_title + '\n all site pairs')
 
+        if num_figs > 0:
+            fig, ax = plt.subplots(num_figs ,2, figsize = (10,4*num_figs), squeeze = False)
+            fig.suptitle(plot_title, y = 0.89)    
+        
         for i in np.arange(0,num_figs,1):
             reach = self.comparison_reaches[i]
             site = self.NWIS_sites[i]
@@ -641,8 +830,8 @@ class LULC_Eval():
             NWIS_site_lab = 'USGS: ' + str(site)
             Mod_reach_lab = self.model + ': ' + str(reach)
 
-            max_flow = max(max(self.NWIS_data[site]), max(self.Mod_data[reach]))
-            min_flow = min(min(self.NWIS_data[site]), min(self.Mod_data[reach]))
+            max_flow = np.nanmax([self.NWIS_data[site].max(), self.Mod_data[reach].max()])
+            min_flow = np.nanmin([self.NWIS_data[site].min(), self.Mod_data[reach].min()])
             
             plt.subplots_adjust(hspace=0.5)
 
@@ -662,13 +851,13 @@ class LULC_Eval():
             ylab = self.model+ ' Predictions (cfs)'
             ax[i,1].set_ylabel(ylab)
 
-        #calculate some performance metrics
-        model_cfs = self.model+'_flow_cfs'
-        r2 = r2_score(self.Evaluation.NWIS_flow_cfs, self.Evaluation.model_cfs)
-        rmse = mean_squared_error(self.Evaluation.NWIS_flow_cfs, self.Evaluation.model_cfs, squared=False)
-        maxerror = max_error(self.Evaluation.NWIS_flow_cfs, self.Evaluation.model_cfs)
-        MAPE = mean_absolute_percentage_error(self.Evaluation.NWIS_flow_cfs, self.Evaluation.model_cfs)*100
-        kge, r, alpha, beta = he.evaluator(he.kge, self.Evaluation.model_cfs.astype('float32'), self.Evaluation.NWIS_flow_cfs.astype('float32'))
+        #calculate some performance metrics, pooled over all site pairs
+        pooled = metrics.pooled_scores(self.Evaluation['NWIS_flow_cfs'], self.Evaluation[model_cfs],
+                                       ['RMSE', 'MaxError', 'MAPE', 'KGE'])
+        rmse = pooled['RMSE']
+        maxerror = pooled['MaxError']
+        MAPE = pooled['MAPE']
+        kge = [pooled['KGE']]
 
         print('The '+ self.model+ ' demonstrates the following overall performance in catchments exhibiting ', size, ' ', self.category)
         print('RMSE = ', rmse, 'cfs')
@@ -680,132 +869,100 @@ class LULC_Eval():
         
         
         
-    def Interactive_Model_Eval(self, freq, supply):
+    def resample_pairs(self, freq, supply, NWIS_sites, reaches, water_year = False):
+        #Resampled (and supply accumulated) NWIS and model series for each site pair
+        #Pairs are memoized on (site, reach, startDT, endDT, freq, supply, data version)
+        #water_year accumulates supply from October and bins annual volumes by water year
+        NWIS_series, Mod_series = {}, {}
+        missing = []
+        for site, reach in zip(NWIS_sites, reaches):
+            version = [memo.data_version(data[col]) if col in data.columns else None
+                       for data, col in [(self.NWIS_data, site), (self.Mod_data, reach)]]
+            key = memo.make_key(site, reach, self.startDT, self.endDT, freq, supply, water_year, version)
+            pair = self.eval_cache.get(key)
+            if pair is None:
+                missing.append((site, reach, key))
+            else:
+                NWIS_series[site], Mod_series[reach] = pair
+
+        if len(missing) > 0:
+            NWIS_columns = list(dict.fromkeys([p[0] for p in missing]))
+            Mod_columns = list(dict.fromkeys([p[1] for p in missing]))
+
+            #Daily
+            if freq == 'D':
+                NWIS_data_resampled = self.NWIS_data.reindex(columns = NWIS_columns)
+                Mod_data_resampled = self.Mod_data.reindex(columns = Mod_columns)
+
+            #Monthly, Quarterly, Annual volumes are looked up in the aggregation pyramids
+            else:
+                if self.NWIS_pyramid is None or not self.NWIS_pyramid.matches(self.NWIS_data):
+                    self.NWIS_pyramid = aggregation.Aggregation_Pyramid(self.NWIS_data, self.cfsday_AFday)
+                if self.Mod_pyramid is None or not self.Mod_pyramid.matches(self.Mod_data):
+                    self.Mod_pyramid = aggregation.Aggregation_Pyramid(self.Mod_data, self.cfsday_AFday)
+                rule = 'A-SEP' if (water_year == True and freq == 'A') else freq
+                #only complete periods are compared, a gap in either series drops the period
+                NWIS_data_resampled = self.NWIS_pyramid.level(rule, 'sum', NWIS_columns, complete = True)
+                Mod_data_resampled = self.Mod_pyramid.level(rule, 'sum', Mod_columns, complete = True)
+
+            #one column per pair, a site or reach may be in several pairs
+            NWIS_pairs = NWIS_data_resampled[[p[0] for p in missing]]
+            Mod_pairs = Mod_data_resampled[[p[1] for p in missing]]
+            if supply == True:
+                #year-to-date volumes for all pairs in one grouped cumulative sum, only over the
+                #periods both series of a pair hold so a gap in one does not leak into the other
+                Mod_pairs = Mod_pairs.reindex(NWIS_pairs.index)
+                both = NWIS_pairs.notna().values & Mod_pairs.notna().values
+                NWIS_pairs = aggregation.supply_cumsum(NWIS_pairs.where(both), water_year)
+                Mod_pairs = aggregation.supply_cumsum(Mod_pairs.where(both), water_year)
+
+            for j, (site, reach, key) in enumerate(missing):
+                pair = (NWIS_pairs.iloc[:, j], Mod_pairs.iloc[:, j])
+                self.eval_cache.put(key, pair)
+                NWIS_series[site], Mod_series[reach] = pair
+
+        self.NWIS_data_resampled = pd.DataFrame(NWIS_series)
+        self.Mod_data_resampled = pd.DataFrame(Mod_series)
+
+
+    def Score_Sites(self, freq, supply, metric_set = None, n_boot = 0, water_year = False):
+        #score every site at one frequency into self.Eval, sorted by KGE, without displaying or plotting
+        #used by Interactive_Model_Eval and by batch runs
         self.freq = freq
+        #metrics to score, defaults to the class metric set
+        if metric_set is not None:
+            self.metric_set = list(metric_set)
+        #sites are ranked by KGE so it is always scored
+        if 'KGE' not in self.metric_set:
+            self.metric_set = self.metric_set + ['KGE']
 
         if self.freq == 'D':
             self.units = 'cfs'
         else:
             self.units = 'Acre-Feet'
 
-        #Adjust for different time intervals here
-        #Daily
-        if self.freq == 'D':
-            self.NWIS_data_resampled = self.NWIS_data.copy()
-            self.Mod_data_resampled = self.Mod_data.copy()
-
-        #Monthly, Quarterly, Annual
-        if self.freq !='D':
-            #NWIS
-            self.NWIS_data_resampled = self.NWIS_data.copy()*self.cfsday_AFday
-            self.NWIS_data_resampled = self.NWIS_data_resampled.resample(self.freq).sum()
-            #Modeled
-            self.Mod_data_resampled = self.Mod_data.copy()*self.cfsday_AFday
-            self.Mod_data_resampled = self.Mod_data_resampled.resample(self.freq).sum()
-            
-        if supply == True:
-            #NWIS
-            #Get Columns names
-            columns = self.NWIS_data_resampled.columns
-
-            #set up cumulative monthly values
-            self.NWIS_data_resampled['Year'] = self.NWIS_data_resampled.index.year
-
-            self.NWIS_CumSum = pd.DataFrame(columns=columns)
-
-            for site in columns:
-                self.NWIS_CumSum[site] = self.NWIS_data_resampled.groupby(['Year'])[site].cumsum()
-
-            #Model
-            #Get Columns names
-            columns = self.Mod_data_resampled.columns
+        #resample the site pairs, reusing memoized results from earlier calls
+        self.resample_pairs(self.freq, supply, self.df['NWIS_site_id'], self.df['NHD_reachid'], water_year)
 
-            #set up cumulative monthly values
-            self.Mod_data_resampled['Year'] = self.Mod_data_resampled.index.year
-
-            self.Mod_CumSum = pd.DataFrame(columns=columns)
-
-            for site in columns:
-                self.Mod_CumSum[site] = self.Mod_data_resampled.groupby(['Year'])[site].cumsum()
-                
-            #set the Mod and NWIS resampled data == to the CumSum Df's
-            self.NWIS_data_resampled = self.NWIS_CumSum
-            self.Mod_data_resampled =self.Mod_CumSum
-
-        RMSE = []
-        MAXERROR = []
-        MAPE = []
-        KGE = []
-
-        for row in np.arange(0,len(self.df),1):
-            #try:            
-            #print(row)
-            #Get NWIS id
-            NWISid = self.df['NWIS_site_id'][row]
-            
-            #Get Model reach id
-            reachid = 'NHD_reachid'
-            modid = self.df[reachid][row]
-            
-            #get observed and prediction data
-            obs = self.NWIS_data_resampled[NWISid]
-            mod = self.Mod_data_resampled[modid]
-
-            #remove na values or 0
-            df = pd.DataFrame()
-            df['obs'] = obs
-            df['mod'] = mod.astype('float64')
-         #adding dropna() to prevent crashing script
-            df = df[df>=0]
-            df.dropna(inplace =True)
-
-            if len(df)>=1:
-                
-                df[df<0.01]=0.01
-                df['error'] = df['obs'] - df['mod']
-                df['P_error'] = abs(df['error']/df['obs'])*100
-                
-                #drop inf values
-                df.replace([np.inf, -np.inf], np.nan, inplace = True)
-                df.dropna(inplace = True)
-
-                obs = df['obs']
-                mod = df['mod']
-
-                #calculate scoring
-                rmse = round(mean_squared_error(obs, mod, squared=False))
-                maxerror = round(max_error(obs, mod))
-                mape = df.P_error.mean()
-                kge, r, alpha, beta = he.evaluator(he.kge, mod.astype('float32'), obs.astype('float32'))
-
-                RMSE.append(rmse)
-                MAXERROR.append(maxerror)
-                MAPE.append(mape)
-                KGE.append(kge[0])
-
-              
-            else:
-                #calculate scoring
-                rmse = 0
-                maxerror = 0
-                mape = 0
-                kge = -10000
-
-                RMSE.append(rmse)
-                MAXERROR.append(maxerror)
-                MAPE.append(mape)
-                KGE.append(kge)
-      
+        #score all sites at once on the aligned obs and model matrices
+        reachid = 'NHD_reachid'
+        obs, mod = metrics.site_matrices(self.NWIS_data_resampled, self.Mod_data_resampled,
+                                         self.df['NWIS_site_id'], self.df[reachid])
+        mask = metrics.validity_mask(obs, mod)
+        scores = metrics.evaluate(obs, mod, mask, metric_set = self.metric_set)
 
         #Connect model evaluation to a DF, add in relevant information concerning LULC
         Eval = pd.DataFrame()
         Eval['NWIS_site_id'] = self.df['NWIS_site_id']
         Eval[reachid] = self.df[reachid]
         Eval['Location'] = self.df['NWIS_sitename']
-        Eval['RMSE'] = RMSE
-        Eval['MaxError'] = MAXERROR
-        Eval['MAPE'] = MAPE
-        Eval['KGE'] = KGE
+        for metric in self.metric_set:
+            Eval[metric] = scores[metric].values
+        #block-bootstrap interval of the KGE used to rank the sites
+        if n_boot > 0:
+            KGE_ci = metrics.kge_bootstrap(obs, mod, mask, n_boot = n_boot)
+            Eval['KGE_lower'] = KGE_ci['KGE_lower'].values
+            Eval['KGE_upper'] = KGE_ci['KGE_upper'].values
         Eval['Drainage_area_mi2'] = self.df['Drainage_area_mi2']
         Eval['Mean_Basin_Elev_ft'] = self.df['Mean_Basin_Elev_ft']
         Eval['Perc_Forest'] = self.df['Perc_Forest']
@@ -820,7 +977,12 @@ class LULC_Eval():
         #remove locations with no USGS obs
         Eval = Eval[Eval['KGE'] > -1000]
         #sort dataframe and reindex
-        self.Eval = Eval.sort_values('KGE', ascending = False).reset_index(drop = True)    
+        self.Eval = Eval.sort_values('KGE', ascending = False).reset_index(drop = True)
+        return self.Eval
+
+
+    def Interactive_Model_Eval(self, freq, supply, metric_set = None, n_boot = 0, water_year = False, max_points = downsample.MAX_POINTS, browse = False):
+        self.Score_Sites(freq, supply, metric_set, n_boot, water_year)
         #display evaluation DF
         display(self.Eval)
         
@@ -898,107 +1060,157 @@ class LULC_Eval():
         plt.show()
         
         num_figs = len(self.Eval)
+        if browse:
+            #plots are only built for the selected site
+            return self.Site_Browser(max_points)
         for i in np.arange(0,num_figs,1):
-            
+            plot = self.Site_Plot(i, max_points)
+            if plot is not None:
+                display(plot[0] + plot[1])
 
-            reach = self.Eval[reachid][i]
-            site = self.Eval['NWIS_site_id'][i]
-            #print(site, reach)
- 
-            sitename = self.Eval.Location[i]
-            sitestat = str(self.Eval[self.category][i])
 
-            plot_title = 'Performance of ' + self.model +' predictions related to: ' + self.category +  '\n' + sitename + '\n'+ self.category +': ' + sitestat + ', classified as: '+ self.size
+    def Site_Plot(self, i, max_points = downsample.MAX_POINTS):
+        #hydrograph and obs vs model scatter of the i-th site of self.Eval, None without data
+        reachid = 'NHD_reachid'
+        reach = self.Eval[reachid][i]
+        site = self.Eval['NWIS_site_id'][i]
+        #print(site, reach)
 
+        sitename = self.Eval.Location[i]
+        sitestat = str(self.Eval[self.category][i])
 
-            NWIS_site_lab = 'USGS: ' + str(site)
-            Mod_reach_lab = self.model + ': NHD ' + str(reach)
+        plot_title = 'Performance of ' + self.model +' predictions related to: ' + self.category +  '\n' + sitename + '\n'+ self.category +': ' + sitestat + ', classified as: '+ self.size
 
-            Eval_cols = [NWIS_site_lab, Mod_reach_lab]
-            Eval_df = pd.DataFrame(index = self.NWIS_data_resampled.index, columns = Eval_cols)
-            Eval_df[Mod_reach_lab] = self.Mod_data_resampled[reach]
-            Eval_df[NWIS_site_lab] = self.NWIS_data_resampled[site]
 
+        NWIS_site_lab = 'USGS: ' + str(site)
+        Mod_reach_lab = self.model + ': NHD ' + str(reach)
 
-            Eval_df = Eval_df.dropna()
+        Eval_cols = [NWIS_site_lab, Mod_reach_lab]
+        Eval_df = pd.DataFrame(index = self.NWIS_data_resampled.index, columns = Eval_cols)
+        Eval_df[Mod_reach_lab] = self.Mod_data_resampled[reach]
+        Eval_df[NWIS_site_lab] = self.NWIS_data_resampled[site]
 
-            if Eval_df.shape[0] > 0:
 
-                #need to have datetime fixed
-                Eval_df = Eval_df.reset_index()
-                Eval_df['Datetime'] = pd.to_datetime(Eval_df['Datetime'])
-                Eval_df.set_index('Datetime', inplace = True, drop = True)
-                
-                #get observed and prediction data
-                obs = Eval_df[NWIS_site_lab]
-                mod = Eval_df[Mod_reach_lab]
-                df = pd.DataFrame()
-                df['obs'] = obs
-                df['mod'] = mod.astype('float64')
-                #remove na values or 0
-                df[df<0.01]=0.01
-                #adding dropna() to prevent crashing script
-                df.dropna(axis=0, inplace =True)
-                
-                if len(df)>0:
-                    df['error'] = df['obs'] - df['mod']
-                    df['P_error'] = abs(df['error']/df['obs'])*100
-                    #drop inf values
-                    df.replace([np.inf, -np.inf], np.nan, inplace = True)
-                    df.dropna(inplace = True)
+        Eval_df = Eval_df.dropna()
+
+        if Eval_df.shape[0] > 0:
+
+            #need to have datetime fixed
+            Eval_df = Eval_df.reset_index()
+            Eval_df['Datetime'] = pd.to_datetime(Eval_df['Datetime'])
+            Eval_df.set_index('Datetime', inplace = True, drop = True)
+            
+            #get observed and prediction data
+            obs = Eval_df[NWIS_site_lab]
+            mod = Eval_df[Mod_reach_lab]
+            df = pd.DataFrame()
+            df['obs'] = obs
+            df['mod'] = mod.astype('float64')
+            #remove na values or 0
+            df[df<0.01]=0.01
+            #adding dropna() to prevent crashing script
+            df.dropna(axis=0, inplace =True)
+            
+            if len(df)>0:
+                df['error'] = df['obs'] - df['mod']
+                df['P_error'] = abs(df['error']/df['obs'])*100
+                #drop inf values
+                df.replace([np.inf, -np.inf], np.nan, inplace = True)
+                df.dropna(inplace = True)
+
+                obs = df['obs']
+                mod = df['mod']
 
-                    obs = df['obs']
-                    mod = df['mod']
+                #scores come from the vectorized evaluation in Score_Sites, not recomputed per site
+                #RMSE, MaxError and MAPE show as nan when not in the scored metric set
+                scores = self.Eval.loc[i]
+                rmse = scores.get('RMSE', np.nan)
+                maxerror = scores.get('MaxError', np.nan)
+                MAPE = np.round(scores.get('MAPE', np.nan))
+                kge = scores['KGE']
 
-                    #calculate scoring
-                    rmse = round(mean_squared_error(obs, mod, squared=False))
-                    maxerror = round(max_error(obs, mod))
-                    MAPE = round(mean_absolute_percentage_error(obs, mod)*100)
-                    kge, r, alpha, beta = he.evaluator(he.kge, mod.astype('float32'), obs.astype('float32'))
+                #set limit to MAPE error
+                if MAPE > 1000:
+                    MAPE ='> 1000'
 
-                    #set limit to MAPE error
-                    if MAPE > 1000:
-                        MAPE ='> 1000'
+                rmse_phrase = 'RMSE: ' + str(rmse) + ' ' + self.units
+                error_phrase = 'Max Error: ' + str(maxerror) + ' ' + self.units
+                mape_phrase = 'MAPE: ' + str(MAPE) + '%'
+                #Interactive_Model_Eval caps very negative KGE at -1
+                kge_phrase = 'kge: ' + (str(round(kge,2)) if kge > -1 else '<= -1')
 
-                    rmse_phrase = 'RMSE: ' + str(rmse) + ' ' + self.units
-                    error_phrase = 'Max Error: ' + str(maxerror) + ' ' + self.units
-                    mape_phrase = 'MAPE: ' + str(MAPE) + '%'
-                    kge_phrase = 'kge: ' + str(round(kge[0],2))
+                max_flow = np.nanmax([Eval_df[NWIS_site_lab].max(), Eval_df[Mod_reach_lab].max()])
+                min_flow = np.nanmin([Eval_df[NWIS_site_lab].min(), Eval_df[Mod_reach_lab].min()])
 
-                    max_flow = max(max(Eval_df[NWIS_site_lab]), max(Eval_df[Mod_reach_lab]))
-                    min_flow = min(min(Eval_df[NWIS_site_lab]), min(Eval_df[Mod_reach_lab]))
+                flow_range = np.arange(min_flow, max_flow, (max_flow-min_flow)/100)
 
-                    flow_range = np.arange(min_flow, max_flow, (max_flow-min_flow)/100)
+                if self.freq == 'A':
+                    bbox_L = -int(round((len(Eval_df)*.32),0))
+                    text_bbox_L = -int(round((len(Eval_df)*.22),0))
 
-                    if self.freq == 'A':
-                        bbox_L = -int(round((len(Eval_df)*.32),0))
-                        text_bbox_L = -int(round((len(Eval_df)*.22),0))
+                else:
+                    bbox_L = -int(round((len(Eval_df)*.32),0))
+                    text_bbox_L = -int(round((len(Eval_df)*.16),0))
 
-                    else:
-                        bbox_L = -int(round((len(Eval_df)*.32),0))
-                        text_bbox_L = -int(round((len(Eval_df)*.16),0))
+                Discharge_lab = 'Discharge (' +self.units +')'
+                Obs_Discharge_lab = ' Observed Discharge (' +self.units +')'
+                Mod_Discharge_lab = self.model +' Discharge (' +self.units +')'
 
-                    Discharge_lab = 'Discharge (' +self.units +')'
-                    Obs_Discharge_lab = ' Observed Discharge (' +self.units +')'
-                    Mod_Discharge_lab = self.model +' Discharge (' +self.units +')'
 
+                #plot a shape-preserving subset of long records, the scores above use every point
+                plot_df = downsample.downsample_frame(Eval_df[[NWIS_site_lab, Mod_reach_lab]], max_points)
+                NWIS_hydrograph = hv.Curve((plot_df.index, plot_df[NWIS_site_lab]), 'DateTime', Discharge_lab, label = NWIS_site_lab).opts(title = plot_title, tools = ['hover'], color = 'orange')
+                Mod_hydrograph = hv.Curve((plot_df.index, plot_df[Mod_reach_lab]), 'DateTime', Discharge_lab, label = Mod_reach_lab).opts(tools = ['hover'], color = 'blue')
+                RMSE_hv = hv.Text(Eval_df.index[text_bbox_L],max_flow*.93, rmse_phrase, fontsize = 8)
+                Error_hv = hv.Text(Eval_df.index[text_bbox_L],max_flow*.83, error_phrase, fontsize = 8)
+                MAPE_hv = hv.Text(Eval_df.index[text_bbox_L],max_flow*.73, mape_phrase, fontsize = 8)
+                KGE_hv = hv.Text(Eval_df.index[text_bbox_L],max_flow*.63, kge_phrase, fontsize = 8)
+                textbox_hv = hv.Rectangles([(Eval_df.index[bbox_L], max_flow*.56, Eval_df.index[-1], max_flow*.99)]).opts(color = 'white')
 
-                    NWIS_hydrograph = hv.Curve((Eval_df.index, Eval_df[NWIS_site_lab]), 'DateTime', Discharge_lab, label = NWIS_site_lab).opts(title = plot_title, tools = ['hover'], color = 'orange')
-                    Mod_hydrograph = hv.Curve((Eval_df.index, Eval_df[Mod_reach_lab]), 'DateTime', Discharge_lab, label = Mod_reach_lab).opts(tools = ['hover'], color = 'blue')
-                    RMSE_hv = hv.Text(Eval_df.index[text_bbox_L],max_flow*.93, rmse_phrase, fontsize = 8)
-                    Error_hv = hv.Text(Eval_df.index[text_bbox_L],max_flow*.83, error_phrase, fontsize = 8)
-                    MAPE_hv = hv.Text(Eval_df.index[text_bbox_L],max_flow*.73, mape_phrase, fontsize = 8)
-                    KGE_hv = hv.Text(Eval_df.index[text_bbox_L],max_flow*.63, kge_phrase, fontsize = 8)
-                    textbox_hv = hv.Rectangles([(Eval_df.index[bbox_L], max_flow*.56, Eval_df.index[-1], max_flow*.99)]).opts(color = 'white')
+                Mod_NWIS_Scatter = hv.Scatter((Eval_df[NWIS_site_lab], Eval_df[Mod_reach_lab]), Obs_Discharge_lab, Mod_Discharge_lab).opts(tools = ['hover'], color = 'blue', xrotation=45)
+                Mod_NWIS_one2one = hv.Curve((flow_range, flow_range)).opts(color = 'red', line_dash='dashed')
+                return (NWIS_hydrograph * Mod_hydrograph*textbox_hv*RMSE_hv*Error_hv*MAPE_hv*KGE_hv).opts(width=600, legend_position='top_left', tools=['hover']), (Mod_NWIS_Scatter*Mod_NWIS_one2one).opts(shared_axes = False)
 
-                    Mod_NWIS_Scatter = hv.Scatter((Eval_df[NWIS_site_lab], Eval_df[Mod_reach_lab]), Obs_Discharge_lab, Mod_Discharge_lab).opts(tools = ['hover'], color = 'blue', xrotation=45)
-                    Mod_NWIS_one2one = hv.Curve((flow_range, flow_range)).opts(color = 'red', line_dash='dashed')
-                    display((NWIS_hydrograph * Mod_hydrograph*textbox_hv*RMSE_hv*Error_hv*MAPE_hv*KGE_hv).opts(width=600, legend_position='top_left', tools=['hover']) + (Mod_NWIS_Scatter*Mod_NWIS_one2one).opts(shared_axes = False))
+            else:
+                print('No data for NWIS site: ', str(NWIS_site_lab), ' skipping.')
+
+
+    def Site_Browser(self, max_points = downsample.MAX_POINTS, cache_size = 32):
+        #site selector showing one site at a time, a site's plot is built when it is first
+        #selected and the most recently viewed plots are kept
+        plots = memo.Result_Cache(maxsize = cache_size)
+
+        def site_plot(NWIS_site_id):
+            plot = plots.get(NWIS_site_id)
+            if plot is None:
+                i = int(np.flatnonzero(self.Eval['NWIS_site_id'] == NWIS_site_id)[0])
+                plot = self.Site_Plot(i, max_points)
+                if plot is None:
+                    empty = hv.Curve([]) * hv.Text(0, 0, 'No data for NWIS site: ' + str(NWIS_site_id))
+                    plot = (empty, empty)
+                plots.put(NWIS_site_id, plot)
+            return plot
+
+        #one DynamicMap per panel, holoviews shares the site selector between them
+        sites = list(self.Eval['NWIS_site_id'])
+        hydrographs = hv.DynamicMap(lambda NWIS_site_id: site_plot(NWIS_site_id)[0], kdims = ['NWIS_site_id'])
+        scatters = hv.DynamicMap(lambda NWIS_site_id: site_plot(NWIS_site_id)[1], kdims = ['NWIS_site_id'])
+        self.Browser = (hydrographs + scatters).redim.values(NWIS_site_id = sites)
+        display(self.Browser)
+        return self.Browser
+
+
+    def Report(self, out_dir = None, max_workers = None, max_points = downsample.MAX_POINTS, dpi = 100):
+        #render the figures of every site in self.Eval to disk with an index page, nothing is displayed
+        #run Interactive_Model_Eval or Score_Sites first so the evaluation and resampled pairs exist
+        if out_dir is None:
+            out_dir = os.path.join(self.cwd, 'Reports', self.model + '_' + self.freq)
+        title = self.model + ' ' + self.freqkeys[self.freq] + ' (' + self.units + ') evaluation'
+        return report.render_report(out_dir, self.Eval, self.NWIS_data_resampled, self.Mod_data_resampled,
+                                    self.model, self.units, title = title, max_workers = max_workers,
+                                    max_points = max_points, dpi = dpi)
 
-                else:
-                    print('No data for NWIS site: ', str(NWIS_site_lab), ' skipping.')
 
-            
     #streamstats does not get lat long, we need this to do any NWIS geospatial work
     #https://github.com/hyriver/HyRiver-examples/blob/main/notebooks/dam_impact.ipynb
     def more_StreamStats(self, state, cwd):
@@ -1036,7 +1248,7 @@ class LULC_Eval():
         
         
         #Map locations and scoring of sites
-    def Map_Plot_Eval(self, freq, df, size, supply):
+    def Map_Plot_Eval(self, freq, df, size, supply, n_boot = 0, water_year = False, lazy = False, map_dir = None, fast = False, max_points = downsample.MAX_POINTS):
         self.freq = freq
         self.df = df
         self.size = size
@@ -1047,54 +1259,14 @@ class LULC_Eval():
             self.units = 'Acre-Feet'
 
         yaxis = 'Streamflow (' + self.units +')'
+        if lazy and map_dir is None:
+            map_dir = os.path.join(self.cwd, 'Maps', self.model + '_' + self.freq)
         
         #Get data and prepare
         self.prepare_comparison(self.df)
 
-        #Adjust for different time intervals here
-        #Daily
-        if self.freq == 'D':
-            self.NWIS_data_resampled = self.NWIS_data.copy()
-            self.Mod_data_resampled = self.Mod_data.copy()
-
-
-        #Monthly, Quarterly, Annual
-        if self.freq !='D':
-            #NWIS
-            self.NWIS_data_resampled = self.NWIS_data.copy()*self.cfsday_AFday
-            self.NWIS_data_resampled = self.NWIS_data_resampled.resample(self.freq).sum()
-            #Modeled
-            self.Mod_data_resampled = self.Mod_data.copy()*self.cfsday_AFday
-            self.Mod_data_resampled = self.Mod_data_resampled.resample(self.freq).sum()
-            
-        if supply == True:
-            #NWIS
-            #Get Columns names
-            columns = self.NWIS_data_resampled.columns
-
-            #set up cumulative monthly values
-            self.NWIS_data_resampled['Year'] = self.NWIS_data_resampled.index.year
-
-            self.NWIS_CumSum = pd.DataFrame(columns=columns)
-
-            for site in columns:
-                self.NWIS_CumSum[site] = self.NWIS_data_resampled.groupby(['Year'])[site].cumsum()
-
-            #Model
-            #Get Columns names
-            columns = self.Mod_data_resampled.columns
-
-            #set up cumulative monthly values
-            self.Mod_data_resampled['Year'] = self.Mod_data_resampled.index.year
-
-            self.Mod_CumSum = pd.DataFrame(columns=columns)
-
-            for site in columns:
-                self.Mod_CumSum[site] = self.Mod_data_resampled.groupby(['Year'])[site].cumsum()
-                
-            #set the Mod and NWIS resampled data == to the CumSum Df's
-            self.NWIS_data_resampled = self.NWIS_CumSum
-            self.Mod_data_resampled =self.Mod_CumSum
+        #resample the site pairs, reusing memoized results from earlier calls
+        self.resample_pairs(self.freq, supply, self.df['NWIS_site_id'], self.df['NHD_reachid'], water_year)
 
         print('Plotting monitoring station locations')
         cols =  ['NWIS_site_id', 'NWIS_sitename', 'NHD_reachid', 'dec_lat_va', 'dec_long_va', 'geometry']
@@ -1117,13 +1289,31 @@ class LULC_Eval():
         colormap.caption = 'Model Performance (KGE)'
         m.add_child(colormap)
 
-        ax = AxisProperties(
-        labels=PropertySet(
-            angle=ValueRef(value=300),
-            align=ValueRef(value='right')
+        ax = vincent.AxisProperties(
+        labels=vincent.PropertySet(
+            angle=vincent.ValueRef(value=300),
+            align=vincent.ValueRef(value='right')
                 )
             )
 
+        #score every mapped site in one NaN-skipping kernel pass
+        obs, mod = metrics.site_matrices(self.NWIS_data_resampled, self.Mod_data_resampled,
+                                         self.df_map['NWIS_site_id'], self.df_map['NHD_reachid'])
+        mask = metrics.validity_mask(obs, mod)
+        #floored as in Score_Sites, so the map and the metrics table show the same KGE
+        self.Map_scores = skill_kernels.skill_scores(obs, mod, mask, floor = 0.01)
+        if n_boot > 0:
+            self.Map_scores = self.Map_scores.join(metrics.kge_bootstrap(obs, mod, mask, n_boot = n_boot))
+
+        if fast:
+            #every scored site goes in one clustered layer, colored by KGE class without a per-site loop
+            if lazy:
+                site_map.write_series(os.path.join(map_dir, 'series'), self.df_map, self.NWIS_data_resampled,
+                                      self.Mod_data_resampled, self.model, self.units, self.Map_scores,
+                                      max_points = max_points)
+            m.add_child(site_map.score_layer(self.df_map, self.Map_scores, colormap, lazy = lazy))
+            return site_map.show_map(m, lazy, map_dir)
+
         for i in np.arange(0, len(self.df_map),1):
             #get site information
             site = self.df_map['NWIS_site_id'][i]
@@ -1138,50 +1328,45 @@ class LULC_Eval():
             df = df.rename(columns = {site: USGSsite})
             df[Modreach] = pd.DataFrame(self.Mod_data_resampled[reach])
             
-            #this evaluates the model only on NWIS observations
-            df_narem = pd.DataFrame()
-            df_narem['obs'] = self.NWIS_data_resampled[site].astype('float64')
-            df_narem['mod'] = self.Mod_data_resampled[reach].astype('float64')
-            
-            #remove locations with no usgs observations for time period -remove na values or 0, 
-            df_narem = df_narem[df_narem>=0]
-            df_narem.dropna(inplace = True)
-            
-            if len(df_narem)>=1:
-            
-               # df_narem['error'] = df_narem['obs'] - df_narem['mod']
-               # df_narem['P_error'] = abs(df_narem['error']/df_narem['obs'])*100
-                #drop inf values
-                df_narem.replace([np.inf, -np.inf], np.nan, inplace = True)
-                df_narem.dropna(inplace = True)
+            if self.Map_scores['n'][i] >= 1:
 
-                obs = df_narem['obs']
-                mod = df_narem['mod']
-
-                #calculate scoring
-                kge, r, alpha, beta = he.evaluator(he.kge, mod.astype('float32'), obs.astype('float32'))
+                kge = self.Map_scores['KGE'][i]
+                tooltip = None
+                if n_boot > 0:
+                    tooltip = 'KGE: ' + str(round(kge, 2)) + ' (' + str(round(self.Map_scores['KGE_lower'][i], 2)) + ' to ' + str(round(self.Map_scores['KGE_upper'][i], 2)) + ')'
 
                  #set the color of marker by model performance
                 #Marker color options ['red', 'blue', 'green', 'purple', 'orange', 'darkred', 'lightred', 'beige', 'darkblue', 'darkgreen', 'cadetblue', 'darkpurple', 'white', 'pink', 'lightblue', 'lightgreen', 'gray', 'black', 'lightgray']
 
-                if kge[0] > 0.30:
+                if kge > 0.30:
                     color = 'green'
 
-                elif kge[0] > 0.0:
+                elif kge > 0.0:
                     color = 'lightgreen'
 
-                elif kge[0] > -0.40:
+                elif kge > -0.40:
                     color = 'orange'
 
                 else:
                     color = 'red'
 
 
+                if lazy:
+                    #only the site id and KGE go in the page, the series is loaded when the popup opens
+                    site_map.write_site_series(os.path.join(map_dir, 'series'), site,
+                                               site_map.series_payload(downsample.downsample_frame(df, max_points), site_name, self.units))
+                    tooltip = USGSsite + ', ' + (tooltip if tooltip is not None else 'KGE: ' + str(round(kge, 2)))
+                    mk = features.Marker([self.df_map['dec_lat_va'][i], self.df_map['dec_long_va'][i]],
+                                         icon=folium.Icon(color=color, icon = 'fa-navicon', prefix = 'fa'), tooltip = tooltip)
+                    mk.add_child(site_map.lazy_popup(site))
+                    m.add_child(mk)
+                    continue
+
                 title_size = 14
                 
                 self.dff = df
                 #create graph and convert to json
-                graph = vincent.Line(df, height=300, width=500)
+                graph = vincent.Line(downsample.downsample_frame(df, max_points), height=300, width=500)
                 graph.axis_titles(x='Datetime', y=yaxis)
                 graph.legend(title= site_name)
                 graph.colors(brew='Set1')
@@ -1195,7 +1380,7 @@ class LULC_Eval():
                 #Add marker with point to map, https://fontawesome.com/v4/cheatsheet/
                 lat = self.df_map['dec_lat_va'][i]
                 long = self.df_map['dec_long_va'][i]
-                mk = features.Marker([lat, long], icon=folium.Icon(color=color, icon = 'fa-navicon', prefix = 'fa'))
+                mk = features.Marker([lat, long], icon=folium.Icon(color=color, icon = 'fa-navicon', prefix = 'fa'), tooltip = tooltip)
                 p = folium.Popup("Hello")
                 v = features.Vega(data, width="100%", height="100%")
 
@@ -1204,4 +1389,4 @@ class LULC_Eval():
                 m.add_child(mk)
 
 
-        display(m)
+        return site_map.show_map(m, lazy, map_dir)
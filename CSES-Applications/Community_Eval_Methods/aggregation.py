@@ -0,0 +1,104 @@
+# Script to aggregate streamflow matrices (time x site) for water supply evaluation
+# All sites are aggregated together with whole-frame operations instead of per-column loops.
+
+import numpy as np
+import pandas as pd
+
+
+def water_year(index):
+    """
+    Water year of each timestamp, October through September named by the ending year
+    Arguments:
+    ----------
+    index (pandas.DatetimeIndex): Timestamps
+    Returns
+    -------
+    (numpy.array): Water year per timestamp
+    """
+    index = pd.DatetimeIndex(index)
+    return index.year + (index.month >= 10)
+
+
+def supply_cumsum(df, water_year_segments = False):
+    """
+    Cumulative flow volume within each year for every column at once
+    Arguments:
+    ----------
+    df (pandas.dataframe): Flows or volumes indexed by Datetime, one column per site
+    water_year_segments (bool): Restart the sums each October (water year) instead of each January
+    Returns
+    -------
+    (pandas.dataframe): Year-to-date cumulative values with the same index and columns
+    """
+    if water_year_segments == True:
+        segments = water_year(df.index)
+    else:
+        segments = df.index.year
+    return df.groupby(np.asarray(segments)).cumsum()
+
+
+class Aggregation_Pyramid():
+    """
+    Daily, monthly, quarterly and annual aggregates of a daily flow matrix, built once
+    Each level is derived from the one below it (D -> M -> Q -> A and A-SEP), so switching
+    the evaluation frequency is a lookup instead of a resample of the daily record.
+    Every level holds the volume sum (acre-feet), the mean flow (cfs), the number of
+    valid (non-NaN) days and the number of days of the record in each period. Periods
+    without any valid day are NaN instead of 0.
+    Arguments:
+    ----------
+    data (pandas.dataframe): Daily flows (cfs) indexed by Datetime, one column per site, NaN where missing
+    cfsday_AFday (float): Acre-feet per cfs-day
+    """
+    parents = {'M': 'D', 'Q': 'M', 'A': 'Q', 'A-SEP': 'Q'}
+
+    def __init__(self, data, cfsday_AFday = 1.983):
+        self.data = data
+        self.index = data.index
+        self.shape = data.shape
+        self.cfsday_AFday = cfsday_AFday
+
+        #volumes are computed and accumulated in float64 even when the daily flows are float32
+        data = data.apply(pd.to_numeric, errors = 'coerce').astype('float64')
+        self.levels = {'D': {
+            'sum': data*cfsday_AFday,
+            'count': data.notna().astype('int32')
+        }}
+        #calendar days of the record in each period, partial first and last periods included
+        days = pd.Series(1, index = pd.date_range(pd.DatetimeIndex(self.index).min().normalize(),
+                                                  pd.DatetimeIndex(self.index).max().normalize(), freq = 'D'))
+        self.levels['D']['days'] = pd.Series(1, index = data.index, dtype = 'int32')
+        for freq in ['M', 'Q', 'A', 'A-SEP']:
+            parent = self.levels[self.parents[freq]]
+            count = parent['count'].resample(freq).sum()
+            total = parent['sum'].resample(freq).sum()
+            self.levels[freq] = {'sum': total.where(count > 0), 'count': count,
+                                 'days': days.resample(freq).sum().reindex(count.index).fillna(0).astype('int32')}
+        for level in self.levels.values():
+            level['mean'] = level['sum'] / cfsday_AFday / level['count'].where(level['count'] > 0)
+
+    def matches(self, data):
+        #the pyramid is still current if the daily frame and its index were not replaced
+        return data is self.data and data.index is self.index and data.shape == self.shape
+
+    def level(self, freq, stat = 'sum', columns = None, complete = False):
+        """
+        Look up one aggregate
+        Arguments:
+        ----------
+        freq (str): 'D', 'M', 'Q', 'A' or 'A-SEP' for water years
+        stat (str): 'sum' (acre-feet), 'mean' (cfs of valid days) or 'count' (valid days)
+        columns (list): Optional columns to return, missing ones are NaN
+        complete (bool): Set periods missing any day of the record to NaN, so volumes of
+            a gappy series are not compared with volumes summed over every day
+        Returns
+        -------
+        (pandas.dataframe): Aggregate indexed by period end
+        """
+        level = self.levels[freq]
+        frame = level[stat]
+        if complete and stat != 'count':
+            frame = frame.where(level['count'].ge(level['days'], axis = 0))
+        if columns is not None:
+            frame = frame.reindex(columns = columns)
+        return frame
@@ -0,0 +1,73 @@
+# Script to align observed and modeled series on one shared time index
+# Series are joined by date instead of by position, so a site with gaps or a shorter
+# record can never shift against the other series, and coverage is reported per site.
+
+import pandas as pd
+
+
+def shared_index(startDT, endDT, freq = 'D', offset = '12h'):
+    """
+    Shared time index of an evaluation window
+    Arguments:
+    ----------
+    startDT (str): Start date
+    endDT (str): End date (inclusive)
+    freq (str): Time step of the index
+    offset (str): Time of day the daily values are stamped at
+    Returns
+    -------
+    (pandas.DatetimeIndex): Index named Datetime
+    """
+    index = pd.date_range(pd.to_datetime(startDT), pd.to_datetime(endDT), freq = freq) + pd.Timedelta(offset)
+    return index.rename('Datetime')
+
+
+def align(series, index, columns = None):
+    """
+    Join many series onto a shared daily index by date
+    Timestamps are matched on the calendar day, values sharing a day are averaged.
+    Arguments:
+    ----------
+    series (dict): Column name -> pandas.Series indexed by datetime
+    index (pandas.DatetimeIndex): Shared index from shared_index
+    columns (list): Optional column order, names without a series are all NaN
+    Returns
+    -------
+    (pandas.dataframe, pandas.dataframe): Aligned frame and its coverage report
+    """
+    days = {}
+    for name, s in series.items():
+        s = pd.to_numeric(s, errors = 'coerce')
+        day = pd.DatetimeIndex(s.index).normalize()
+        days[name] = s.groupby(day).mean() if not day.is_unique else s.set_axis(day)
+
+    if len(days) > 0:
+        frame = pd.concat(days, axis = 1).reindex(index.normalize())
+    else:
+        frame = pd.DataFrame(index = index.normalize())
+    frame.index = index
+    if columns is not None:
+        frame = frame.reindex(columns = list(dict.fromkeys(columns)))
+    return frame, coverage(frame)
+
+
+def coverage(frame):
+    """
+    Per-column data coverage of an aligned frame
+    Arguments:
+    ----------
+    frame (pandas.dataframe): Aligned frame, NaN where a series has no value
+    Returns
+    -------
+    (pandas.dataframe): n_valid, coverage fraction, first and last valid timestamp per column
+    """
+    valid = frame.notna()
+    has_data = valid.any()
+    report = pd.DataFrame({
+        'n_valid': valid.sum(),
+        'coverage': valid.mean(),
+        'first': valid.idxmax().where(has_data),
+        'last': valid[::-1].idxmax().where(has_data)
+    })
+    report.index.name = 'site'
+    return report
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Script to run state, HUC and reach evaluations without a notebook
+# A run spec names the model, the sites (states, HUC ids or lists of USGS sites), the date
+# window, the frequencies and the supply mode. Every state, HUC group or site list is one job
+# run in a worker process, writing a metrics table per frequency and optionally a report.
+# Run from the CSES-Applications directory: python -m Community_Eval_Methods.batch spec.json
+#
+# Example spec:
+# {"model": "NWM_v2.1", "startDT": "2015-01-01", "endDT": "2015-12-31",
+#  "freqs": ["D", "M"], "supply": false,
+#  "states": ["ut"], "hucs": ["1602", ["1601", "1603"]],
+#  "nwis": {"provo": ["10163000", "10155500"]},
+#  "out_dir": "Results", "report": true}
+
+import os
+import json
+import time
+import argparse
+import traceback
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from Community_Eval_Methods import metrics, downsample
+
+#spec keys and their defaults, model, startDT, endDT and at least one selector are required
+DEFAULTS = {
+    'model': None,
+    'startDT': None,
+    'endDT': None,
+    #site selectors, a list of state abbreviations, a list of HUC ids (a nested list is one
+    #job over several HUCs of the same level) and lists of USGS sites, optionally named
+    'states': [],
+    'hucs': [],
+    'nwis': {},
+    'freqs': ['D'],
+    'supply': False,
+    'water_year': False,
+    #metrics scored, defaults to the class metric set
+    'metrics': None,
+    'n_boot': 0,
+    #state runs: category used to drop sites without a value, and optional categories
+    #whose jenks classes are also written as one sweep table per frequency
+    'category': 'Drainage_area_mi2',
+    'categories': [],
+    'cwd': None,
+    #read and write series through the local HDF5 stores under cwd/Data/cache
+    'cache': False,
+    'cache_dir': None,
+    'out_dir': 'Results',
+    'report': False,
+    'max_points': downsample.MAX_POINTS,
+    'dpi': 100,
+    'workers': None,
+}
+
+FREQS = ['D', 'M', 'Q', 'A']
+
+
+def load_spec(path = None, **overrides):
+    """
+    Read a run spec and fill in the defaults
+    Arguments:
+    ----------
+    path (str): Optional JSON file with the spec
+    overrides: Spec keys set on the command line, None values are ignored
+    Returns
+    -------
+    (dict): Complete run spec
+    """
+    spec = dict(DEFAULTS)
+    if path is not None:
+        with open(path) as f:
+            given = json.load(f)
+        unknown = sorted(set(given) - set(DEFAULTS))
+        if len(unknown) > 0:
+            raise ValueError('Unknown run spec keys: ' + ', '.join(unknown))
+        spec.update(given)
+    spec.update({key: value for key, value in overrides.items() if value is not None})
+
+    for key in ['model', 'startDT', 'endDT']:
+        if spec[key] is None:
+            raise ValueError('The run spec needs a ' + key)
+    if len(spec['states']) + len(spec['hucs']) + len(spec['nwis']) == 0:
+        raise ValueError('The run spec needs states, hucs or nwis sites to evaluate')
+    unknown = [freq for freq in spec['freqs'] if freq not in FREQS]
+    if len(unknown) > 0:
+        raise ValueError('Unknown frequencies: ' + ', '.join(unknown) + '. Choose from ' + ', '.join(FREQS))
+    if spec['metrics'] is not None:
+        metrics.check_metrics(spec['metrics'])
+    #lists of sites without a name are numbered
+    if not isinstance(spec['nwis'], dict):
+        spec['nwis'] = {str(i): sites for i, sites in enumerate(spec['nwis'])}
+    if spec['cwd'] is None:
+        spec['cwd'] = os.getcwd()
+    return spec
+
+
+def make_jobs(spec):
+    """
+    Split a run spec into independent jobs
+    Arguments:
+    ----------
+    spec (dict): Run spec from load_spec
+    Returns
+    -------
+    (list): (kind, name, selector) of every job, kind is 'state', 'huc' or 'reach'
+    """
+    jobs = [('state', 'state_' + state.lower(), state.lower()) for state in spec['states']]
+    for hucs in spec['hucs']:
+        hucs = [str(huc) for huc in ([hucs] if isinstance(hucs, (str, int)) else hucs)]
+        jobs.append(('huc', 'huc_' + '_'.join(hucs), hucs))
+    for name, sites in spec['nwis'].items():
+        jobs.append(('reach', 'reach_' + str(name), [str(site) for site in sites]))
+    return jobs
+
+
+def load_evaluation(kind, selector, spec):
+    #the notebook steps of each evaluation up to loading the observed and modeled series
+    if kind == 'state':
+        from Community_Eval_Methods import State_Eval
+        ev = State_Eval.LULC_Eval(spec['model'], selector, spec['startDT'], spec['endDT'], spec['cwd'],
+                                  cache_dir = spec['cache_dir'])
+        ev.get_NWIS()
+        ev.get_NHD_Model_info()
+        ev.class_eval_state(spec['category'])
+        ev.prepare_comparison(ev.df, cache = spec['cache'])
+    elif kind == 'huc':
+        from Community_Eval_Methods import HUC_Eval
+        ev = HUC_Eval.HUC_Eval(spec['model'], selector, spec['startDT'], spec['endDT'], spec['cwd'],
+                               cache_dir = spec['cache_dir'])
+        ev.Join_WBD_StreamStats()
+        ev.get_NHD_Model_info()
+        ev.prepare_comparison(cache = spec['cache'])
+    else:
+        from Community_Eval_Methods import Reach_Eval
+        ev = Reach_Eval.Reach_Eval(spec['model'], selector, spec['startDT'], spec['endDT'], spec['cwd'],
+                                   cache_dir = spec['cache_dir'])
+        ev.get_NHD_Model_info()
+        ev.prepare_comparison(cache = spec['cache'])
+    return ev
+
+
+def run_job(job, spec):
+    """
+    Evaluate one job at every frequency of the spec, runs in a worker process
+    Arguments:
+    ----------
+    job (tuple): (kind, name, selector) from make_jobs
+    spec (dict): Run spec from load_spec
+    Returns
+    -------
+    (dict): Job summary with the number of scored sites, the written files and any error
+    """
+    kind, name, selector = job
+    job_dir = os.path.join(spec['out_dir'], name)
+    os.makedirs(job_dir, exist_ok = True)
+    summary = {'job': name, 'kind': kind, 'sites': 0, 'files': [], 'seconds': 0.0, 'error': None}
+    t0 = time.perf_counter()
+    try:
+        ev = load_evaluation(kind, selector, spec)
+        for freq in spec['freqs']:
+            prefix = os.path.join(job_dir, spec['model'] + '_' + freq)
+            Eval = ev.Score_Sites(freq, spec['supply'], spec['metrics'], spec['n_boot'], spec['water_year'])
+            Eval.to_csv(prefix + '_metrics.csv', index = False)
+            summary['files'].append(prefix + '_metrics.csv')
+            summary['sites'] = max(summary['sites'], len(Eval))
+            #the report draws the pairs resampled by Score_Sites, so it is rendered before the sweep
+            if spec['report']:
+                summary['files'].append(ev.Report(out_dir = prefix + '_report', max_workers = 1,
+                                                  max_points = spec['max_points'], dpi = spec['dpi']))
+            if kind == 'state' and len(spec['categories']) > 0:
+                sweep = ev.Category_Sweep(spec['categories'], freq, spec['supply'], spec['metrics'],
+                                          water_year = spec['water_year'])
+                sweep.to_csv(prefix + '_sweep.csv')
+                summary['files'].append(prefix + '_sweep.csv')
+    except Exception:
+        #one failing state or site list does not stop the other jobs
+        summary['error'] = traceback.format_exc()
+    summary['seconds'] = round(time.perf_counter() - t0, 1)
+    return summary
+
+
+def run_batch(spec):
+    """
+    Run every job of a spec in a process pool and write a summary of the run
+    Arguments:
+    ----------
+    spec (dict): Run spec from load_spec
+    Returns
+    -------
+    (pandas.dataframe): One row per job with its site count, run time, files and error
+    """
+    jobs = make_jobs(spec)
+    workers = spec['workers'] if spec['workers'] is not None else min(len(jobs), os.cpu_count() or 1)
+    if spec['cache'] and workers > 1:
+        #the HDF5 stores are shared by all jobs and do not support concurrent writers
+        print('Local cache stores are not safe for concurrent writes, running the jobs one at a time')
+        workers = 1
+    os.makedirs(spec['out_dir'], exist_ok = True)
+    print('Running ', len(jobs), ' evaluation jobs on ', workers, ' workers')
+
+    results = []
+    if workers == 1:
+        for job in jobs:
+            results.append(run_job(job, spec))
+            print_summary(results[-1])
+    else:
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            futures = [pool.submit(run_job, job, spec) for job in jobs]
+            for future in as_completed(futures):
+                results.append(future.result())
+                print_summary(results[-1])
+
+    summary = pd.DataFrame(results).sort_values('job').reset_index(drop = True)
+    summary['files'] = summary['files'].str.join(';')
+    summary.to_csv(os.path.join(spec['out_dir'], 'runs.csv'), index = False)
+    return summary
+
+
+def print_summary(result):
+    if result['error'] is None:
+        print(result['job'], ': ', result['sites'], ' sites scored in ', result['seconds'], ' s')
+    else:
+        print(result['job'], ': failed after ', result['seconds'], ' s')
+        print(result['error'])
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Batch state, HUC and reach streamflow evaluations')
+    parser.add_argument('spec', nargs = '?', help = 'JSON run spec, options given here override it')
+    parser.add_argument('--model')
+    parser.add_argument('--start', dest = 'startDT', help = 'YYYY-MM-DD')
+    parser.add_argument('--end', dest = 'endDT', help = 'YYYY-MM-DD')
+    parser.add_argument('--states', nargs = '+', help = 'State abbreviations, one job each')
+    parser.add_argument('--hucs', nargs = '+', help = 'HUC ids, one job each')
+    parser.add_argument('--nwis', nargs = '+', help = 'USGS site ids, evaluated as one job')
+    parser.add_argument('--freqs', nargs = '+', help = 'Any of ' + ', '.join(FREQS))
+    parser.add_argument('--supply', action = 'store_true', default = None, help = 'Evaluate cumulative water supply')
+    parser.add_argument('--water-year', dest = 'water_year', action = 'store_true', default = None)
+    parser.add_argument('--metrics', nargs = '+')
+    parser.add_argument('--categories', nargs = '+', help = 'State runs, categories written as sweep tables')
+    parser.add_argument('--cache', action = 'store_true', default = None, help = 'Use the local HDF5 stores under cwd/Data/cache')
+    parser.add_argument('--cache-dir', dest = 'cache_dir', help = 'Directory of persisted evaluation results')
+    parser.add_argument('--out-dir', dest = 'out_dir')
+    parser.add_argument('--report', action = 'store_true', default = None, help = 'Also render a report per job and frequency')
+    parser.add_argument('--workers', type = int)
+    args = vars(parser.parse_args(argv))
+
+    path = args.pop('spec')
+    if args['nwis'] is not None:
+        args['nwis'] = {'sites': args['nwis']}
+    spec = load_spec(path, **args)
+    summary = run_batch(spec)
+    failed = summary['error'].notna().sum()
+    print(len(summary) - failed, ' of ', len(summary), ' jobs finished, summary saved to ',
+          os.path.join(spec['out_dir'], 'runs.csv'))
+    return 1 if failed > 0 else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,69 @@
+# Script to classify catchments into size classes with Jenks natural breaks
+# Breaks are computed on a quantile sample for large inputs and cached per (state, category),
+# and sites are labeled with one categorical column instead of one dataframe per class.
+
+import numpy as np
+import pandas as pd
+import jenkspy
+from Community_Eval_Methods import memo
+
+SIZE_LABELS = ['vsmall', 'small', 'medium', 'large', 'vlarge']
+
+#breaks already computed in this session
+BREAKS_CACHE = memo.Result_Cache(maxsize = 256)
+
+
+def natural_breaks(values, n_classes = 5, max_samples = 5000):
+    """
+    Fisher-Jenks natural breaks, on an evenly spaced quantile sample when the input is large
+    The sample always keeps the minimum and maximum, so the outer breaks are exact.
+    Arguments:
+    ----------
+    values (list): Values to classify, NaN and inf are ignored
+    n_classes (int): Number of classes
+    max_samples (int): Largest number of values passed to the exact algorithm
+    Returns
+    -------
+    (list): n_classes + 1 break values from the minimum to the maximum
+    """
+    values = np.sort(np.asarray(values, dtype = 'float64'))
+    values = values[np.isfinite(values)]
+    if len(values) > max_samples:
+        values = values[np.linspace(0, len(values) - 1, max_samples).round().astype('int64')]
+    return [float(b) for b in jenkspy.jenks_breaks(values, n_classes = n_classes)]
+
+
+def cached_breaks(key, values, n_classes = 5, max_samples = 5000):
+    """
+    Natural breaks memoized on a key such as (state, category) and the values themselves
+    Arguments:
+    ----------
+    key (tuple): Identifies the classification, e.g. (state, category)
+    values (pandas.Series): Values to classify
+    n_classes (int): Number of classes
+    max_samples (int): Largest number of values passed to the exact algorithm
+    Returns
+    -------
+    (list): n_classes + 1 break values
+    """
+    cache_key = memo.make_key(key, n_classes, max_samples, memo.data_version(pd.Series(values).reset_index(drop = True)))
+    breaks = BREAKS_CACHE.get(cache_key)
+    if breaks is None:
+        breaks = natural_breaks(values, n_classes, max_samples)
+        BREAKS_CACHE.put(cache_key, breaks)
+    return breaks
+
+
+def size_classes(values, breaks, labels = SIZE_LABELS):
+    """
+    Label every value with its class
+    Arguments:
+    ----------
+    values (pandas.Series): Values to classify
+    breaks (list): Class breaks from natural_breaks
+    labels (list): One label per class
+    Returns
+    -------
+    (pandas.Series): Categorical class labels
+    """
+    return pd.cut(values, bins = breaks, labels = labels, include_lowest = True)
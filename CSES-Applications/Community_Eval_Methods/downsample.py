@@ -0,0 +1,105 @@
+# Script with a shape-preserving downsampler for plotted hydrographs
+# Largest-triangle-three-buckets keeps the point of each bucket that spans the largest
+# triangle with its neighbours, so peaks and recessions survive while a 40-year daily
+# record is drawn with a few thousand points. Only plots use it, metrics keep the full data.
+
+import numpy as np
+import pandas as pd
+
+try:
+    from numba import njit
+except ImportError:
+    #numba is optional, without it the kernel runs as plain Python
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+#default number of points per plotted series
+MAX_POINTS = 2000
+
+
+@njit(cache = True)
+def lttb_indices(x, y, n_out):
+    """
+    Positions of the points kept by largest-triangle-three-buckets
+    Arguments:
+    ----------
+    x (numpy.array): Increasing x values (e.g. time as float), no NaN
+    y (numpy.array): y values, no NaN
+    n_out (int): Number of points to keep, the first and last point are always kept
+    Returns
+    -------
+    (numpy.array): Sorted positions of the kept points
+    """
+    n = x.shape[0]
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    out = np.empty(n_out, dtype = np.int64)
+    out[0] = 0
+    out[n_out-1] = n-1
+    every = (n-2) / (n_out-2)
+    a = 0
+    for i in range(n_out-2):
+        start = int(np.floor(i*every)) + 1
+        end = int(np.floor((i+1)*every)) + 1
+        #average of the next bucket, the last point for the final bucket
+        next_end = min(int(np.floor((i+2)*every)) + 1, n)
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+
+        best = start
+        max_area = -1.0
+        for j in range(start, end):
+            area = abs((x[a]-avg_x)*(y[j]-y[a]) - (x[a]-x[j])*(avg_y-y[a]))
+            if area > max_area:
+                max_area = area
+                best = j
+        out[i+1] = best
+        a = best
+    return out
+
+
+def lttb(x, y, n_out = MAX_POINTS):
+    """
+    Downsample one series with largest-triangle-three-buckets
+    Arguments:
+    ----------
+    x (numpy.array): Increasing x values, datetimes are allowed
+    y (numpy.array): y values, NaN values are dropped first
+    n_out (int): Number of points to keep
+    Returns
+    -------
+    (numpy.array, numpy.array): Kept x and y values
+    """
+    x = np.asarray(x)
+    y = np.asarray(y, dtype = 'float64')
+    valid = ~np.isnan(y)
+    x, y = x[valid], y[valid]
+    keep = lttb_indices(x.astype('float64'), y, n_out)
+    return x[keep], y[keep]
+
+
+def downsample_frame(df, n_out = MAX_POINTS):
+    """
+    Downsample the columns of a time-indexed frame for plotting
+    Each column keeps its own LTTB points, the frame keeps the union of them so
+    every column's shape is preserved. NaN gaps are skipped, not bridged by extra points.
+    Arguments:
+    ----------
+    df (pandas.dataframe): Indexed by Datetime, one column per series
+    n_out (int): Number of points kept per column, None keeps everything
+    Returns
+    -------
+    (pandas.dataframe): Rows of df at the kept points
+    """
+    if n_out is None or len(df) <= n_out:
+        return df
+    x = pd.DatetimeIndex(df.index).asi8.astype('float64')
+    keep = []
+    for col in df.columns:
+        y = df[col].to_numpy(dtype = 'float64', na_value = np.nan)
+        valid = np.flatnonzero(~np.isnan(y))
+        keep.append(valid[lttb_indices(x[valid], y[valid], n_out)])
+    return df.iloc[np.unique(np.concatenate(keep))]
@@ -0,0 +1,45 @@
+# Script with deferred imports for the heavy, optional dependencies of the evaluation modules
+# A Lazy_Module stands in for a module at import time and imports the real one on first
+# attribute access, so batch jobs that only load data and compute metrics never import
+# the plotting, mapping or web-service stacks.
+
+import importlib
+
+
+class Lazy_Module():
+    """
+    Module stand-in that is imported on first use
+    Arguments:
+    ----------
+    name (str): Full module name, e.g. 'matplotlib.pyplot'
+    setup (function): Optional, called once with the module right after it is imported
+    """
+    def __init__(self, name, setup = None):
+        self.__dict__['_name'] = name
+        self.__dict__['_setup'] = setup
+        self.__dict__['_module'] = None
+
+    def load(self):
+        #import the module, running the setup the first time
+        if self._module is None:
+            module = importlib.import_module(self._name)
+            if self._setup is not None:
+                self._setup(module)
+            self.__dict__['_module'] = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self.load(), attr, value)
+
+    def __repr__(self):
+        state = 'imported' if self._module is not None else 'not imported'
+        return '<lazy module ' + repr(self._name) + ', ' + state + '>'
+
+
+def display(*objs, **kwargs):
+    #IPython is only imported when something is shown
+    from IPython.display import display as ipython_display
+    return ipython_display(*objs, **kwargs)
@@ -0,0 +1,88 @@
+# Script to memoize evaluation results across method calls
+# Results are kept in an in-memory LRU and optionally persisted to disk, keyed on
+# everything that determines them, including a digest of the underlying data.
+
+import os
+import hashlib
+import pandas as pd
+from collections import OrderedDict
+
+
+def make_key(*parts):
+    """
+    Build a stable cache key from the values that determine a result
+    Arguments:
+    ----------
+    parts: Any values with a stable repr, e.g. site, reach, startDT, endDT, freq, supply
+    Returns
+    -------
+    (str): Hex digest of the parts
+    """
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def data_version(series):
+    """
+    Digest of a series' index and values, changes whenever the data changes
+    Arguments:
+    ----------
+    series (pandas.Series): Data the cached results are derived from
+    Returns
+    -------
+    (str): Hex digest of the series
+    """
+    return hashlib.sha1(pd.util.hash_pandas_object(series, index = True).values.tobytes()).hexdigest()
+
+
+class Result_Cache():
+    """
+    Least-recently-used cache of evaluation results with optional disk persistence
+    Arguments:
+    ----------
+    maxsize (int): Number of results kept in memory
+    path (str): Optional directory, results are also pickled there and reloaded on a miss
+    """
+    def __init__(self, maxsize = 1024, path = None):
+        self.maxsize = maxsize
+        self.path = path
+        self.items = OrderedDict()
+        if self.path is not None:
+            os.makedirs(self.path, exist_ok = True)
+
+    def file(self, key):
+        return os.path.join(self.path, key + '.pkl')
+
+    def get(self, key):
+        """
+        Look up a result, None if it has not been computed
+        Arguments:
+        ----------
+        key (str): Key from make_key
+        """
+        if key in self.items:
+            self.items.move_to_end(key)
+            return self.items[key]
+        if self.path is not None and os.path.exists(self.file(key)):
+            value = pd.read_pickle(self.file(key))
+            self.put(key, value, persist = False)
+            return value
+        return None
+
+    def put(self, key, value, persist = True):
+        """
+        Store a result, evicting the least recently used one when full
+        Arguments:
+        ----------
+        key (str): Key from make_key
+        value: Result to keep, must be picklable when a path is set
+        persist (bool): Also write the result to disk when a path is set
+        """
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last = False)
+        if persist and self.path is not None:
+            pd.to_pickle(value, self.file(key))
+
+    def clear(self):
+        self.items.clear()
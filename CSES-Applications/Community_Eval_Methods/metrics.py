@@ -0,0 +1,451 @@
+# Script to score modeled vs. observed streamflow for many sites at once
+# Works on aligned (time x site) obs and model matrices with a validity mask, so
+# every site is scored with masked NumPy reductions instead of a per-site loop.
+# skill_kernels computes the same statistics in single-pass JIT kernels, changes to a
+# metric definition here go there too.
+
+import warnings
+import numpy as np
+import pandas as pd
+
+
+def site_matrices(NWIS_data, Mod_data, NWIS_sites, reaches):
+    """
+    Build aligned (time x site) obs and model matrices for paired NWIS sites and model reaches
+    The model series are aligned onto the NWIS index, matching the per-site dataframes.
+    Arguments:
+    ----------
+    NWIS_data (pandas.dataframe): NWIS flows with one column per USGS site
+    Mod_data (pandas.dataframe): Model flows with one column per NHD reach
+    NWIS_sites (list): USGS site ids, one per evaluated pair
+    reaches (list): NHD reach ids, paired with NWIS_sites
+    Returns
+    -------
+    (numpy.array, numpy.array): obs and model float32 matrices of shape (time, site), NaN where missing
+    """
+    obs = NWIS_data.reindex(columns = list(NWIS_sites))
+    mod = Mod_data.reindex(index = NWIS_data.index, columns = list(reaches))
+    obs = obs.apply(pd.to_numeric, errors = 'coerce').to_numpy(dtype = 'float32')
+    mod = mod.apply(pd.to_numeric, errors = 'coerce').to_numpy(dtype = 'float32')
+    return obs, mod
+
+
+def long_table(NWIS_data, Mod_data, NWIS_sites, reaches, model_column = 'model_flow_cfs'):
+    """
+    Typed long-format table with one (site, reach, Datetime, obs, model) row per time step and pair
+    Rows are site-major, flows are float32 and the ids are categorical.
+    Arguments:
+    ----------
+    NWIS_data (pandas.dataframe): NWIS flows with one column per USGS site
+    Mod_data (pandas.dataframe): Model flows with one column per NHD reach
+    NWIS_sites (list): USGS site ids, one per evaluated pair
+    reaches (list): NHD reach ids, paired with NWIS_sites
+    model_column (str): Name of the model flow column
+    Returns
+    -------
+    (pandas.dataframe): Columns NWIS_site_id, NHD_reachid, Datetime, NWIS_flow_cfs and model_column
+    """
+    obs, mod = site_matrices(NWIS_data, Mod_data, NWIS_sites, reaches)
+    n_steps, n_sites = obs.shape
+    sites, site_codes = np.unique(np.asarray(list(NWIS_sites)).astype(str), return_inverse = True)
+    reach_ids, reach_codes = np.unique(np.asarray(list(reaches)).astype(str), return_inverse = True)
+
+    #the transpose of a column-major matrix flattens site by site without a copy
+    return pd.DataFrame({
+        'NWIS_site_id': pd.Categorical.from_codes(np.repeat(site_codes, n_steps), categories = sites),
+        'NHD_reachid': pd.Categorical.from_codes(np.repeat(reach_codes, n_steps), categories = reach_ids),
+        'Datetime': np.tile(pd.DatetimeIndex(NWIS_data.index).values, n_sites),
+        'NWIS_flow_cfs': np.asfortranarray(obs).T.reshape(-1),
+        model_column: np.asfortranarray(mod).T.reshape(-1)
+    })
+
+
+def validity_mask(obs, mod, strict = False):
+    """
+    Mask of time steps to evaluate, gaps (NaN) and negative values are excluded
+    Arguments:
+    ----------
+    obs (numpy.array): Observed flows (time x site)
+    mod (numpy.array): Modeled flows (time x site)
+    strict (bool): If True zero flows are also excluded
+    Returns
+    -------
+    (numpy.array): Boolean mask (time x site)
+    """
+    with np.errstate(invalid = 'ignore'):
+        if strict == True:
+            mask = (obs > 0) & (mod > 0)
+        else:
+            mask = (obs >= 0) & (mod >= 0)
+    return mask & np.isfinite(obs) & np.isfinite(mod)
+
+
+#every metric evaluate can return, and the set scored when none is requested
+#the bias metrics PBIAS, FHV and FLV share the hydroeval sign convention,
+#100*(obs - model)/obs, so they are positive when the model underpredicts
+METRICS = ['RMSE', 'MaxError', 'MAPE', 'KGE', 'r', 'alpha', 'beta', 'KGEprime',
+           'NSE', 'logNSE', 'PBIAS', 'FHV', 'FLV']
+DEFAULT_METRICS = ['RMSE', 'MaxError', 'MAPE', 'KGE', 'r', 'alpha', 'beta']
+
+
+def sufficient_statistics(obs, mod, mask, epsilon = 0.01):
+    """
+    Per-site sums, centered sums of squares and cross products shared by all metrics
+    Arguments:
+    ----------
+    obs (numpy.array): Observed flows (time x site)
+    mod (numpy.array): Modeled flows (time x site)
+    mask (numpy.array): Boolean validity mask (time x site)
+    epsilon (float): Offset added before taking logs for log-NSE
+    Returns
+    -------
+    (dict): Statistic name -> per-site numpy.array
+    """
+    obs = np.where(mask, obs, 0)
+    mod = np.where(mask, mod, 0)
+    error = obs - mod
+    n = mask.sum(axis = 0)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        log_obs = np.where(mask, np.log(obs + epsilon), 0)
+        log_mod = np.where(mask, np.log(mod + epsilon), 0)
+        ape = np.where(mask, np.abs(error / obs)*100, 0)
+        sum_o = obs.sum(axis = 0)
+        sum_m = mod.sum(axis = 0)
+        sum_lo = log_obs.sum(axis = 0)
+        obs_dev = np.where(mask, obs - sum_o/n, 0)
+        mod_dev = np.where(mask, mod - sum_m/n, 0)
+        log_dev = np.where(mask, log_obs - sum_lo/n, 0)
+
+    return {
+        'n': n,
+        'sum_o': sum_o,
+        'sum_m': sum_m,
+        'ss_o': (obs_dev*obs_dev).sum(axis = 0),
+        'ss_m': (mod_dev*mod_dev).sum(axis = 0),
+        'ss_om': (obs_dev*mod_dev).sum(axis = 0),
+        'sse': (error*error).sum(axis = 0),
+        'min_err': np.where(mask, error, np.inf).min(axis = 0, initial = np.inf),
+        'max_err': np.where(mask, error, -np.inf).max(axis = 0, initial = -np.inf),
+        'sum_ape': ape.sum(axis = 0),
+        'sum_lo': sum_lo,
+        'ss_lo': (log_dev*log_dev).sum(axis = 0),
+        'sse_log': ((log_obs - log_mod)**2).sum(axis = 0)
+    }
+
+
+def merge_statistics(a, b):
+    """
+    Combine the sufficient statistics of two disjoint sets of time steps
+    Centered moments are merged with the pairwise update of Chan et al. (1979).
+    Arguments:
+    ----------
+    a (dict): Output of sufficient_statistics for the first set
+    b (dict): Output of sufficient_statistics for the second set
+    Returns
+    -------
+    (dict): Statistics of the union
+    """
+    n = a['n'] + b['n']
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        #weight of the difference in means, 0 when either side is empty
+        w = np.where(n > 0, a['n']*b['n'] / n, 0)
+        d_o = np.nan_to_num(b['sum_o']/b['n'] - a['sum_o']/a['n'])
+        d_m = np.nan_to_num(b['sum_m']/b['n'] - a['sum_m']/a['n'])
+        d_lo = np.nan_to_num(b['sum_lo']/b['n'] - a['sum_lo']/a['n'])
+
+    merged = {key: a[key] + b[key] for key in ['sum_o', 'sum_m', 'sse', 'sum_ape', 'sum_lo', 'sse_log']}
+    merged['n'] = n
+    merged['ss_o'] = a['ss_o'] + b['ss_o'] + d_o*d_o*w
+    merged['ss_m'] = a['ss_m'] + b['ss_m'] + d_m*d_m*w
+    merged['ss_om'] = a['ss_om'] + b['ss_om'] + d_o*d_m*w
+    merged['ss_lo'] = a['ss_lo'] + b['ss_lo'] + d_lo*d_lo*w
+    merged['min_err'] = np.minimum(a['min_err'], b['min_err'])
+    merged['max_err'] = np.maximum(a['max_err'], b['max_err'])
+    return merged
+
+
+def kge_components(stats):
+    """
+    Kling-Gupta Efficiency and its components for every site, following hydroeval.kge
+    Arguments:
+    ----------
+    stats (dict): Sufficient statistics with n, sum_o, sum_m, ss_o, ss_m and ss_om
+    Returns
+    -------
+    (numpy.array, numpy.array, numpy.array, numpy.array): kge, r, alpha, beta per site
+    """
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        r = stats['ss_om'] / np.sqrt(stats['ss_o']*stats['ss_m'])
+        alpha = np.sqrt(stats['ss_m'] / stats['ss_o'])
+        beta = stats['sum_m'] / stats['sum_o']
+        kge = 1 - np.sqrt((r - 1)**2 + (alpha - 1)**2 + (beta - 1)**2)
+    return kge, r, alpha, beta
+
+
+def segment_biases(obs, mod, mask, high = 0.02, low = 0.3):
+    """
+    Percent biases of the high- and low-flow segments of the flow duration curves
+    Each site's valid obs and model flows are sorted once. FHV is the volume bias of the
+    highest `high` fraction of exceedance. FLV is the bias of the lowest `low` fraction in
+    log space, measured above each curve's minimum flow (Yilmaz et al., 2008). Both are
+    positive when the model underpredicts, as PBIAS. Flows must be positive, evaluate
+    raises them to its floor first.
+    Arguments:
+    ----------
+    obs (numpy.array): Observed flows (time x site)
+    mod (numpy.array): Modeled flows (time x site)
+    mask (numpy.array): Boolean validity mask (time x site)
+    high (float): Exceedance fraction of the high-flow segment
+    low (float): Exceedance fraction of the low-flow segment
+    Returns
+    -------
+    (numpy.array, numpy.array): FHV and FLV per site in percent
+    """
+    #descending flow duration curves, invalid steps sorted to the end as NaN
+    obs_fdc = -np.sort(-np.where(mask, obs, np.nan), axis = 0)
+    mod_fdc = -np.sort(-np.where(mask, mod, np.nan), axis = 0)
+    n = mask.sum(axis = 0)
+    rank = np.arange(obs.shape[0])[:, None]
+
+    n_high = np.maximum(np.floor(n*high), 1)
+    n_low = np.maximum(np.floor(n*low), 1)
+    high_seg = rank < n_high
+    low_seg = (rank >= n - n_low) & (rank < n)
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        obs_high = np.where(high_seg, obs_fdc, 0).sum(axis = 0)
+        mod_high = np.where(high_seg, mod_fdc, 0).sum(axis = 0)
+        fhv = 100*(obs_high - mod_high) / obs_high
+
+        #log flows of the low segment above the segment minimum, the last valid rank
+        last = np.maximum(n - 1, 0)[None, :]
+        log_obs, log_mod = np.log(obs_fdc), np.log(mod_fdc)
+        obs_low = np.where(low_seg, log_obs - np.take_along_axis(log_obs, last, axis = 0), 0).sum(axis = 0)
+        mod_low = np.where(low_seg, log_mod - np.take_along_axis(log_mod, last, axis = 0), 0).sum(axis = 0)
+        flv = 100*(obs_low - mod_low) / obs_low
+    fhv[n == 0] = np.nan
+    #a flat observed low-flow segment has no shape to compare against
+    flv[(n == 0) | (obs_low == 0)] = np.nan
+    return fhv, flv
+
+
+def scores_from_statistics(stats, metric_set = DEFAULT_METRICS):
+    """
+    Compute the requested metrics from the shared sufficient statistics
+    Arguments:
+    ----------
+    stats (dict): Output of sufficient_statistics or merge_statistics
+    metric_set (list): Metric names, any of METRICS except FHV and FLV
+    Returns
+    -------
+    (dict): Metric name -> per-site numpy.array
+    """
+    n = stats['n']
+    kge, r, alpha, beta = kge_components(stats)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        available = {
+            'RMSE': lambda: np.round(np.sqrt(stats['sse'] / n)),
+            'MaxError': lambda: np.round(np.maximum(np.abs(stats['min_err']), np.abs(stats['max_err']))),
+            'MAPE': lambda: stats['sum_ape'] / n,
+            'KGE': lambda: kge,
+            'r': lambda: r,
+            'alpha': lambda: alpha,
+            'beta': lambda: beta,
+            #Kling et al. (2012), variability as the ratio of coefficients of variation
+            'KGEprime': lambda: 1 - np.sqrt((r - 1)**2 + (alpha/beta - 1)**2 + (beta - 1)**2),
+            'NSE': lambda: 1 - stats['sse'] / stats['ss_o'],
+            'logNSE': lambda: 1 - stats['sse_log'] / stats['ss_lo'],
+            'PBIAS': lambda: 100*(stats['sum_o'] - stats['sum_m']) / stats['sum_o']
+        }
+        return {metric: available[metric]() for metric in metric_set}
+
+
+def check_metrics(metric_set, allowed = METRICS):
+    unknown = [metric for metric in metric_set if metric not in allowed]
+    if len(unknown) > 0:
+        raise ValueError('Unknown metrics: ' + ', '.join(unknown) + '. Choose from ' + ', '.join(allowed))
+
+
+def score_table(scores, n, metric_set):
+    #one row per site, sites without observations get the sentinel scores
+    scores = pd.DataFrame({metric: scores[metric] for metric in metric_set})
+    scores['n'] = n
+    empty = scores['n'] == 0
+    scores.loc[empty, [m for m in ['RMSE', 'MaxError', 'MAPE'] if m in metric_set]] = 0
+    if 'KGE' in metric_set:
+        scores.loc[empty, 'KGE'] = -10000
+    return scores
+
+
+def evaluate(obs, mod, mask, floor = 0.01, metric_set = DEFAULT_METRICS, epsilon = 0.01):
+    """
+    Score every site at once with a configurable set of metrics
+    All metrics come from one set of sums and cross products, FHV and FLV from one sort.
+    Valid values below floor are raised to floor before scoring, as in the per-site evaluation.
+    Sites without any valid time step get RMSE, MaxError and MAPE of 0 and a KGE of -10000.
+    Arguments:
+    ----------
+    obs (numpy.array): Observed flows (time x site)
+    mod (numpy.array): Modeled flows (time x site)
+    mask (numpy.array): Boolean validity mask (time x site)
+    floor (float): Minimum flow used for scoring
+    metric_set (list): Metric names from METRICS, scored in this order
+    epsilon (float): Offset added before taking logs for log-NSE
+    Returns
+    -------
+    (pandas.dataframe): One row per site with the requested metrics and n
+    """
+    check_metrics(metric_set)
+
+    #matrices may be stored as float32, reductions run in float64
+    obs = np.where(mask, np.maximum(obs, floor), np.nan).astype('float64')
+    mod = np.where(mask, np.maximum(mod, floor), np.nan).astype('float64')
+    stats = sufficient_statistics(obs, mod, mask, epsilon)
+    scores = scores_from_statistics(stats, [m for m in metric_set if m not in ['FHV', 'FLV']])
+    if 'FHV' in metric_set or 'FLV' in metric_set:
+        scores['FHV'], scores['FLV'] = segment_biases(obs, mod, mask)
+    return score_table(scores, stats['n'], metric_set)
+
+
+def pooled_scores(obs, mod, metric_set = DEFAULT_METRICS, floor = 0.01):
+    """
+    Score all rows of a long table together as one sample
+    Arguments:
+    ----------
+    obs (numpy.array): Observed flows, one per row
+    mod (numpy.array): Modeled flows, one per row
+    metric_set (list): Metric names from METRICS
+    floor (float): Minimum flow used for scoring
+    Returns
+    -------
+    (pandas.Series): Pooled metrics and n
+    """
+    obs = np.asarray(obs)[:, None]
+    mod = np.asarray(mod)[:, None]
+    return evaluate(obs, mod, validity_mask(obs, mod), floor, metric_set).iloc[0]
+
+
+def kge_bootstrap(obs, mod, mask, n_boot = 1000, block = None, ci = 0.9, seed = 42, floor = 0.01):
+    """
+    Moving-block bootstrap confidence interval of KGE for every site at once
+    Blocks of consecutive time steps are drawn with one (replicate x time) index matrix
+    shared by all sites. Each replicate's sums are a count-weighted product with the
+    per-step terms, so the whole bootstrap is a few matrix multiplications.
+    Arguments:
+    ----------
+    obs (numpy.array): Observed flows (time x site)
+    mod (numpy.array): Modeled flows (time x site)
+    mask (numpy.array): Boolean validity mask (time x site)
+    n_boot (int): Number of bootstrap replicates
+    block (int): Block length in time steps, defaults to the cube root of the record length
+    ci (float): Central coverage of the interval, e.g. 0.9 for the 5th to 95th percentile
+    seed (int): Random seed so intervals are reproducible
+    floor (float): Minimum flow used for scoring, None scores the flows as given.
+        Use the floor of the point KGE the interval is reported with.
+    Returns
+    -------
+    (pandas.dataframe): One row per site with KGE_lower, KGE_median and KGE_upper
+    """
+    if floor is not None:
+        obs = np.maximum(obs, floor)
+        mod = np.maximum(mod, floor)
+    obs = np.where(mask, obs, 0).astype('float64')
+    mod = np.where(mask, mod, 0).astype('float64')
+    valid = mask.astype('float64')
+    n_steps = obs.shape[0]
+    if block is None:
+        block = max(1, int(round(n_steps**(1/3))))
+    block = min(block, n_steps)
+
+    #(replicate x time) resampled indices, blocks wrap around the end of the record
+    rng = np.random.default_rng(seed)
+    n_blocks = int(np.ceil(n_steps / block))
+    starts = rng.integers(0, n_steps, (n_boot, n_blocks))
+    index = ((starts[:, :, None] + np.arange(block)) % n_steps).reshape(n_boot, -1)[:, :n_steps]
+
+    #number of times each time step is drawn in each replicate
+    rows = np.repeat(np.arange(n_boot), n_steps)
+    weights = np.bincount(rows*n_steps + index.ravel(), minlength = n_boot*n_steps).reshape(n_boot, n_steps).astype('float64')
+
+    n = weights @ valid
+    sum_o = weights @ obs
+    sum_m = weights @ mod
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        stats = {
+            'sum_o': sum_o,
+            'sum_m': sum_m,
+            'ss_o': weights @ (obs*obs) - sum_o**2 / n,
+            'ss_m': weights @ (mod*mod) - sum_m**2 / n,
+            'ss_om': weights @ (obs*mod) - sum_o*sum_m / n
+        }
+    kge = kge_components(stats)[0]
+
+    tail = (1 - ci) / 2
+    with warnings.catch_warnings():
+        #sites without observations have an all-NaN distribution
+        warnings.simplefilter('ignore', category = RuntimeWarning)
+        lower, median, upper = np.nanquantile(kge, [tail, 0.5, 1 - tail], axis = 0)
+    return pd.DataFrame({'KGE_lower': lower, 'KGE_median': median, 'KGE_upper': upper})
+
+
+class Metric_Accumulator():
+    """
+    Mergeable running statistics for scoring sites chunk by chunk
+    Time chunks of the aligned obs and model matrices are reduced to sufficient statistics
+    as they arrive and merged with the running totals, so the full record is never held
+    in memory. Accumulators from separate workers or site groups over the same sites can
+    be merged with merge.
+    Arguments:
+    ----------
+    n_sites (int): Number of site columns in every chunk
+    floor (float): Minimum flow used for scoring
+    epsilon (float): Offset added before taking logs for log-NSE
+    """
+    def __init__(self, n_sites, floor = 0.01, epsilon = 0.01):
+        self.n_sites = n_sites
+        self.floor = floor
+        self.epsilon = epsilon
+        empty = np.zeros((0, n_sites))
+        self.stats = sufficient_statistics(empty, empty, empty.astype(bool), epsilon)
+
+    def update(self, obs, mod, mask = None):
+        """
+        Add one time chunk of aligned flows to the running statistics
+        Arguments:
+        ----------
+        obs (numpy.array): Observed flows (time x site)
+        mod (numpy.array): Modeled flows (time x site)
+        mask (numpy.array): Optional boolean validity mask, validity_mask(obs, mod) if None
+        """
+        if mask is None:
+            mask = validity_mask(obs, mod)
+        obs = np.where(mask, np.maximum(obs, self.floor), np.nan).astype('float64')
+        mod = np.where(mask, np.maximum(mod, self.floor), np.nan).astype('float64')
+        self.stats = merge_statistics(self.stats, sufficient_statistics(obs, mod, mask, self.epsilon))
+
+    def merge(self, other):
+        """
+        Fold in the statistics of another accumulator over the same sites
+        Arguments:
+        ----------
+        other (Metric_Accumulator): Accumulator over disjoint time steps
+        Returns
+        -------
+        (Metric_Accumulator): self, so merges can be chained
+        """
+        self.stats = merge_statistics(self.stats, other.stats)
+        return self
+
+    def result(self, metric_set = DEFAULT_METRICS):
+        """
+        Score every site from the statistics accumulated so far
+        FHV and FLV need the full flow duration curves and cannot be accumulated.
+        Arguments:
+        ----------
+        metric_set (list): Metric names from METRICS except FHV and FLV
+        Returns
+        -------
+        (pandas.dataframe): One row per site with the requested metrics and n
+        """
+        check_metrics(metric_set, [m for m in METRICS if m not in ['FHV', 'FLV']])
+        return score_table(scores_from_statistics(self.stats, metric_set), self.stats['n'], metric_set)
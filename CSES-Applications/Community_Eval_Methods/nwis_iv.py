@@ -0,0 +1,286 @@
+# Script to retrieve USGS NWIS instantaneous values (IV) for many sites at once
+# Sites are grouped into multi-site requests and long date ranges are split into
+# time chunks that are requested in parallel over one pooled HTTP session.
+
+import pandas as pd
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+
+IV_URL = 'https://waterservices.usgs.gov/nwis/iv/'
+
+#columns returned by hydrotools IVDataService, kept so downstream code is unchanged
+IV_COLUMNS = ['value_time', 'variable_name', 'usgs_site_code', 'measurement_unit', 'value', 'qualifiers', 'series']
+
+
+def get_session(max_workers = 8):
+    """
+    Create a requests session with a connection pool sized for the worker threads
+    Arguments:
+    ----------
+    max_workers (int): Number of threads that will share the session
+    Returns
+    -------
+    (requests.Session): Session with pooled keep-alive connections
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections = max_workers, pool_maxsize = max_workers, max_retries = 3)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def site_batches(sites, batch_size):
+    """
+    Split a list of USGS site ids into multi-site request groups
+    Arguments:
+    ----------
+    sites (list): USGS site ids
+    batch_size (int): Maximum number of sites per request
+    Returns
+    -------
+    (list): List of site id lists
+    """
+    sites = [str(site) for site in sites]
+    return [sites[i:i+batch_size] for i in np.arange(0, len(sites), batch_size)]
+
+
+def date_chunks(startDT, endDT, chunk_days):
+    """
+    Split an inclusive date window into consecutive, non-overlapping chunks
+    Arguments:
+    ----------
+    startDT (str): Start date
+    endDT (str): End date (inclusive)
+    chunk_days (int): Number of days per chunk
+    Returns
+    -------
+    (list): Ordered list of (start, end) date strings in "YYYY-MM-DD" format
+    """
+    starts = pd.date_range(pd.to_datetime(startDT), pd.to_datetime(endDT), freq = str(chunk_days)+'D')
+    ends = list(starts[1:] - pd.Timedelta(days = 1)) + [pd.to_datetime(endDT)]
+    return [(s.strftime('%Y-%m-%d'), e.strftime('%Y-%m-%d')) for s, e in zip(starts, ends)]
+
+
+def parse_iv_json(payload):
+    """
+    Convert a WaterML-JSON IV response into a long dataframe
+    Arguments:
+    ----------
+    payload (dict): Decoded JSON response from the NWIS IV service
+    Returns
+    -------
+    (pandas.dataframe): One row per observation with the hydrotools IVDataService columns
+    """
+    frames = []
+    for ts in payload['value']['timeSeries']:
+        site = ts['sourceInfo']['siteCode'][0]['value']
+        variable = ts['variable']['variableName']
+        unit = ts['variable']['unit']['unitCode']
+        nodata = ts['variable'].get('noDataValue', None)
+
+        for series, block in enumerate(ts['values']):
+            if len(block['value']) == 0:
+                continue
+            df = pd.DataFrame(block['value'])
+            df['value'] = df['value'].astype('float32')
+            if nodata is not None:
+                df.loc[df['value'] == nodata, 'value'] = np.nan
+            df['value_time'] = pd.to_datetime(df['dateTime'], utc = True).dt.tz_localize(None)
+            df['qualifiers'] = df['qualifiers'].astype(str)
+            df['variable_name'] = variable
+            df['usgs_site_code'] = site
+            df['measurement_unit'] = unit
+            df['series'] = series
+            frames.append(df[IV_COLUMNS])
+
+    if len(frames) == 0:
+        return pd.DataFrame(columns = IV_COLUMNS)
+    return pd.concat(frames, ignore_index = True)
+
+
+def get_iv_request(session, sites, startDT, endDT, parameterCd = '00060'):
+    """
+    Request IV data for a group of sites over one date window
+    Arguments:
+    ----------
+    session (requests.Session): Shared HTTP session
+    sites (list): USGS site ids for one multi-site request
+    startDT (str): Start date in "YYYY-MM-DD" format
+    endDT (str): End date in "YYYY-MM-DD" format
+    parameterCd (str): NWIS parameter code, default is discharge
+    Returns
+    -------
+    (pandas.dataframe): Long dataframe of observations for the request
+    """
+    params = {
+        'format': 'json',
+        'sites': ','.join(sites),
+        'startDT': startDT,
+        'endDT': endDT,
+        'parameterCd': parameterCd,
+        'siteStatus': 'all'
+    }
+    response = session.get(IV_URL, params = params, timeout = 120)
+    response.raise_for_status()
+    return parse_iv_json(response.json())
+
+
+def iter_iv_batch(sites, startDT, endDT, batch_size = 50, chunk_days = 365, max_workers = 8, parameterCd = '00060', session = None):
+    """
+    Stream IV data for many sites one (site group, time chunk) request at a time
+    Requests run in a thread pool over one pooled session, but only a bounded number
+    are held in memory at once and they are yielded in site group and time order.
+    Arguments:
+    ----------
+    sites (list): USGS site ids
+    startDT (str): Start date
+    endDT (str): End date (inclusive)
+    batch_size (int): Maximum number of sites per request
+    chunk_days (int): Number of days per time chunk
+    max_workers (int): Number of concurrent requests
+    parameterCd (str): NWIS parameter code, default is discharge
+    session (requests.Session): Optional session to reuse, one is created if None
+    Returns
+    -------
+    (generator): Long dataframes with the hydrotools IVDataService columns
+    """
+    if session is None:
+        session = get_session(max_workers)
+
+    tasks = [(batch, chunk) for batch in site_batches(sites, batch_size)
+             for chunk in date_chunks(startDT, endDT, chunk_days)]
+
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        pending = []
+        for batch, chunk in tasks:
+            pending.append(executor.submit(get_iv_request, session, batch, chunk[0], chunk[1], parameterCd))
+            #keep at most two rounds of requests in flight
+            if len(pending) >= 2*max_workers:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+def get_iv_batch(sites, startDT, endDT, batch_size = 50, chunk_days = 365, max_workers = 8, parameterCd = '00060', session = None):
+    """
+    Get IV data for many sites using multi-site requests and parallel time chunks
+    Each (site group, time chunk) request runs in a thread pool over one pooled session
+    and the results are stitched back together in site and time order.
+    Arguments:
+    ----------
+    sites (list): USGS site ids
+    startDT (str): Start date
+    endDT (str): End date (inclusive)
+    batch_size (int): Maximum number of sites per request
+    chunk_days (int): Number of days per time chunk
+    max_workers (int): Number of concurrent requests
+    parameterCd (str): NWIS parameter code, default is discharge
+    session (requests.Session): Optional session to reuse, one is created if None
+    Returns
+    -------
+    (pandas.dataframe): Long dataframe with the hydrotools IVDataService columns
+    """
+    results = [r for r in iter_iv_batch(sites, startDT, endDT, batch_size, chunk_days, max_workers, parameterCd, session) if len(r) > 0]
+    if len(results) == 0:
+        return pd.DataFrame(columns = IV_COLUMNS)
+
+    usgs_data = pd.concat(results, ignore_index = True)
+    usgs_data = usgs_data.drop_duplicates(subset = ['usgs_site_code', 'series', 'value_time'])
+    usgs_data = usgs_data.sort_values(['usgs_site_code', 'value_time'], kind = 'mergesort').reset_index(drop = True)
+    return usgs_data
+
+
+def period_label(times, freq):
+    """
+    Label timestamps with the period they fall in, matching pd.Grouper labels
+    Arguments:
+    ----------
+    times (pandas.Series): Datetime values
+    freq (str): Temporal frequency ('D', 'M', 'Q', 'A')
+    Returns
+    -------
+    (pandas.Series): Period label, the period start for daily and the period end day otherwise
+    """
+    return times.dt.to_period(freq).dt.to_timestamp(how = 'end').dt.normalize()
+
+
+class IV_Reducer():
+    """
+    Streaming reducer from IV records to temporal means
+    Keeps a running sum and sample count per (site, period), so memory is bounded by
+    the number of output periods and not by the length of the 15-minute record.
+    Arguments:
+    ----------
+    freq (str): Temporal frequency ('D', 'M', 'Q', 'A')
+    interval (str): Nominal IV sampling interval, used to compute period coverage
+    """
+    def __init__(self, freq = 'D', interval = '15min'):
+        self.freq = freq
+        self.interval = pd.Timedelta(interval)
+        self.totals = None
+        self.site_info = {}
+
+    def update(self, usgs_data):
+        """
+        Add one chunk of IV records to the running sums and counts
+        Arguments:
+        ----------
+        usgs_data (pandas.dataframe): Long IV dataframe with value_time, value and usgs_site_code
+        """
+        usgs_data = usgs_data[usgs_data['value'].notna()]
+        if len(usgs_data) == 0:
+            return
+
+        for site, info in usgs_data.groupby('usgs_site_code', sort = False).first().iterrows():
+            if site not in self.site_info:
+                self.site_info[site] = {'variable': info['variable_name'], 'measurement_unit': info['measurement_unit']}
+
+        period = period_label(usgs_data['value_time'], self.freq)
+        chunk = usgs_data['value'].astype('float64').groupby([usgs_data['usgs_site_code'], period]).agg(['sum', 'count'])
+        chunk.index.names = ['USGS_ID', 'Datetime']
+
+        if self.totals is None:
+            self.totals = chunk
+        else:
+            self.totals = self.totals.add(chunk, fill_value = 0)
+
+    def result(self, startDT, endDT, min_coverage = 0.9):
+        """
+        Emit the aggregated series with per-period sample counts
+        Arguments:
+        ----------
+        startDT (str): Start date of the retrieval window
+        endDT (str): End date of the retrieval window
+        min_coverage (float): Fraction of expected samples below which a period is flagged partial
+        Returns
+        -------
+        (dict): USGS site id -> dataframe indexed by Datetime with USGS_flow, n_obs, expected, coverage and partial
+        """
+        periods = period_label(pd.Series(pd.date_range(pd.to_datetime(startDT), pd.to_datetime(endDT), freq = 'D')), self.freq).drop_duplicates()
+        index = pd.DatetimeIndex(periods, name = 'Datetime')
+
+        #expected number of samples in each period
+        starts = index.to_period(self.freq).start_time
+        ends = index.to_period(self.freq).end_time
+        expected = np.asarray((ends - starts + pd.Timedelta(1, 'ns')) / self.interval)
+
+        out = {}
+        if self.totals is None:
+            return out
+
+        for site, site_totals in self.totals.groupby(level = 'USGS_ID', sort = False):
+            site_totals = site_totals.droplevel('USGS_ID').reindex(index)
+            n_obs = site_totals['count'].fillna(0).astype('int64')
+            usgs_meanflow = pd.DataFrame(index = index)
+            usgs_meanflow['USGS_flow'] = site_totals['sum'] / n_obs.where(n_obs > 0)
+            usgs_meanflow['n_obs'] = n_obs
+            usgs_meanflow['expected'] = expected
+            usgs_meanflow['coverage'] = n_obs.values / expected
+            usgs_meanflow['partial'] = usgs_meanflow['coverage'] < min_coverage
+            usgs_meanflow['USGS_ID'] = site
+            usgs_meanflow['variable'] = self.site_info[site]['variable']
+            usgs_meanflow['measurement_unit'] = self.site_info[site]['measurement_unit']
+            out[site] = usgs_meanflow
+        return out
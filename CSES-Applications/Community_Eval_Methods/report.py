@@ -0,0 +1,308 @@
+# Script to render evaluation reports to disk without a notebook
+# Per-site hydrograph/scatter figures are drawn on the Agg canvas in a pool of worker
+# processes, each reusing one figure, and linked from a single index page with the
+# watershed characteristics vs. KGE panel, so a state's report can run as a batch job.
+
+import os
+import html
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import LogNorm
+from Community_Eval_Methods import downsample
+
+#characteristics plotted against KGE, one row of the 3 x 3 panel each
+CHARACTERISTICS = [['Drainage_area_mi2', 'Mean_Basin_Elev_ft', 'Perc_Forest'],
+                   ['Perc_Imperv', 'Perc_Herbace', 'Mean_Ann_Precip_in'],
+                   ['Ann_low_cfs', 'Ann_mean_cfs', 'Ann_hi_cfs']]
+
+#scores written on the site figures and in the index table, when present in the evaluation
+REPORT_METRICS = ['KGE', 'KGE_lower', 'KGE_upper', 'RMSE', 'MaxError', 'MAPE']
+
+#figure of the current worker process, reused for every site it renders
+SITE_FIGURE = None
+
+
+def site_figure():
+    global SITE_FIGURE
+    if SITE_FIGURE is None:
+        fig = Figure(figsize = (13, 4.5))
+        FigureCanvasAgg(fig)
+        axes = fig.subplots(1, 2, gridspec_kw = {'width_ratios': [2, 1]})
+        #fixed margins, a tight layout would draw every figure twice
+        fig.subplots_adjust(left = 0.06, right = 0.98, bottom = 0.12, top = 0.9, wspace = 0.22)
+        SITE_FIGURE = (fig, axes)
+    return SITE_FIGURE
+
+
+def render_site(task):
+    """
+    Draw one site's hydrograph and obs vs model scatter and save it as a PNG
+    Arguments:
+    ----------
+    task (dict): From site_tasks
+    Returns
+    -------
+    (str, str): USGS site id and the figure path relative to the report
+    """
+    fig, (ax_h, ax_s) = site_figure()
+    ax_h.cla()
+    ax_s.cla()
+    units = task['units']
+
+    ax_h.plot(task['plot_index'], task['plot_obs'], color = 'orange', lw = 0.8, label = task['obs_label'])
+    ax_h.plot(task['plot_index'], task['plot_mod'], color = 'blue', lw = 0.8, label = task['mod_label'])
+    ax_h.set_xlabel('Datetime')
+    ax_h.set_ylabel('Discharge (' + units + ')')
+    ax_h.legend(loc = 'upper left')
+    ax_h.text(0.99, 0.97, task['score_text'], transform = ax_h.transAxes, ha = 'right', va = 'top',
+              fontsize = 9, bbox = dict(facecolor = 'white', edgecolor = 'gray'))
+
+    ax_s.scatter(task['obs'], task['mod'], s = 4, color = 'blue')
+    flow_range = [min(task['obs'].min(), task['mod'].min()), max(task['obs'].max(), task['mod'].max())]
+    ax_s.plot(flow_range, flow_range, color = 'red', ls = '--')
+    ax_s.set_xlabel('Observed Discharge (' + units + ')')
+    ax_s.set_ylabel(task['model'] + ' Discharge (' + units + ')')
+
+    fig.suptitle(task['title'])
+    fig.savefig(os.path.join(task['out_dir'], task['file']), dpi = task['dpi'])
+    return task['site'], task['file']
+
+
+def score_text(row, units):
+    text = []
+    for metric in REPORT_METRICS:
+        if metric in row and not pd.isna(row[metric]):
+            unit = ' ' + units if metric in ['RMSE', 'MaxError'] else ('%' if metric == 'MAPE' else '')
+            text.append(metric + ': ' + str(round(float(row[metric]), 2)) + unit)
+    return '\n'.join(text)
+
+
+def site_tasks(Eval, obs, mod, out_dir, model, units, max_points = downsample.MAX_POINTS, dpi = 100):
+    """
+    Compact rendering tasks for the sites of an evaluation, sites without paired data are skipped
+    Arguments:
+    ----------
+    Eval (pandas.dataframe): Evaluation with NWIS_site_id, NHD_reachid, Location and scores
+    obs (pandas.dataframe): Observed flows, one column per USGS site
+    mod (pandas.dataframe): Modeled flows, one column per reach
+    out_dir (str): Report directory
+    model (str): Model name
+    units (str): Flow units, 'cfs' or 'Acre-Feet'
+    max_points (int): Number of LTTB points kept per plotted hydrograph
+    dpi (int): Resolution of the figures
+    Returns
+    -------
+    (list): One dict per site
+    """
+    tasks = []
+    for _, row in Eval.iterrows():
+        site, reach = row['NWIS_site_id'], row['NHD_reachid']
+        df = pd.DataFrame({'obs': obs[site], 'mod': mod[reach]}).dropna()
+        if len(df) == 0:
+            print('No data for NWIS site: ', str(site), ' skipping.')
+            continue
+        plot = downsample.downsample_frame(df, max_points)
+        tasks.append({'site': str(site),
+                      'file': os.path.join('sites', str(site) + '.png'),
+                      'out_dir': out_dir,
+                      'dpi': dpi,
+                      'model': model,
+                      'units': units,
+                      'title': 'USGS: ' + str(site) + ' ' + str(row.get('Location', '')) + ', ' + model + ': NHD ' + str(reach),
+                      'obs_label': 'USGS: ' + str(site),
+                      'mod_label': model + ': NHD ' + str(reach),
+                      'score_text': score_text(row, units),
+                      'plot_index': plot.index.values,
+                      'plot_obs': plot['obs'].values.astype('float32'),
+                      'plot_mod': plot['mod'].values.astype('float32'),
+                      'obs': df['obs'].values.astype('float32'),
+                      'mod': df['mod'].values.astype('float32')})
+    return tasks
+
+
+def render_characteristics(Eval, path, dpi = 100):
+    """
+    Save the watershed characteristics vs. KGE panel, KGE below -1 is shown as -1
+    Arguments:
+    ----------
+    Eval (pandas.dataframe): Evaluation with KGE and the CHARACTERISTICS columns
+    path (str): PNG file to write
+    dpi (int): Resolution of the figure
+    """
+    fig = Figure(figsize = (11, 11))
+    FigureCanvasAgg(fig)
+    ax = fig.subplots(3, 3)
+    fig.suptitle('Watershed Charcteristics vs. Model Performance', fontsize = 16)
+    for row, variables in enumerate(CHARACTERISTICS):
+        for col, variable in enumerate(variables):
+            if variable not in Eval:
+                ax[row, col].set_visible(False)
+                continue
+            df = Eval[['KGE', variable]].dropna()
+            x = df['KGE'].clip(lower = -1)
+            y = df[variable]
+            ax[row, col].scatter(x = x, y = y)
+            ax[row, col].set_ylabel(variable)
+            if row == len(CHARACTERISTICS)-1:
+                ax[row, col].set_xlabel('Model Performance (KGE)')
+            #trendline
+            if len(df) > 1 and x.nunique() > 1:
+                p = np.poly1d(np.polyfit(x, y, 1))
+                ax[row, col].plot(x, p(x), color = 'r', linestyle = '--')
+    fig.tight_layout()
+    fig.savefig(path, dpi = dpi)
+
+
+def pooled_density(obs, mod, bins = 200, floor = 0.01):
+    """
+    Count the (obs, model) pairs of all sites on a log-spaced 2-D grid
+    Arguments:
+    ----------
+    obs (numpy.array): Observed flows of every pair, NaN where missing
+    mod (numpy.array): Modeled flows of every pair, NaN where missing
+    bins (int): Number of bins per axis
+    floor (float): Minimum flow, values below are raised to it before taking logs
+    Returns
+    -------
+    (numpy.array, numpy.array): Counts (obs bin x model bin) and the shared flow bin edges
+    """
+    obs = np.asarray(obs, dtype = 'float64').ravel()
+    mod = np.asarray(mod, dtype = 'float64').ravel()
+    valid = ~(np.isnan(obs) | np.isnan(mod))
+    log_obs = np.log10(np.maximum(obs[valid], floor))
+    log_mod = np.log10(np.maximum(mod[valid], floor))
+    #one range for both axes so the 1:1 line is the diagonal
+    if len(log_obs) > 0:
+        low = min(log_obs.min(), log_mod.min())
+        high = max(log_obs.max(), log_mod.max())
+    else:
+        low, high = np.log10(floor), np.log10(floor) + 1
+    high = high if high > low else low + 1
+    edges = np.linspace(low, high, bins + 1)
+    #equal-width bins, so the bin of a value is computed directly and counted with bincount
+    scale = bins / (high - low)
+    i = np.minimum(((log_obs - low) * scale).astype('int64'), bins - 1)
+    j = np.minimum(((log_mod - low) * scale).astype('int64'), bins - 1)
+    counts = np.bincount(i * bins + j, minlength = bins * bins).reshape(bins, bins)
+    return counts, 10**edges
+
+
+def draw_density(fig, ax, obs, mod, model, units, bins = 200, floor = 0.01):
+    """
+    Draw all pooled (obs, model) pairs as a log-scaled 2-D histogram raster with a 1:1 line
+    Drawing time depends only on the number of bins, not on the number of pairs.
+    Arguments:
+    ----------
+    fig (matplotlib.figure.Figure): Figure holding ax, for the colorbar
+    ax (matplotlib.axes.Axes): Axes to draw on
+    obs (numpy.array): Observed flows of every pair
+    mod (numpy.array): Modeled flows of every pair
+    model (str): Model name
+    units (str): Flow units, 'cfs' or 'Acre-Feet'
+    bins (int): Number of bins per axis
+    floor (float): Minimum flow, values below are raised to it
+    """
+    counts, edges = pooled_density(obs, mod, bins, floor)
+    counts = np.where(counts > 0, counts, np.nan)
+    mesh = ax.pcolormesh(edges, edges, counts.T, norm = LogNorm(), cmap = 'viridis', rasterized = True)
+    ax.plot(edges[[0, -1]], edges[[0, -1]], ls = '--', c = 'red')
+    ax.set_xscale('log')
+    ax.set_yscale('log')
+    ax.set_xlabel('Observed USGS (' + units + ')')
+    ax.set_ylabel(model + ' Predictions (' + units + ')')
+    fig.colorbar(mesh, ax = ax, label = 'Number of pairs')
+
+
+def write_index(out_dir, Eval, figures, title, panels = None):
+    """
+    Write the report index page, one table row per site linking its figure
+    Arguments:
+    ----------
+    out_dir (str): Report directory
+    Eval (pandas.dataframe): Evaluation, rows in report order
+    figures (dict): Figure path relative to out_dir by USGS site id
+    title (str): Page heading
+    panels (list): Summary figure paths relative to out_dir, shown above the table
+    Returns
+    -------
+    (str): Path of the index page
+    """
+    metrics = [metric for metric in REPORT_METRICS if metric in Eval]
+    header = ''.join('<th>' + html.escape(col) + '</th>' for col in ['USGS site', 'Location', 'NHD reach'] + metrics + ['Figure'])
+    rows = []
+    for _, row in Eval.iterrows():
+        site = str(row['NWIS_site_id'])
+        cells = [site, str(row.get('Location', '')), str(row['NHD_reachid'])]
+        cells += ['' if pd.isna(row[metric]) else str(round(float(row[metric]), 2)) for metric in metrics]
+        cells = ''.join('<td>' + html.escape(cell) + '</td>' for cell in cells)
+        if site in figures:
+            src = html.escape(figures[site].replace(os.sep, '/'))
+            cells += '<td><a href="' + src + '"><img src="' + src + '" height="80"></a></td>'
+        else:
+            cells += '<td>No data</td>'
+        rows.append('<tr>' + cells + '</tr>')
+
+    page = ['<!DOCTYPE html>', '<html><head><meta charset="utf-8"><title>' + html.escape(title) + '</title>',
+            '<style>body{font-family:sans-serif} table{border-collapse:collapse} td,th{border:1px solid #ccc;padding:2px 6px}</style>',
+            '</head><body>', '<h1>' + html.escape(title) + '</h1>']
+    for panel in (panels if panels is not None else []):
+        page.append('<img src="' + html.escape(panel) + '" width="800">')
+    page += ['<table><tr>' + header + '</tr>'] + rows + ['</table></body></html>']
+
+    path = os.path.join(out_dir, 'index.html')
+    with open(path, 'w') as f:
+        f.write('\n'.join(page))
+    return path
+
+
+def render_report(out_dir, Eval, obs, mod, model, units, title = None, max_workers = None,
+                  max_points = downsample.MAX_POINTS, dpi = 100):
+    """
+    Render an evaluation's per-site figures and characteristics panel to disk with an index page
+    Arguments:
+    ----------
+    out_dir (str): Report directory, created if needed
+    Eval (pandas.dataframe): Evaluation with NWIS_site_id, NHD_reachid, Location and scores
+    obs (pandas.dataframe): Observed flows, one column per USGS site
+    mod (pandas.dataframe): Modeled flows, one column per reach
+    model (str): Model name
+    units (str): Flow units, 'cfs' or 'Acre-Feet'
+    title (str): Page heading
+    max_workers (int): Worker processes, 1 renders in this process
+    max_points (int): Number of LTTB points kept per plotted hydrograph
+    dpi (int): Resolution of the figures
+    Returns
+    -------
+    (str): Path of the index page
+    """
+    os.makedirs(os.path.join(out_dir, 'sites'), exist_ok = True)
+    title = model + ' evaluation' if title is None else title
+
+    panels = []
+    if 'KGE' in Eval and any(variable in Eval for variables in CHARACTERISTICS for variable in variables):
+        panels.append('characteristics.png')
+        render_characteristics(Eval, os.path.join(out_dir, 'characteristics.png'), dpi = dpi)
+
+    tasks = site_tasks(Eval, obs, mod, out_dir, model, units, max_points, dpi)
+    if len(tasks) > 0:
+        fig = Figure(figsize = (7, 5.5))
+        FigureCanvasAgg(fig)
+        ax = fig.subplots()
+        draw_density(fig, ax, np.concatenate([task['obs'] for task in tasks]),
+                     np.concatenate([task['mod'] for task in tasks]), model, units)
+        ax.set_title('All site pairs')
+        fig.savefig(os.path.join(out_dir, 'density.png'), dpi = dpi)
+        panels = panels + ['density.png']
+    if max_workers == 1:
+        figures = dict(map(render_site, tasks))
+    else:
+        workers = max_workers if max_workers is not None else (os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            figures = dict(pool.map(render_site, tasks, chunksize = max(1, len(tasks)//(4*workers))))
+
+    path = write_index(out_dir, Eval, figures, title, panels)
+    print('Report saved to ', path)
+    return path
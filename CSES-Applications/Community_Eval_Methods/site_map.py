@@ -0,0 +1,280 @@
+# Script to build folium gauge maps whose hydrographs load only when a popup opens
+# Markers carry just the site id and KGE. Each site's series is written to a small
+# script file next to the map and fetched the first time its popup is opened, so the
+# map build time and page weight do not grow with the length of the record.
+# National maps put every gauge in one clustered layer colored by KGE class.
+
+import os
+import json
+import numpy as np
+import pandas as pd
+import folium
+from folium.plugins import FastMarkerCluster
+from branca.element import MacroElement
+from jinja2 import Template
+from Community_Eval_Methods import downsample
+from IPython.display import display, IFrame
+
+#vega-lite renders the hydrograph in the browser once the series has arrived
+VEGA_SCRIPTS = ['https://cdn.jsdelivr.net/npm/vega@5',
+                'https://cdn.jsdelivr.net/npm/vega-lite@5',
+                'https://cdn.jsdelivr.net/npm/vega-embed@6']
+
+#sites scored but without a defined KGE, e.g. constant observations
+NO_SCORE_COLOR = '#808080'
+
+#marker for one row [lat, long, color, tooltip, site] of the clustered layer
+#the popup placeholder matches lazy_popup and is only bound when series were written
+LAYER_CALLBACK = """
+function (row) {
+    var marker = L.circleMarker(new L.LatLng(row[0], row[1]),
+        {radius: 6, color: row[2], fillColor: row[2], fillOpacity: 0.9, weight: 1});
+    marker.bindTooltip(row[3]);
+    if (row[4] !== null) {
+        marker.bindPopup('<div class="lazy-hydrograph" data-site="' + row[4] +
+            '" style="width:520px;height:340px">Loading USGS station ' + row[4] + '...</div>', {maxWidth: 540});
+    }
+    return marker;
+}
+"""
+
+
+def series_payload(df, site_name, units, decimals = 2):
+    """
+    Compact, JSON serializable form of one site's observed and modeled series
+    Arguments:
+    ----------
+    df (pandas.dataframe): Indexed by Datetime, first column observed, second modeled
+    site_name (str): Title of the hydrograph
+    units (str): Flow units, 'cfs' or 'Acre-Feet'
+    decimals (int): Flows are rounded to this many decimals
+    Returns
+    -------
+    (dict): Column labels, ISO dates and flows, missing flows as None
+    """
+    def values(col):
+        col = df[col].astype('float64').round(decimals)
+        return [None if np.isnan(v) else v for v in col.tolist()]
+
+    return {'name': site_name,
+            'units': units,
+            'labels': [str(col) for col in df.columns[:2]],
+            'dates': pd.DatetimeIndex(df.index).strftime('%Y-%m-%d').tolist(),
+            'obs': values(df.columns[0]),
+            'mod': values(df.columns[1])}
+
+
+def write_site_series(series_dir, site, payload):
+    """
+    Write one site's series as a script that hands it to the map when loaded
+    Script files, unlike JSON fetched with XHR, also load when the map is opened from disk.
+    Arguments:
+    ----------
+    series_dir (str): Directory next to the map holding the per-site files
+    site (str): USGS site id, used as the file name
+    payload (dict): Series from series_payload
+    """
+    os.makedirs(series_dir, exist_ok = True)
+    with open(os.path.join(series_dir, str(site) + '.js'), 'w') as f:
+        f.write('lazySiteSeries(' + json.dumps(str(site)) + ',' + json.dumps(payload, separators = (',', ':')) + ');')
+
+
+def lazy_popup(site, width = 520, height = 340):
+    """
+    Popup holding an empty placeholder, filled with the site's hydrograph when opened
+    Arguments:
+    ----------
+    site (str): USGS site id
+    width (int): Popup width in pixels
+    height (int): Popup height in pixels
+    Returns
+    -------
+    (folium.Popup)
+    """
+    html = ('<div class="lazy-hydrograph" data-site="' + str(site) + '" style="width:' + str(width) +
+            'px;height:' + str(height) + 'px">Loading USGS station ' + str(site) + '...</div>')
+    return folium.Popup(html, max_width = width + 20)
+
+
+class Lazy_Hydrographs(MacroElement):
+    """
+    Map element that loads and draws a site's hydrograph on the first opening of its popup
+    Arguments:
+    ----------
+    series_url (str): Location of the per-site files relative to the saved map
+    """
+    _template = Template(u"""
+        {% macro header(this, kwargs) %}
+            {% for src in this.scripts %}
+            <script src="{{ src }}"></script>
+            {% endfor %}
+        {% endmacro %}
+
+        {% macro script(this, kwargs) %}
+        (function() {
+            var map = {{ this._parent.get_name() }};
+            var base = {{ this.series_url|tojson }};
+            var loaded = {};
+            var pending = {};
+
+            function draw(div, s) {
+                var values = [];
+                for (var i = 0; i < s.dates.length; i++) {
+                    values.push({Datetime: s.dates[i], series: s.labels[0], flow: s.obs[i]});
+                    values.push({Datetime: s.dates[i], series: s.labels[1], flow: s.mod[i]});
+                }
+                div.innerHTML = '';
+                vegaEmbed(div, {
+                    $schema: 'https://vega.github.io/schema/vega-lite/v5.json',
+                    title: s.name, width: 'container', height: 'container',
+                    data: {values: values},
+                    mark: {type: 'line', strokeWidth: 1},
+                    encoding: {
+                        x: {field: 'Datetime', type: 'temporal', axis: {labelAngle: 300}},
+                        y: {field: 'flow', type: 'quantitative', title: 'Streamflow (' + s.units + ')'},
+                        color: {field: 'series', type: 'nominal', title: null,
+                                scale: {scheme: 'set1'}, legend: {orient: 'bottom'}}
+                    }
+                }, {actions: false});
+            }
+
+            window.lazySiteSeries = function(site, s) {
+                loaded[site] = s;
+                (pending[site] || []).forEach(function(div) { draw(div, s); });
+                delete pending[site];
+            };
+
+            map.on('popupopen', function(e) {
+                var div = e.popup.getElement().querySelector('.lazy-hydrograph');
+                if (!div || div.dataset.drawn) { return; }
+                div.dataset.drawn = 1;
+                var site = div.dataset.site;
+                if (loaded[site]) { draw(div, loaded[site]); return; }
+                if (pending[site]) { pending[site].push(div); return; }
+                pending[site] = [div];
+                var tag = document.createElement('script');
+                tag.src = base + '/' + encodeURIComponent(site) + '.js';
+                document.head.appendChild(tag);
+            });
+        })();
+        {% endmacro %}
+        """)
+
+    def __init__(self, series_url = 'series'):
+        super(Lazy_Hydrographs, self).__init__()
+        self._name = 'Lazy_Hydrographs'
+        self.series_url = series_url
+        self.scripts = VEGA_SCRIPTS
+
+
+def kge_colors(kge, colormap):
+    """
+    Color of every site's KGE class, classes are the steps of the map legend
+    A KGE above a break falls in the next class, as with the marker colors of the per-site maps.
+    Arguments:
+    ----------
+    kge (numpy.array): KGE of each site, NaN where undefined
+    colormap (branca.colormap.StepColormap): Legend with the class breaks in its index
+    Returns
+    -------
+    (numpy.array): Hex color of each site
+    """
+    kge = np.asarray(kge, dtype = 'float64')
+    palette = np.array(['#%02x%02x%02x' % tuple(int(round(255*c)) for c in rgba[:3]) for rgba in colormap.colors])
+    classes = np.searchsorted(np.asarray(colormap.index)[1:-1], kge, side = 'left')
+    colors = palette[np.clip(classes, 0, len(palette)-1)]
+    colors[np.isnan(kge)] = NO_SCORE_COLOR
+    return colors
+
+
+def score_layer(df_map, scores, colormap, lazy = False, cluster = True):
+    """
+    All scored sites as one marker layer, markers are created in the browser from a single array
+    Arguments:
+    ----------
+    df_map (pandas.dataframe): Sites with NWIS_site_id, dec_lat_va and dec_long_va, ordered as scores
+    scores (pandas.dataframe): Site scores with n and KGE, and KGE_lower/KGE_upper if bootstrapped
+    colormap (branca.colormap.StepColormap): Legend with the KGE class breaks
+    lazy (bool): Bind popups that load the site series written by write_series
+    cluster (bool): Cluster nearby markers, otherwise markers are only clustered at zoom 0
+    Returns
+    -------
+    (folium.plugins.FastMarkerCluster)
+    """
+    valid = (scores['n'] >= 1).values
+    sites = df_map['NWIS_site_id'].astype(str)[valid].reset_index(drop = True)
+    kge = scores['KGE'][valid].reset_index(drop = True)
+
+    tooltips = 'USGS station id: ' + sites + ', KGE: ' + kge.round(2).astype(str)
+    if 'KGE_lower' in scores:
+        tooltips = (tooltips + ' (' + scores['KGE_lower'][valid].round(2).astype(str).values +
+                    ' to ' + scores['KGE_upper'][valid].round(2).astype(str).values + ')')
+
+    rows = list(zip(df_map['dec_lat_va'][valid].astype('float64').tolist(),
+                    df_map['dec_long_va'][valid].astype('float64').tolist(),
+                    kge_colors(kge, colormap).tolist(),
+                    tooltips.tolist(),
+                    sites.tolist() if lazy else [None]*len(sites)))
+    options = None if cluster else {'disableClusteringAtZoom': 1}
+    return FastMarkerCluster(rows, callback = LAYER_CALLBACK, options = options, name = 'Model Performance (KGE)')
+
+
+def write_series(series_dir, df_map, obs, mod, model, units, scores = None, max_points = None):
+    """
+    Write the per-site series files of every mapped site
+    Arguments:
+    ----------
+    series_dir (str): Directory next to the map holding the per-site files
+    df_map (pandas.dataframe): Sites with NWIS_site_id, NWIS_sitename and NHD_reachid
+    obs (pandas.dataframe): Observed flows, one column per USGS site
+    mod (pandas.dataframe): Modeled flows, one column per reach
+    model (str): Model name used in the series labels
+    units (str): Flow units, 'cfs' or 'Acre-Feet'
+    scores (pandas.dataframe): Optional site scores, sites with n of 0 are skipped
+    max_points (int): Optional number of LTTB points kept per series
+    """
+    valid = np.ones(len(df_map), dtype = bool) if scores is None else (scores['n'] >= 1).values
+    for site, site_name, reach in df_map[['NWIS_site_id', 'NWIS_sitename', 'NHD_reachid']][valid].itertuples(index = False):
+        df = pd.DataFrame({'USGS station id: ' + site: obs[site],
+                           model + ' reach id: ' + str(reach): mod[reach]})
+        write_site_series(series_dir, site, series_payload(downsample.downsample_frame(df, max_points), site_name, units))
+
+
+def save_lazy_map(m, map_dir, series_url = 'series'):
+    """
+    Attach the popup loader to a map and write it next to its per-site series files
+    Arguments:
+    ----------
+    m (folium.Map): Map with lazy_popup markers
+    map_dir (str): Directory holding the map and its series_url subdirectory
+    series_url (str): Subdirectory of map_dir with the per-site files
+    Returns
+    -------
+    (str): Path of the saved map
+    """
+    m.add_child(Lazy_Hydrographs(series_url))
+    os.makedirs(map_dir, exist_ok = True)
+    path = os.path.join(map_dir, 'map.html')
+    m.save(path)
+    return path
+
+
+def show_map(m, lazy = False, map_dir = None):
+    """
+    Display a map, lazy maps are saved first so their popups can reach the series files
+    Arguments:
+    ----------
+    m (folium.Map): Map to show
+    lazy (bool): The map has lazy popups
+    map_dir (str): Directory for the saved map when lazy
+    Returns
+    -------
+    (str): Path of the saved map when lazy, otherwise None
+    """
+    if not lazy:
+        display(m)
+        return None
+    path = save_lazy_map(m, map_dir)
+    print('Map saved to ', path)
+    display(IFrame(os.path.relpath(path), width = '100%', height = 600))
+    return path
@@ -0,0 +1,215 @@
+# Script with JIT-compiled hydrologic skill kernels
+# Each kernel makes a single NaN-skipping pass over a (time x site) array and runs
+# the sites in parallel, so thousands of gauges can be scored over many periods.
+# The statistics follow the definitions of metrics.evaluate, given the same mask and floor
+# the two agree (tests/test_metrics.py), except that evaluate rounds RMSE and MaxError.
+
+import numpy as np
+import pandas as pd
+
+try:
+    from numba import njit, prange
+except ImportError:
+    #numba is optional, without it the kernels run as plain (slow) Python
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+    prange = range
+
+#order of the statistics returned by the kernels
+METRICS = ['KGE', 'r', 'alpha', 'beta', 'NSE', 'logNSE', 'PBIAS', 'RMSE', 'MaxError', 'MAPE', 'n']
+N_METRICS = len(METRICS)
+
+
+@njit(cache = True, error_model = 'numpy')
+def site_skill(obs, mod, epsilon):
+    """
+    Single pass over one site's series with Welford-style running moments
+    Arguments:
+    ----------
+    obs (numpy.array): Observed flows, NaN where missing
+    mod (numpy.array): Modeled flows, NaN where missing
+    epsilon (float): Offset added before taking logs for log-NSE
+    Returns
+    -------
+    (numpy.array): Statistics ordered as METRICS
+    """
+    out = np.empty(N_METRICS)
+    n = 0
+    mean_o = 0.0
+    mean_m = 0.0
+    m2_o = 0.0
+    m2_m = 0.0
+    c_om = 0.0
+    sum_o = 0.0
+    sum_m = 0.0
+    sse = 0.0
+    max_err = 0.0
+    sum_ape = 0.0
+    mean_lo = 0.0
+    m2_lo = 0.0
+    sse_log = 0.0
+
+    for t in range(obs.shape[0]):
+        o = obs[t]
+        m = mod[t]
+        if np.isnan(o) or np.isnan(m):
+            continue
+        n += 1
+        d_o = o - mean_o
+        d_m = m - mean_m
+        mean_o += d_o / n
+        mean_m += d_m / n
+        m2_o += d_o * (o - mean_o)
+        m2_m += d_m * (m - mean_m)
+        c_om += d_o * (m - mean_m)
+
+        sum_o += o
+        sum_m += m
+        err = o - m
+        sse += err * err
+        if abs(err) > max_err:
+            max_err = abs(err)
+        sum_ape += abs(err / o) * 100
+
+        lo = np.log(o + epsilon)
+        lm = np.log(m + epsilon)
+        d_lo = lo - mean_lo
+        mean_lo += d_lo / n
+        m2_lo += d_lo * (lo - mean_lo)
+        sse_log += (lo - lm) * (lo - lm)
+
+    if n == 0:
+        out[:] = np.nan
+        out[10] = 0
+        return out
+
+    r = c_om / np.sqrt(m2_o * m2_m)
+    alpha = np.sqrt(m2_m / m2_o)
+    beta = sum_m / sum_o
+    out[0] = 1 - np.sqrt((r - 1)**2 + (alpha - 1)**2 + (beta - 1)**2)
+    out[1] = r
+    out[2] = alpha
+    out[3] = beta
+    out[4] = 1 - sse / m2_o
+    out[5] = 1 - sse_log / m2_lo
+    out[6] = 100 * (sum_o - sum_m) / sum_o
+    out[7] = np.sqrt(sse / n)
+    out[8] = max_err
+    out[9] = sum_ape / n
+    out[10] = n
+    return out
+
+
+@njit(parallel = True, cache = True, error_model = 'numpy')
+def skill_matrix(obs, mod, epsilon):
+    """
+    Skill statistics for every site of a (time x site) array, sites run in parallel
+    Arguments:
+    ----------
+    obs (numpy.array): Observed flows (time x site), NaN where missing
+    mod (numpy.array): Modeled flows (time x site), NaN where missing
+    epsilon (float): Offset added before taking logs for log-NSE
+    Returns
+    -------
+    (numpy.array): Statistics (metric x site) ordered as METRICS
+    """
+    n_sites = obs.shape[1]
+    out = np.empty((N_METRICS, n_sites))
+    for j in prange(n_sites):
+        out[:, j] = site_skill(obs[:, j], mod[:, j], epsilon)
+    return out
+
+
+@njit(parallel = True, cache = True, error_model = 'numpy')
+def skill_periods(obs, mod, starts, epsilon):
+    """
+    Skill statistics per (period, site) for time-ordered periods given by start rows
+    Arguments:
+    ----------
+    obs (numpy.array): Observed flows (time x site), NaN where missing
+    mod (numpy.array): Modeled flows (time x site), NaN where missing
+    starts (numpy.array): First row of each period plus the total number of rows
+    epsilon (float): Offset added before taking logs for log-NSE
+    Returns
+    -------
+    (numpy.array): Statistics (period x metric x site) ordered as METRICS
+    """
+    n_periods = len(starts) - 1
+    n_sites = obs.shape[1]
+    out = np.empty((n_periods, N_METRICS, n_sites))
+    for j in prange(n_sites):
+        for p in range(n_periods):
+            out[p, :, j] = site_skill(obs[starts[p]:starts[p+1], j], mod[starts[p]:starts[p+1], j], epsilon)
+    return out
+
+
+def nan_masked(obs, mod, mask = None, floor = None):
+    """
+    Prepare contiguous float64 inputs for the kernels, invalid steps set to NaN
+    Arguments:
+    ----------
+    obs (numpy.array): Observed flows (time x site)
+    mod (numpy.array): Modeled flows (time x site)
+    mask (numpy.array): Optional boolean validity mask (time x site)
+    floor (float): Optional minimum flow, values below are raised to it
+    Returns
+    -------
+    (numpy.array, numpy.array): obs and model arrays
+    """
+    obs = np.array(obs, dtype = 'float64', order = 'F')
+    mod = np.array(mod, dtype = 'float64', order = 'F')
+    if mask is not None:
+        obs[~mask] = np.nan
+        mod[~mask] = np.nan
+    if floor is not None:
+        obs = np.where(obs < floor, floor, obs)
+        mod = np.where(mod < floor, floor, mod)
+    return np.asfortranarray(obs), np.asfortranarray(mod)
+
+
+def skill_scores(obs, mod, mask = None, floor = None, epsilon = 0.01):
+    """
+    Score every site with KGE (r, alpha, beta), NSE, log-NSE, PBIAS, RMSE, MaxError and MAPE
+    Arguments:
+    ----------
+    obs (numpy.array): Observed flows (time x site)
+    mod (numpy.array): Modeled flows (time x site)
+    mask (numpy.array): Optional boolean validity mask (time x site)
+    floor (float): Optional minimum flow, values below are raised to it
+    epsilon (float): Offset added before taking logs for log-NSE
+    Returns
+    -------
+    (pandas.dataframe): One row per site, columns ordered as METRICS
+    """
+    obs, mod = nan_masked(obs, mod, mask, floor)
+    return pd.DataFrame(skill_matrix(obs, mod, epsilon).T, columns = METRICS)
+
+
+def skill_scores_by_period(obs, mod, index, freq, mask = None, floor = None, epsilon = 0.01):
+    """
+    Score every site separately within each period (e.g. each water year)
+    Arguments:
+    ----------
+    obs (numpy.array): Observed flows (time x site)
+    mod (numpy.array): Modeled flows (time x site)
+    index (pandas.DatetimeIndex): Sorted time index of the rows
+    freq (str): Period frequency, e.g. 'A', 'Q', 'M' or 'A-SEP' for water years
+    mask (numpy.array): Optional boolean validity mask (time x site)
+    floor (float): Optional minimum flow, values below are raised to it
+    epsilon (float): Offset added before taking logs for log-NSE
+    Returns
+    -------
+    (pandas.dataframe): Rows indexed by (period, site position), columns ordered as METRICS
+    """
+    obs, mod = nan_masked(obs, mod, mask, floor)
+    periods = pd.DatetimeIndex(index).to_period(freq)
+    change = np.flatnonzero(periods[1:] != periods[:-1]) + 1
+    starts = np.concatenate([[0], change, [len(periods)]]).astype('int64')
+
+    out = skill_periods(obs, mod, starts, epsilon)
+    n_periods, n_metrics, n_sites = out.shape
+    scores = out.transpose(0, 2, 1).reshape(n_periods*n_sites, n_metrics)
+    rows = pd.MultiIndex.from_product([periods[starts[:-1]], np.arange(n_sites)], names = ['period', 'site'])
+    return pd.DataFrame(scores, index = rows, columns = METRICS)
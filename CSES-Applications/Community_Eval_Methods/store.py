@@ -0,0 +1,363 @@
+# Script to manage the local HDF5 data store of NWIS observations and model predictions
+# Each store keeps per-site high-water marks so a refresh only requests the missing dates.
+
+import os
+import numpy as np
+import pandas as pd
+import warnings
+from contextlib import contextmanager
+
+WATERMARK_KEY = 'watermarks'
+
+#NWIS series are stored with one column set, whether retrieved per site or in batches
+NWIS_COLUMNS = ['USGS_flow', 'USGS_ID', 'variable', 'measurement_unit']
+
+
+@contextmanager
+def digit_keys():
+    #USGS site ids and NHD reach ids start with digits, which pytables warns about when writing
+    #pytables is imported here so loading the evaluation modules does not import it
+    from tables import NaturalNameWarning
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', category = NaturalNameWarning)
+        yield
+
+
+def read_watermarks(path):
+    """
+    Read the per-site date coverage of a local store
+    Arguments:
+    ----------
+    path (str): Path to the HDF5 store
+    Returns
+    -------
+    (pandas.dataframe): Indexed by site key with startDT and endDT columns, empty if none
+    """
+    if not os.path.exists(path):
+        return pd.DataFrame(columns = ['startDT', 'endDT'])
+    try:
+        return pd.read_hdf(path, key = WATERMARK_KEY)
+    except KeyError:
+        return pd.DataFrame(columns = ['startDT', 'endDT'])
+
+
+def write_watermark(path, key, startDT, endDT):
+    """
+    Extend the high-water mark of one site to cover a date window
+    Arguments:
+    ----------
+    path (str): Path to the HDF5 store
+    key (str): Site key in the store
+    startDT (str): Start date of the window now held locally
+    endDT (str): End date of the window now held locally
+    """
+    with HDF_Writer(path) as writer:
+        writer.write_watermark(key, startDT, endDT)
+
+
+def received_end(df, endDT, valid = None):
+    """
+    Last date of a requested window that a fetch actually returned
+    NWIS daily values lag and trailing days can be missing, so a watermark set to the
+    requested end would mark those days as held and they would never be requested again.
+    Arguments:
+    ----------
+    df (pandas.dataframe): Fetched series indexed by Datetime
+    endDT (str): Requested end date (inclusive)
+    valid (pandas.Series): Optional boolean mask of the rows actually received, e.g. the
+        complete periods of a series reindexed to the whole window, defaults to every row
+    Returns
+    -------
+    (pandas.Timestamp): The earlier of endDT and the last received date, None if nothing was received
+    """
+    index = df.index if valid is None else df.index[np.asarray(valid, dtype = bool)]
+    if len(index) == 0:
+        return None
+    return min(pd.to_datetime(endDT), pd.to_datetime(index.max()).normalize())
+
+
+def nwis_frame(usgs_meanflow):
+    """
+    Reduce a retrieved NWIS series to the stored column set
+    Arguments:
+    ----------
+    usgs_meanflow (pandas.dataframe): Temporal mean flows indexed by Datetime
+    Returns
+    -------
+    (pandas.dataframe): NWIS_COLUMNS, flows as float64
+    """
+    df = usgs_meanflow.reindex(columns = NWIS_COLUMNS)
+    df['USGS_flow'] = df['USGS_flow'].astype('float64')
+    return df
+
+
+def missing_ranges(path, key, startDT, endDT, freq = 'D', watermarks = None):
+    """
+    Get the date windows of a request that are not yet held locally
+    Windows start at the beginning of a temporal period so partial periods at the
+    high-water mark are requested again and overwritten.
+    Arguments:
+    ----------
+    path (str): Path to the HDF5 store
+    key (str): Site key in the store
+    startDT (str): Requested start date
+    endDT (str): Requested end date (inclusive)
+    freq (str): Temporal frequency of the stored series ('D', 'M', 'Q', 'A')
+    watermarks (pandas.dataframe): Optional watermarks already read from the store
+    Returns
+    -------
+    (list): Ordered list of (start, end) date strings in "YYYY-MM-DD" format
+    """
+    startDT, endDT = pd.to_datetime(startDT), pd.to_datetime(endDT)
+    if watermarks is None:
+        watermarks = read_watermarks(path)
+    key = str(key)
+    if key not in watermarks.index:
+        return [(startDT.strftime('%Y-%m-%d'), endDT.strftime('%Y-%m-%d'))]
+
+    held_start, held_end = watermarks.loc[key, 'startDT'], watermarks.loc[key, 'endDT']
+    ranges = []
+    if startDT < held_start:
+        ranges.append((startDT, held_start - pd.Timedelta(days = 1)))
+    if endDT > held_end:
+        resume = (held_end + pd.Timedelta(days = 1)).to_period(freq).start_time
+        ranges.append((max(resume, startDT), endDT))
+    return [(s.strftime('%Y-%m-%d'), e.strftime('%Y-%m-%d')) for s, e in ranges]
+
+
+def append_to_store(path, key, df):
+    """
+    Append new rows of a site to the local store, newer rows replace overlapping dates
+    Arguments:
+    ----------
+    path (str): Path to the HDF5 store
+    key (str): Site key in the store
+    df (pandas.dataframe): New rows indexed by Datetime
+    """
+    with HDF_Writer(path) as writer:
+        writer.append(key, df)
+
+
+class HDF_Writer():
+    """
+    Keep one HDFStore open for a whole batch of site writes
+    Series are written in compressed, appendable table format with the Datetime
+    index as a queryable column.
+    Arguments:
+    ----------
+    path (str): Path to the HDF5 store
+    complib (str): Compression library, blosc:zstd by default
+    complevel (int): Compression level from 0 to 9
+    min_itemsize (int): Reserved width for string columns so later appends fit
+    """
+    def __init__(self, path, complib = 'blosc:zstd', complevel = 5, min_itemsize = 64):
+        self.path = path
+        self.complib = complib
+        self.complevel = complevel
+        self.min_itemsize = min_itemsize
+        self.hdf = None
+        self.marks = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok = True)
+        self.hdf = pd.HDFStore(self.path, mode = 'a', complib = self.complib, complevel = self.complevel)
+        return self
+
+    def __exit__(self, *args):
+        #high-water marks are buffered during the batch and written once
+        if self.marks is not None:
+            with digit_keys():
+                self.hdf.put(WATERMARK_KEY, self.marks.astype('datetime64[ns]'))
+            self.marks = None
+        self.hdf.close()
+        self.hdf = None
+
+    def prepare(self, df):
+        #pytables needs fixed width strings, convert bytes/mixed object columns to str
+        df = df.copy()
+        for col in df.columns[df.dtypes == object]:
+            df[col] = df[col].astype(str)
+        df.index = pd.DatetimeIndex(df.index, name = 'Datetime')
+        return df
+
+    def put(self, key, df):
+        """
+        Write a site's series, replacing anything held for the key
+        Arguments:
+        ----------
+        key (str): Site key in the store
+        df (pandas.dataframe): Series indexed by Datetime
+        """
+        with digit_keys():
+            self.hdf.put(str(key), self.prepare(df), format = 'table',
+                         min_itemsize = {'values': self.min_itemsize}, index = True)
+
+    def held_dtypes(self, key):
+        #column names and dtypes of a held table, read from an empty selection
+        return self.hdf.select(key, start = 0, stop = 0).dtypes
+
+    def append(self, key, df):
+        """
+        Append rows of a site's series, newer rows replace overlapping dates
+        Held rows are only removed once the new rows are written, so a failed append
+        leaves the store as it was.
+        Arguments:
+        ----------
+        key (str): Site key in the store
+        df (pandas.dataframe): New rows indexed by Datetime
+        """
+        key = str(key)
+        df = self.prepare(df)
+        if len(df) == 0:
+            return
+        if key not in self.hdf:
+            with digit_keys():
+                self.hdf.append(key, df, format = 'table', min_itemsize = {'values': self.min_itemsize}, index = True)
+            return
+
+        start, end = df.index.min(), df.index.max()
+        if not self.hdf.get_storer(key).is_table or not self.held_dtypes(key).equals(df.dtypes):
+            #fixed format stores written with DataFrame.to_hdf and tables of another column set
+            #cannot take the rows, the key is rewritten whole in the incoming columns
+            held = self.hdf.get(key)
+            held = held[(held.index < start) | (held.index > end)].reindex(columns = df.columns)
+            self.put(key, pd.concat([held, df]).sort_index())
+            return
+
+        n_held = self.hdf.get_storer(key).nrows
+        with digit_keys():
+            self.hdf.append(key, df, format = 'table', min_itemsize = {'values': self.min_itemsize}, index = True)
+        #new rows are stored after the held ones, only held rows in the window are replaced
+        overlap = self.hdf.select_as_coordinates(key, where = 'index >= start & index <= end')
+        overlap = overlap[overlap < n_held]
+        if len(overlap) > 0:
+            self.hdf.remove(key, where = overlap)
+
+    def select(self, key, startDT = None, endDT = None):
+        """
+        Read a site's series, optionally only a date window
+        Arguments:
+        ----------
+        key (str): Site key in the store
+        startDT (str): Optional start date
+        endDT (str): Optional end date (inclusive)
+        Returns
+        -------
+        (pandas.dataframe): Series indexed by Datetime
+        """
+        key = str(key)
+        if not self.hdf.get_storer(key).is_table:
+            return self.hdf.get(key).loc[startDT:endDT]
+        where = []
+        if startDT is not None:
+            start = pd.to_datetime(startDT)
+            where.append('index >= start')
+        if endDT is not None:
+            end = pd.to_datetime(endDT) + pd.Timedelta(days = 1)
+            where.append('index < end')
+        #rows prepended before the high-water mark are stored after the later rows
+        return self.hdf.select(key, where = where if len(where) > 0 else None).sort_index()
+
+    def watermarks(self):
+        if self.marks is not None:
+            return self.marks
+        if WATERMARK_KEY in self.hdf:
+            return self.hdf.get(WATERMARK_KEY)
+        return pd.DataFrame(columns = ['startDT', 'endDT'])
+
+    def write_watermark(self, key, startDT, endDT, fetchedDT = None):
+        """
+        Extend the high-water mark of one site to cover a date window
+        Arguments:
+        ----------
+        key (str): Site key in the store
+        startDT (str): Start date of the window now held locally
+        endDT (str): End date of the window now held locally
+        fetchedDT (str): Optional end of the last request to the source, may be later
+            than endDT when the source had no data past endDT
+        """
+        watermarks = self.watermarks()
+        key = str(key)
+        startDT, endDT = pd.to_datetime(startDT), pd.to_datetime(endDT)
+        if key in watermarks.index:
+            startDT = min(startDT, watermarks.loc[key, 'startDT'])
+            endDT = max(endDT, watermarks.loc[key, 'endDT'])
+        watermarks.loc[key, 'startDT'] = startDT
+        watermarks.loc[key, 'endDT'] = endDT
+        if fetchedDT is not None:
+            fetchedDT = pd.to_datetime(fetchedDT)
+            if 'fetchedDT' in watermarks and not pd.isna(watermarks.loc[key, 'fetchedDT']):
+                fetchedDT = max(fetchedDT, watermarks.loc[key, 'fetchedDT'])
+            watermarks.loc[key, 'fetchedDT'] = fetchedDT
+        self.marks = watermarks
+
+
+def cached_series(path, key, startDT, endDT, fetch):
+    """
+    Return a site's series for a window, fetching only when the local store does not cover it
+    Only rows outside the held window are added to the store after a fetch. The fetch returns
+    the whole record, so a record ending before endDT is not fetched again for the same
+    window, only for a later endDT.
+    Arguments:
+    ----------
+    path (str): Path to the HDF5 store
+    key (str): Site key in the store
+    startDT (str): Requested start date
+    endDT (str): Requested end date (inclusive)
+    fetch (function): Called with no arguments, returns the site series indexed by Datetime
+    Returns
+    -------
+    (pandas.dataframe): Site series for the requested window
+    """
+    watermarks = read_watermarks(path)
+    fetched = watermarks
+    if 'fetchedDT' in watermarks:
+        #the record was already requested through fetchedDT, dates up to it have nothing more to give
+        fetched = watermarks.assign(endDT = watermarks[['endDT', 'fetchedDT']].max(axis = 1))
+    with HDF_Writer(path) as writer:
+        if len(missing_ranges(path, key, startDT, endDT, watermarks = fetched)) > 0:
+            #a new fetch also fills the dates past the held data that earlier fetches lacked
+            ranges = missing_ranges(path, key, startDT, endDT, watermarks = watermarks)
+            new = fetch()
+            for s, e in ranges:
+                writer.append(key, new.loc[s:e])
+            held_end = received_end(new, endDT)
+            if held_end is not None:
+                writer.write_watermark(key, startDT, held_end, fetchedDT = endDT)
+
+        return writer.select(key, startDT, endDT)
+
+
+def iter_site_windows(path, keys, startDT, endDT, column = None, chunk_days = 1826):
+    """
+    Stream daily (time x site) matrices from a local store one time window at a time
+    Only one window of every site is read at once, so the full record is never in memory.
+    Arguments:
+    ----------
+    path (str): Path to the HDF5 store
+    keys (list): Site keys in the store, one matrix column each
+    startDT (str): Start date
+    endDT (str): End date (inclusive)
+    column (str): Column holding the flows, the first column if None
+    chunk_days (int): Number of days per window
+    Returns
+    -------
+    (generator): (pandas.DatetimeIndex, numpy.array) per window, NaN where a site has no data
+    """
+    keys = [str(key) for key in keys]
+    starts = pd.date_range(pd.to_datetime(startDT), pd.to_datetime(endDT), freq = str(chunk_days)+'D')
+    ends = list(starts[1:] - pd.Timedelta(days = 1)) + [pd.to_datetime(endDT)]
+
+    with HDF_Writer(path) as writer:
+        for start, end in zip(starts, ends):
+            index = pd.date_range(start, end, freq = 'D')
+            matrix = np.full((len(index), len(keys)), np.nan)
+            for j, key in enumerate(keys):
+                if key not in writer.hdf:
+                    continue
+                series = writer.select(key, start, end)
+                series = series[column] if column is not None else series.iloc[:, 0]
+                #stored daily values are stamped at noon
+                series = pd.to_numeric(series, errors = 'coerce').groupby(series.index.normalize()).mean()
+                matrix[:, j] = series.reindex(index).values
+            yield index, matrix
@@ -0,0 +1,32 @@
+# Script with the visualization extras of the evaluation modules, all imported on first use
+# The evaluation classes draw through these handles, so importing them for data loading
+# and scoring does not import matplotlib, holoviews, folium or vincent, nor change any
+# global plotting or warning settings until something is actually plotted.
+
+import warnings
+import pandas as pd
+from Community_Eval_Methods import lazy
+
+
+def pyplot_setup(plt):
+    plt.rcParams['figure.facecolor'] = 'w'
+    #notebook plotting is noisy with pandas and matplotlib deprecation warnings
+    warnings.filterwarnings('ignore')
+
+
+def holoviews_setup(hv):
+    #registers the bokeh extension and the .hvplot accessor
+    import hvplot.pandas
+    pd.options.plotting.backend = 'holoviews'
+    warnings.filterwarnings('ignore')
+
+
+plt = lazy.Lazy_Module('matplotlib.pyplot', setup = pyplot_setup)
+hv = lazy.Lazy_Module('holoviews', setup = holoviews_setup)
+folium = lazy.Lazy_Module('folium')
+features = lazy.Lazy_Module('folium.features')
+cm = lazy.Lazy_Module('branca.colormap')
+vincent = lazy.Lazy_Module('vincent')
+site_map = lazy.Lazy_Module('Community_Eval_Methods.site_map')
+report = lazy.Lazy_Module('Community_Eval_Methods.report')
+display = lazy.display
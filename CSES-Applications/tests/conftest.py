@@ -0,0 +1,5 @@
+import os
+import sys
+
+#tests import the evaluation modules as the notebooks do, from the CSES-Applications directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
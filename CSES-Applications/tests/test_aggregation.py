@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+from Community_Eval_Methods import aggregation
+
+
+def daily_flows(seed = 0):
+    #three years of float32 flows with a gap month and a site missing its first year
+    rng = np.random.default_rng(seed)
+    index = pd.date_range('2001-01-01', '2003-12-31', freq = 'D', name = 'Datetime')
+    data = pd.DataFrame(rng.lognormal(3, 1, (len(index), 3)).astype('float32'), index = index, columns = ['a', 'b', 'c'])
+    data.loc['2002-03', 'a'] = np.nan
+    data.loc['2001', 'c'] = np.nan
+    return data
+
+
+def test_pyramid_levels_match_resample():
+    data = daily_flows()
+    pyramid = aggregation.Aggregation_Pyramid(data, 1.983)
+    for freq in ['M', 'Q', 'A', 'A-SEP']:
+        expected = (data.astype('float64')*1.983).resample(freq).sum(min_count = 1)
+        assert np.allclose(pyramid.level(freq), expected, rtol = 1e-14, atol = 0, equal_nan = True)
+        assert (pyramid.level(freq, 'count') == data.notna().resample(freq).sum()).all().all()
+
+
+def test_complete_levels_drop_periods_with_gaps():
+    data = daily_flows()
+    data.loc['2003-06-10', 'b'] = np.nan
+    pyramid = aggregation.Aggregation_Pyramid(data, 1.983)
+    monthly = pyramid.level('M', complete = True)
+    assert np.isnan(monthly.loc['2002-03-31', 'a'])
+    assert np.isnan(monthly.loc['2003-06-30', 'b'])
+    assert monthly['c'].isna().sum() == 12
+    assert monthly.notna().sum().sum() == 3*36 - 1 - 1 - 12
+    assert pyramid.level('A', complete = True)['a'].isna().tolist() == [False, True, False]
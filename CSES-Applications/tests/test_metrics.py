@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+from Community_Eval_Methods import metrics, skill_kernels
+
+
+def low_flow_pairs(n_steps = 3650, n_sites = 4, seed = 0):
+    #flows mostly below the 0.01 scoring floor, the model doubles them
+    rng = np.random.default_rng(seed)
+    obs = rng.lognormal(-6, 0.5, (n_steps, n_sites))
+    mod = obs*rng.lognormal(0.7, 0.1, (n_steps, n_sites))
+    obs[:30, 0] = np.nan
+    return obs, mod
+
+
+def test_map_kge_inside_bootstrap_interval():
+    #Map_Plot_Eval shows the floored kernel KGE next to its bootstrap interval
+    obs, mod = low_flow_pairs()
+    mask = metrics.validity_mask(obs, mod)
+    kge = skill_kernels.skill_scores(obs, mod, mask, floor = 0.01)['KGE'].values
+    ci = metrics.kge_bootstrap(obs, mod, mask, n_boot = 200)
+    assert np.all(ci['KGE_lower'].values <= kge)
+    assert np.all(kge <= ci['KGE_upper'].values)
+
+
+def test_evaluate_kge_inside_bootstrap_interval():
+    #Score_Sites scores and bootstraps with the default floor
+    obs, mod = low_flow_pairs()
+    mask = metrics.validity_mask(obs, mod)
+    kge = metrics.evaluate(obs, mod, mask, metric_set = ['KGE'])['KGE'].values
+    ci = metrics.kge_bootstrap(obs, mod, mask, n_boot = 200)
+    assert np.all(ci['KGE_lower'].values <= kge)
+    assert np.all(kge <= ci['KGE_upper'].values)
+
+
+def test_kernels_match_evaluate():
+    #the map kernels and the table scores agree with and without the floor
+    obs, mod = low_flow_pairs()
+    obs[100:200, 1] = -1
+    mod[300:320, 2] = np.nan
+    mask = metrics.validity_mask(obs, mod)
+    metric_set = ['KGE', 'r', 'alpha', 'beta', 'NSE', 'logNSE', 'PBIAS', 'MAPE']
+    for floor in [0.01, 0]:
+        kernel = skill_kernels.skill_scores(obs, mod, mask, floor = floor)
+        scores = metrics.evaluate(obs, mod, mask, floor = floor, metric_set = metric_set + ['RMSE'])
+        assert np.allclose(kernel[metric_set].values, scores[metric_set].values, rtol = 1e-9)
+        assert np.array_equal(np.round(kernel['RMSE'].values), scores['RMSE'].values)
+        assert np.array_equal(kernel['n'].values, scores['n'].values)
+
+
+def test_bias_metrics_share_sign_convention():
+    #a model 20% low is positive in PBIAS and FHV, FLV in log space ignores a constant scale
+    rng = np.random.default_rng(1)
+    obs = rng.lognormal(2, 1, (1000, 2))
+    mod = np.c_[obs[:, 0]*0.8, obs[:, 1]*1.2]
+    scores = metrics.evaluate(obs, mod, metrics.validity_mask(obs, mod), metric_set = ['PBIAS', 'FHV', 'FLV'])
+    assert np.allclose(scores['PBIAS'], [20, -20])
+    assert np.allclose(scores['FHV'], [20, -20])
+    assert np.allclose(scores['FLV'], 0, atol = 1e-9)
+
+
+def per_site_scores(NWIS_data, Mod_data):
+    #the per-site Score_Sites loop evaluate replaced, with sklearn's RMSE and MAPE and
+    #hydroeval's kge, nse and pbias written out in float64
+    rows = []
+    for site in NWIS_data.columns:
+        df = pd.DataFrame({'obs': NWIS_data[site], 'mod': Mod_data[site].astype('float64')})
+        df = df[df >= 0]
+        df.dropna(inplace = True)
+        if len(df) < 1:
+            rows.append({'RMSE': 0, 'MAPE': 0, 'KGE': -10000, 'NSE': np.nan, 'PBIAS': np.nan})
+            continue
+        df[df < 0.01] = 0.01
+        obs, mod = df['obs'].values, df['mod'].values
+        r = np.corrcoef(obs, mod)[0, 1]
+        alpha = np.std(mod) / np.std(obs)
+        beta = np.sum(mod) / np.sum(obs)
+        rows.append({
+            'RMSE': round(np.sqrt(np.mean((obs - mod)**2))),
+            'MAPE': np.mean(np.abs(obs - mod) / np.abs(obs))*100,
+            'KGE': 1 - np.sqrt((r - 1)**2 + (alpha - 1)**2 + (beta - 1)**2),
+            'NSE': 1 - np.sum((obs - mod)**2) / np.sum((obs - np.mean(obs))**2),
+            'PBIAS': 100*np.sum(obs - mod) / np.sum(obs)
+        })
+    return pd.DataFrame(rows, index = NWIS_data.columns)
+
+
+def test_evaluate_matches_per_site_loop():
+    #gaps, negative and below-floor flows, and a site without observations
+    rng = np.random.default_rng(2)
+    index = pd.date_range('2015-01-01', periods = 400, freq = 'D')
+    obs = rng.lognormal(2, 1.5, (400, 4))
+    mod = obs*rng.lognormal(0.1, 0.4, (400, 4))
+    obs[rng.random((400, 4)) < 0.1] = np.nan
+    mod[rng.random((400, 4)) < 0.05] = np.nan
+    obs[:20, 1] = -1
+    mod[20:40, 2] = 0.001
+    obs[:, 3] = np.nan
+    NWIS_data = pd.DataFrame(obs, index = index, columns = ['a', 'b', 'c', 'd'])
+    Mod_data = pd.DataFrame(mod, index = index, columns = ['a', 'b', 'c', 'd'])
+
+    metric_set = ['KGE', 'NSE', 'PBIAS', 'RMSE', 'MAPE']
+    expected = per_site_scores(NWIS_data, Mod_data)[metric_set]
+    scores = metrics.evaluate(obs, mod, metrics.validity_mask(obs, mod), metric_set = metric_set)
+    assert np.allclose(scores[metric_set].values, expected.values, rtol = 1e-12, atol = 1e-12, equal_nan = True)
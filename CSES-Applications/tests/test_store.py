@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+import pandas as pd
+from Community_Eval_Methods import store
+
+
+def daily_flows(startDT, endDT):
+    index = pd.date_range(startDT, endDT, freq = 'D', name = 'Datetime')
+    return pd.DataFrame({'USGS_flow': np.arange(len(index), dtype = 'float64')}, index = index)
+
+
+def test_cached_series_watermark_stops_at_fetched_data(tmp_path):
+    #provisional NWIS days are not published yet, the fetch ends before the requested window
+    path = str(tmp_path / 'NWIS.h5')
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        return daily_flows('2020-01-01', '2020-01-20')
+
+    df = store.cached_series(path, '10163000', '2020-01-01', '2020-01-31', fetch)
+    assert df.index.max() == pd.Timestamp('2020-01-20')
+    assert store.read_watermarks(path).loc['10163000', 'endDT'] == pd.Timestamp('2020-01-20')
+    assert store.missing_ranges(path, '10163000', '2020-01-01', '2020-01-31') == [('2020-01-21', '2020-01-31')]
+
+    #the whole record was fetched, the same window is not requested again
+    df = store.cached_series(path, '10163000', '2020-01-01', '2020-01-31', fetch)
+    assert len(calls) == 1
+    assert len(df) == 20
+
+    #a later window requests the trailing days again, by then they are published
+    df = store.cached_series(path, '10163000', '2020-01-01', '2020-02-05',
+                             lambda: daily_flows('2020-01-01', '2020-02-05'))
+    assert len(df) == 36
+    assert store.missing_ranges(path, '10163000', '2020-01-01', '2020-02-05') == []
+
+
+def test_received_end_skips_trailing_partial_periods():
+    df = daily_flows('2020-01-01', '2020-01-10')
+    partial = pd.Series(df.index >= '2020-01-08', index = df.index)
+    assert store.received_end(df, '2020-01-10', ~partial) == pd.Timestamp('2020-01-07')
+    assert store.received_end(df, '2020-01-05') == pd.Timestamp('2020-01-05')
+    assert store.received_end(df.iloc[:0], '2020-01-10') is None
+
+
+def legacy_nwis(startDT, periods):
+    #per-site retrieval before the stores were unified, written with DataFrame.to_hdf
+    index = pd.date_range(startDT, periods = periods, freq = 'D', name = 'Datetime')
+    return pd.DataFrame({'USGS_flow': np.arange(periods, dtype = 'float64'), 'USGS_ID': '10163000',
+                         'variable': 'streamflow', 'measurement_unit': 'ft3/s',
+                         'qualifiers': "['A']", 'series': 0}, index = index)
+
+
+def batch_nwis(startDT, periods):
+    #IV_Reducer output with its per-period sample counts
+    index = pd.date_range(startDT, periods = periods, freq = 'D', name = 'Datetime')
+    return pd.DataFrame({'USGS_flow': np.full(periods, 100.0), 'n_obs': 96, 'coverage': 1.0, 'partial': False,
+                         'USGS_ID': '10163000', 'variable': 'streamflow', 'measurement_unit': 'ft3/s'}, index = index)
+
+
+def test_append_rewrites_legacy_schema(tmp_path):
+    path = str(tmp_path / 'NWIS_sites_ut.h5')
+    legacy_nwis('2020-01-01', 10).to_hdf(path, key = '10163000')
+    with store.HDF_Writer(path) as writer:
+        writer.append('10163000', store.nwis_frame(batch_nwis('2020-01-06', 10)))
+        df = writer.select('10163000')
+    assert list(df.columns) == store.NWIS_COLUMNS
+    assert len(df) == 15
+    assert df['USGS_flow'].tolist() == [0.0, 1.0, 2.0, 3.0, 4.0] + [100.0]*10
+
+
+def test_append_replaces_overlapping_rows(tmp_path):
+    path = str(tmp_path / 'NWIS_sites_ut.h5')
+    with store.HDF_Writer(path) as writer:
+        writer.put('10163000', store.nwis_frame(legacy_nwis('2020-01-01', 10)))
+        writer.append('10163000', store.nwis_frame(batch_nwis('2020-01-04', 3)))
+        df = writer.select('10163000')
+    assert len(df) == 10
+    assert df['USGS_flow'].tolist() == [0.0, 1.0, 2.0, 100.0, 100.0, 100.0, 6.0, 7.0, 8.0, 9.0]
+
+
+def test_failed_append_keeps_held_rows(tmp_path):
+    path = str(tmp_path / 'NWIS_sites_ut.h5')
+    with store.HDF_Writer(path, min_itemsize = 8) as writer:
+        writer.put('10163000', store.nwis_frame(legacy_nwis('2020-01-01', 10)))
+        new = store.nwis_frame(batch_nwis('2020-01-04', 3))
+        new['variable'] = 'a variable name longer than the reserved width'
+        with pytest.raises(ValueError):
+            writer.append('10163000', new)
+        df = writer.select('10163000')
+    assert df['USGS_flow'].tolist() == list(np.arange(10, dtype = 'float64'))